@@ -0,0 +1,201 @@
+import asyncio
+import logging
+import os
+import re
+from datetime import date, datetime, timedelta
+
+import aiosqlite
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+
+from migrations import SEARCH_INDEX_COLUMNS, search_text
+
+logger = logging.getLogger(__name__)
+
+ARCHIVED_TABLES = ('income', 'expenses')
+ARCHIVE_COLUMNS = 'id, user_id, category, amount, currency, date, note'
+ARCHIVE_FILE_RE = re.compile(r'archive_(\d{4})\.db')
+ARCHIVE_SCHEMA = [
+    '''
+    CREATE TABLE IF NOT EXISTS {table} (
+        id INTEGER PRIMARY KEY,
+        user_id INTEGER,
+        category TEXT,
+        amount REAL,
+        currency TEXT,
+        date TEXT,
+        note TEXT
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_{table}_user_date ON {table} (user_id, date)',
+]
+# Строки архива остаются в поисковом индексе основной БД; значения как в триггерах миграции 8
+INDEX_ARCHIVED = f'''
+    INSERT INTO transactions_fts ({SEARCH_INDEX_COLUMNS})
+    VALUES (? * 2 + ?, {search_text('?')}, {search_text('?')}, ?, 'u' || ?)
+'''
+# SQLite по умолчанию позволяет присоединить к соединению не больше 10 баз
+MAX_ARCHIVE_FILES = 10
+
+
+def archive_file_name(year: int) -> str:
+    return f'archive_{year}.db'
+
+
+def archive_alias(year: int) -> str:
+    return f'archive_{year}'
+
+
+def history_source(table: str, years) -> str:
+    # Подзапрос вместо временного представления: читатели работают в режиме query_only и не могут создавать схему.
+    # SQLite проталкивает условия WHERE в каждую ветку UNION ALL и использует индексы архивов
+    branches = [f'SELECT {ARCHIVE_COLUMNS} FROM main.{table}']
+    branches += [f'SELECT {ARCHIVE_COLUMNS} FROM {archive_alias(year)}.{table}' for year in years]
+    return f"({' UNION ALL '.join(branches)})"
+
+
+class ArchiveManager:
+    def __init__(self, pool, max_age_days: int = 730, interval_hours: float = 24, batch_size: int = 5000,
+                 vacuum_pages: int = 1000, attach_grace: float = 5.0):
+        if pool.archive_dir is None:
+            raise ValueError("Для архивации пулу нужен каталог архивов.")
+        self.pool = pool
+        self.max_age_days = max_age_days
+        self.interval_hours = interval_hours
+        self.batch_size = batch_size
+        self.vacuum_pages = vacuum_pages
+        self.attach_grace = attach_grace
+        self.scheduler = AsyncIOScheduler()
+
+    def start(self):
+        self.scheduler.add_job(self.run, 'interval', hours=self.interval_hours, next_run_time=datetime.now())
+        self.scheduler.start()
+
+    def stop(self):
+        if self.scheduler.running:
+            self.scheduler.shutdown()
+
+    def cutoff(self, today: date = None) -> str:
+        # Архивируются только целые годы, все операции которых старше max_age_days
+        oldest_hot = (today or date.today()) - timedelta(days=self.max_age_days)
+        return f'{oldest_hot.year}-01-01'
+
+    async def run(self, today: date = None) -> int:
+        await self._upgrade_archives()
+        cutoff = self.cutoff(today)
+        moved = 0
+        for kind, table in enumerate(ARCHIVED_TABLES):
+            moved += await self._archive_table(kind, table, cutoff)
+        if moved:
+            logger.info("В архив перенесено операций: %s", moved)
+        await self.vacuum()
+        return moved
+
+    async def _upgrade_archives(self):
+        # Архивы, созданные до появления заметок и поиска, получают столбец note, а их строки — записи в индексе
+        async with self.pool.writer() as db:
+            for year in await self.pool.attach_archives(db):
+                for kind, table in enumerate(ARCHIVED_TABLES):
+                    async with db.execute(f'PRAGMA {archive_alias(year)}.table_info({table})') as cursor:
+                        if 'note' in {row[1] for row in await cursor.fetchall()}:
+                            continue
+                    await db.execute(f'ALTER TABLE {archive_alias(year)}.{table} ADD COLUMN note TEXT')
+                    async with db.execute(f'SELECT id, category, note, currency, user_id '
+                                          f'FROM {archive_alias(year)}.{table}') as cursor:
+                        rows = await cursor.fetchall()
+                    await db.executemany(INDEX_ARCHIVED, [(row_id, kind, *values) for row_id, *values in rows])
+            await db.commit()
+
+    async def _archive_table(self, kind, table, cutoff) -> int:
+        async with self.pool.reader() as db:
+            async with db.execute(f'SELECT MAX(id) FROM main.{table}') as cursor:
+                max_id = (await cursor.fetchone())[0] or 0
+
+        moved = 0
+        # Проход окнами по id: каждое окно — короткая транзакция, писатель не занят надолго
+        for lower in range(0, max_id, self.batch_size):
+            upper = lower + self.batch_size
+            async with self.pool.reader() as db:
+                async with db.execute(f'''
+                    SELECT DISTINCT substr(date, 1, 4) FROM main.{table}
+                    WHERE id > ? AND id <= ? AND date < ?
+                ''', (lower, upper, cutoff)) as cursor:
+                    years = sorted(int(year) for year, in await cursor.fetchall() if year and year.isdigit())
+            if years:
+                years = await self._ensure_archives(years)
+                moved += await self._move(kind, table, lower, upper, years)
+        return moved
+
+    async def _ensure_archives(self, years):
+        existing = set(self.pool.archive_years())
+        created = False
+        for year in years:
+            if year in existing:
+                continue
+            if len(existing) >= MAX_ARCHIVE_FILES:
+                logger.error("Достигнут предел числа архивов, операции %s года остаются в основной БД", year)
+                continue
+            await self._create_archive(year)
+            existing.add(year)
+            created = True
+        if created:
+            # Пулы других процессов замечают новый файл при следующем запросе к истории; пауза не даёт
+            # перенести строки в архив, которого ещё не видит уже начатый запрос
+            await asyncio.sleep(self.attach_grace)
+        return [year for year in years if year in existing]
+
+    async def _create_archive(self, year):
+        os.makedirs(self.pool.archive_dir, exist_ok=True)
+        path = os.path.join(self.pool.archive_dir, archive_file_name(year))
+        tmp_path = path + '.tmp'
+        # Файл появляется под итоговым именем только со схемой, чтобы читатели не присоединили пустую БД
+        async with aiosqlite.connect(tmp_path) as db:
+            for table in ARCHIVED_TABLES:
+                for statement in ARCHIVE_SCHEMA:
+                    await db.execute(statement.format(table=table))
+            await db.commit()
+        os.replace(tmp_path, path)
+
+    async def _move(self, kind, table, lower, upper, years) -> int:
+        moved = 0
+        async with self.pool.writer() as db:
+            await self.pool.attach_archives(db)
+            for year in years:
+                bounds = (lower, upper, f'{year:04d}-01-01', f'{year + 1:04d}-01-01')
+                # INSERT OR IGNORE делает перенос повторяемым: в WAL транзакция над несколькими файлами атомарна
+                # только для каждого файла, и после сбоя следующий запуск доделает удаление из основной БД
+                await db.execute(f'''
+                    INSERT OR IGNORE INTO {archive_alias(year)}.{table} ({ARCHIVE_COLUMNS})
+                    SELECT {ARCHIVE_COLUMNS} FROM main.{table}
+                    WHERE id > ? AND id <= ? AND date >= ? AND date < ?
+                ''', bounds)
+                # Триггер удаления убирает строки из поискового индекса; возвращаются ровно удалённые строки
+                async with db.execute(f'''
+                    DELETE FROM main.{table} WHERE id > ? AND id <= ? AND date >= ? AND date < ?
+                    RETURNING id, category, note, currency, user_id
+                ''', bounds) as cursor:
+                    rows = await cursor.fetchall()
+                await db.executemany(INDEX_ARCHIVED, [(row_id, kind, *values) for row_id, *values in rows])
+                moved += len(rows)
+            await db.commit()
+        return moved
+
+    async def vacuum(self):
+        async with self.pool.writer() as db:
+            async with db.execute('PRAGMA auto_vacuum') as cursor:
+                mode = (await cursor.fetchone())[0]
+        if mode != 2:
+            logger.warning("В БД не включён auto_vacuum=INCREMENTAL, освободившееся место не возвращается. "
+                           "Выполните: python manage.py enable-incremental-vacuum")
+            return
+
+        # Страницы освобождаются порциями, между которыми писатель доступен остальным
+        while True:
+            async with self.pool.writer() as db:
+                async with db.execute('PRAGMA freelist_count') as cursor:
+                    if (await cursor.fetchone())[0] == 0:
+                        break
+                async with db.execute(f'PRAGMA incremental_vacuum({int(self.vacuum_pages)})') as cursor:
+                    await cursor.fetchall()
+        async with self.pool.writer() as db:
+            async with db.execute('PRAGMA wal_checkpoint(TRUNCATE)') as cursor:
+                await cursor.fetchall()
@@ -0,0 +1,66 @@
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+from aiogram.contrib.fsm_storage.memory import MemoryStorage
+
+from connection_pool import ConnectionPool
+from database_manager import DatabaseManager
+from sqlite_storage import SQLiteStorage
+from write_queue import WriteQueue
+
+# Запуск из корня репозитория: python -m benchmarks.bench_fsm_storage --users 2000 --rounds 5
+
+# Переходы одного диалога /add_expense: категория, сумма, валюта, завершение
+TRANSITIONS_PER_DIALOG = 6
+
+
+async def dialog(storage, user):
+    await storage.set_state(chat=user, user=user, state='AddExpense:category')
+    await storage.update_data(chat=user, user=user, category='Продукты')
+    await storage.set_state(chat=user, user=user, state='AddExpense:amount')
+    await storage.update_data(chat=user, user=user, amount=100.0)
+    await storage.get_data(chat=user, user=user)
+    await storage.finish(chat=user, user=user)
+
+
+async def run(mode, users, rounds):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        pool = ConnectionPool(os.path.join(tmp_dir, 'bench.db'), readers=2)
+        await pool.open()
+        await DatabaseManager(pool).init_db()
+        write_queue = WriteQueue(pool)
+        write_queue.start()
+
+        if mode == 'memory':
+            storage = MemoryStorage()
+        else:
+            storage = SQLiteStorage(pool, write_queue)
+            storage.start()
+
+        started = time.perf_counter()
+        for _ in range(rounds):
+            await asyncio.gather(*(dialog(storage, user) for user in range(users)))
+        await storage.close()
+        elapsed = time.perf_counter() - started
+
+        await write_queue.close()
+        await pool.close()
+        return elapsed / (users * rounds * TRANSITIONS_PER_DIALOG)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Накладные расходы на переход FSM: MemoryStorage против SQLite")
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--rounds', type=int, default=5)
+    args = parser.parse_args()
+
+    for mode in ('memory', 'sqlite'):
+        per_transition = await run(mode, args.users, args.rounds)
+        print(f"{mode:>6}: {per_transition * 1e6:8.1f} мкс на переход")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
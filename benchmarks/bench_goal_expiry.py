@@ -0,0 +1,79 @@
+import argparse
+import asyncio
+import os
+import random
+import sqlite3
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+from unittest.mock import AsyncMock, MagicMock
+
+from connection_pool import ConnectionPool
+from database_manager import DatabaseManager
+from goal_manager import GoalManager
+from user_manager import UserManager
+
+# Запуск из корня репозитория: python -m benchmarks.bench_goal_expiry --goals 1000000 --due 1000
+
+
+def populate(db_path, goals, due, users=10000):
+    today = date.today()
+    with sqlite3.connect(db_path) as db:
+        db.executemany('INSERT INTO users (id, telegram_id) VALUES (?, ?)',
+                       ((user_id, 1_000_000 + user_id) for user_id in range(1, users + 1)))
+        due_ids = set(random.sample(range(goals), due))
+        db.executemany('''
+            INSERT INTO financial_goals (user_id, goal_name, target_amount, deadline, current_amount)
+            VALUES (?, ?, ?, ?, ?)
+        ''', ((random.randint(1, users), f'Цель {i}', 1000.0,
+               (today - timedelta(days=random.randint(0, 30)) if i in due_ids
+                else today + timedelta(days=random.randint(1, 3650))).isoformat(), 10.0)
+              for i in range(goals)))
+
+
+async def legacy_scan(pool):
+    # Прежний алгоритм: вся таблица читается и даты разбираются в Python
+    now = datetime.now()
+    expired = 0
+    async with pool.reader() as db:
+        async with db.execute('SELECT id, user_id, goal_name, target_amount, deadline, current_amount '
+                              'FROM financial_goals') as cursor:
+            for row in await cursor.fetchall():
+                if datetime.strptime(row[4], '%Y-%m-%d') <= now:
+                    expired += 1
+    return expired
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Сравнение обработки истёкших целей: полный проход против индекса")
+    parser.add_argument('--goals', type=int, default=1_000_000)
+    parser.add_argument('--due', type=int, default=1000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = os.path.join(tmp_dir, 'bench.db')
+        pool = ConnectionPool(db_path, readers=1)
+        await pool.open()
+        await DatabaseManager(pool).init_db()
+
+        started = time.perf_counter()
+        await asyncio.get_running_loop().run_in_executor(None, populate, db_path, args.goals, args.due)
+        print(f"Подготовка {args.goals} целей: {time.perf_counter() - started:.1f} с")
+
+        started = time.perf_counter()
+        expired = await legacy_scan(pool)
+        print(f"Полный проход + strptime: {time.perf_counter() - started:.3f} с, найдено {expired}")
+
+        bot = MagicMock()
+        bot.send_message = AsyncMock()
+        goal_manager = GoalManager(bot, pool, UserManager(pool))
+        started = time.perf_counter()
+        await goal_manager.check_goals()
+        print(f"Индексный запрос + пакетный DELETE: {time.perf_counter() - started:.3f} с, "
+              f"отправлено {bot.send_message.await_count}")
+
+        await pool.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
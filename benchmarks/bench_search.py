@@ -0,0 +1,96 @@
+import argparse
+import asyncio
+import os
+import random
+import sqlite3
+import tempfile
+import time
+from datetime import date, timedelta
+from unittest.mock import AsyncMock
+
+from chart_cache import ChartCache
+from chart_renderer import ChartRenderer
+from connection_pool import ConnectionPool
+from database_manager import DatabaseManager
+from finance_manager import FinanceManager
+from rate_store import RateStore
+from transaction_search import parse_search_query
+from user_manager import UserManager
+from write_queue import WriteQueue
+
+# Запуск из корня репозитория: python -m benchmarks.bench_search --rows 5000000
+
+CATEGORIES = ('Продукты', 'Транспорт', 'Развлечения', 'Оплата жилья', 'Другое')
+NOTES = ('Такси Яндекс Go', 'Пятёрочка', 'Магнит', 'Лукойл АЗС', 'Аптека', 'Кафе', 'Кинотеатр', 'Аренда',
+         'Ситимобил', 'Озон', 'Вкусвилл', 'Перекрёсток')
+QUERIES = ('такси', 'такси >1000 2024-03..2024-05', 'пятерочка расходы 2024', 'азс <500', 'кафе кинотеатр', 'такс*')
+
+
+def populate(db_path, rows, users, heavy_share):
+    # Каждая десятая операция принадлежит одному «тяжёлому» пользователю — худший случай для индекса (user_id, date)
+    start = date(2020, 1, 1)
+    with sqlite3.connect(db_path) as db:
+        db.executemany('INSERT INTO users (id, telegram_id) VALUES (?, ?)',
+                       ((user_id, user_id) for user_id in range(1, users + 1)))
+        db.executemany('INSERT INTO expenses (user_id, category, amount, currency, date, note) '
+                       'VALUES (?, ?, ?, ?, ?, ?)',
+                       ((1 if random.random() < heavy_share else random.randint(2, users), random.choice(CATEGORIES),
+                         round(random.uniform(50, 5000), 2), 'RUB',
+                         (start + timedelta(days=random.randrange(6 * 365))).isoformat() + 'T12:00:00',
+                         random.choice(NOTES))
+                        for _ in range(rows)))
+
+
+async def like_scan(pool, user_id, word):
+    # Прежний способ: сканирование таблицы с LIKE по заметке
+    async with pool.reader() as db:
+        async with db.execute('SELECT date, id FROM expenses WHERE user_id = ? AND (note LIKE ? OR category LIKE ?) '
+                              'ORDER BY date DESC, id DESC LIMIT 11', (user_id, f'%{word}%', f'%{word}%')) as cursor:
+            return await cursor.fetchall()
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Поиск операций: LIKE против FTS5 с индексом (user_id, date)")
+    parser.add_argument('--rows', type=int, default=5_000_000)
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--heavy-share', type=float, default=0.1)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = os.path.join(tmp_dir, 'bench.db')
+        pool = ConnectionPool(db_path, readers=1)
+        await pool.open()
+        await DatabaseManager(pool).init_db()
+
+        started = time.perf_counter()
+        await asyncio.get_running_loop().run_in_executor(None, populate, db_path, args.rows, args.users,
+                                                         args.heavy_share)
+        print(f"Подготовка {args.rows} операций вместе с индексом: {time.perf_counter() - started:.1f} с, "
+              f"БД {os.path.getsize(db_path) / 1024 / 1024:.0f} МБ")
+
+        finance_manager = FinanceManager(pool, UserManager(pool), AsyncMock(spec=WriteQueue),
+                                         AsyncMock(spec=ChartRenderer), ChartCache(), RateStore(pool))
+        for telegram_id, label in ((1, "тяжёлый пользователь"), (2, "обычный пользователь")):
+            started = time.perf_counter()
+            for _ in range(args.repeat):
+                await like_scan(pool, telegram_id, 'такси')
+            print(f"LIKE, {label}: {(time.perf_counter() - started) / args.repeat * 1000:.1f} мс")
+
+            for text in QUERIES:
+                query = parse_search_query(text)
+                started = time.perf_counter()
+                for _ in range(args.repeat):
+                    page = await finance_manager.search_transactions(telegram_id, query)
+                elapsed = (time.perf_counter() - started) / args.repeat
+                second = time.perf_counter()
+                if page.next_cursor:
+                    await finance_manager.search_transactions(telegram_id, query, cursor=page.next_cursor)
+                print(f"FTS5 «{text}», {label}: {elapsed * 1000:.1f} мс, "
+                      f"следующая страница {(time.perf_counter() - second) * 1000:.1f} мс")
+
+        await pool.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
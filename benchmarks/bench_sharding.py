@@ -0,0 +1,93 @@
+import argparse
+import asyncio
+import socket
+import time
+
+from aiogram import Bot, Dispatcher
+from aiogram.bot.api import TelegramAPIServer
+
+from currency_manager import parse_cbr_xml
+from fake_telegram import FakeTelegramAPI
+from sharding import ShardRouter, run_worker
+
+# Запуск из корня репозитория: python -m benchmarks.bench_sharding --max-workers 4 --updates 2000
+
+# Синтетическая выгрузка ЦБ: разбор XML — одна из CPU-нагрузок, упирающихся в одно ядро
+CBR_XML = '<ValCurs Date="01.01.2024">{}</ValCurs>'.format(''.join(
+    f'<Valute><CharCode>C{i:02d}</CharCode><Nominal>1</Nominal><Value>{i},5</Value></Valute>' for i in range(40)))
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def fake_update(update_id, user_id):
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': 0,
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': 'Bench'},
+            'text': '/rates',
+        },
+    }
+
+
+def make_worker_main(api_url, parses):
+    def worker_main(index, queue):
+        bot = Bot('123456:BENCH', server=TelegramAPIServer.from_base(api_url))
+        dp = Dispatcher(bot)
+
+        async def handler(message):
+            for _ in range(parses):
+                rates_date, currencies = parse_cbr_xml(CBR_XML)
+            await message.answer(f'{rates_date}: {len(currencies)} валют')
+
+        async def noop(dispatcher):
+            pass
+
+        dp.register_message_handler(handler)
+        run_worker(queue, dp, noop, noop)
+
+    return worker_main
+
+
+async def drive(router, api, port, updates, users):
+    await api.start()
+    started = time.perf_counter()
+    for update_id in range(updates):
+        await router.route(fake_update(update_id, update_id % users + 1))
+    while len(api.calls) < updates:
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - started
+    await router.close()
+    await api.close()
+    return updates / elapsed
+
+
+def run(workers, updates, users, parses):
+    port = free_port()
+    router = ShardRouter(make_worker_main(f'http://127.0.0.1:{port}', parses), workers)
+    # Воркеры создаются до запуска цикла событий, как и в main.py
+    router.start()
+    return asyncio.run(drive(router, FakeTelegramAPI(port=port), port, updates, users))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Пропускная способность шардированного режима от числа воркеров")
+    parser.add_argument('--max-workers', type=int, default=4)
+    parser.add_argument('--updates', type=int, default=2000)
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--parses', type=int, default=20, help="разборов XML на один апдейт")
+    args = parser.parse_args()
+
+    for workers in range(1, args.max_workers + 1):
+        rate = run(workers, args.updates, args.users, args.parses)
+        print(f"{workers} воркер(ов): {rate:8.0f} апдейтов/с")
+
+
+if __name__ == '__main__':
+    main()
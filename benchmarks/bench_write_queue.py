@@ -0,0 +1,61 @@
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+from connection_pool import ConnectionPool
+from database_manager import DatabaseManager
+from finance_manager import INSERT_EXPENSE
+from write_queue import WriteQueue
+
+# Запуск из корня репозитория: python -m benchmarks.bench_write_queue --rows 5000 --concurrency 200
+
+
+async def insert_direct(pool, params):
+    async with pool.writer() as db:
+        await db.execute(INSERT_EXPENSE, params)
+        await db.commit()
+
+
+async def run(mode, rows, concurrency, synchronous):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        pool = ConnectionPool(os.path.join(tmp_dir, 'bench.db'), readers=1, synchronous=synchronous)
+        await pool.open()
+        await DatabaseManager(pool).init_db()
+        write_queue = WriteQueue(pool)
+        write_queue.start()
+
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def insert(i):
+            params = (i % 1000, 'Продукты', 100.0, 'RUB', '2024-01-01T00:00:00')
+            async with semaphore:
+                if mode == 'queue':
+                    await write_queue.submit((INSERT_EXPENSE, params))
+                else:
+                    await insert_direct(pool, params)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(insert(i) for i in range(rows)))
+        elapsed = time.perf_counter() - started
+
+        await write_queue.close()
+        await pool.close()
+        return rows / elapsed
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Сравнение вставок в секунду: по одной против группового COMMIT")
+    parser.add_argument('--rows', type=int, default=5000)
+    parser.add_argument('--concurrency', type=int, default=200)
+    parser.add_argument('--synchronous', default='FULL', choices=['OFF', 'NORMAL', 'FULL'])
+    args = parser.parse_args()
+
+    for mode in ('direct', 'queue'):
+        rate = await run(mode, args.rows, args.concurrency, args.synchronous)
+        print(f"{mode:>6}: {rate:10.0f} вставок/с")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,245 @@
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+import numpy as np
+from aiogram import Bot, Dispatcher, types
+from aiogram.bot.api import TelegramAPIServer
+
+from bot_controller import BotController
+from chart_cache import ChartCache
+from chart_renderer import ChartRenderer
+from connection_pool import ConnectionPool
+from currency_manager import CurrencyManager
+from database_manager import DatabaseManager
+from fake_telegram import FakeTelegramAPI
+from finance_manager import FinanceManager
+from goal_manager import GoalManager
+from notification_dispatcher import NotificationDispatcher
+from rate_store import RateStore
+from sqlite_storage import SQLiteStorage
+from user_manager import UserManager
+from write_queue import WriteQueue
+
+# Запуск из корня репозитория:
+# python -m benchmarks.load_test --users 2000 --scenarios 5 --output load_test.json
+
+DEFAULT_MIX = 'add_expense=40,convert=25,statistics=20,contribute=15'
+RATES = {
+    'USD': {'value': 90.0, 'nominal': 1},
+    'EUR': {'value': 98.0, 'nominal': 1},
+    'CNY': {'value': 125.0, 'nominal': 10},
+}
+
+
+def parse_mix(mix: str) -> dict:
+    weights = {}
+    for item in mix.split(','):
+        name, weight = item.split('=')
+        if name not in SCENARIOS:
+            raise ValueError(f"Неизвестный сценарий: {name}")
+        weights[name] = float(weight)
+    return weights
+
+
+def percentiles(samples) -> dict:
+    if not samples:
+        return {'count': 0}
+    values = np.asarray(samples) * 1000
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {'count': len(samples), 'p50_ms': round(float(p50), 3), 'p95_ms': round(float(p95), 3),
+            'p99_ms': round(float(p99), 3), 'max_ms': round(float(values.max()), 3)}
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class LoadTest:
+    def __init__(self, db_path, api_url, chart_workers=1):
+        self.pool = ConnectionPool(db_path, readers=4)
+        self.write_queue = WriteQueue(self.pool)
+        self.chart_renderer = ChartRenderer(max_workers=chart_workers)
+        self.chart_cache = ChartCache()
+
+        self.bot = Bot('123456:LOAD-TEST', server=TelegramAPIServer.from_base(api_url))
+        self.storage = SQLiteStorage(self.pool, self.write_queue)
+        self.dp = Dispatcher(self.bot, storage=self.storage)
+
+        rate_store = RateStore(self.pool)
+        self.user_manager = UserManager(self.pool)
+        self.finance_manager = FinanceManager(self.pool, self.user_manager, self.write_queue, self.chart_renderer,
+                                              self.chart_cache, rate_store)
+        self.currency_manager = CurrencyManager(rate_store=rate_store)
+        self.currency_manager.set_rates(RATES, '2024-01-01')
+        self.notifier = NotificationDispatcher(self.bot)
+        self.goal_manager = GoalManager(self.notifier, self.pool, self.user_manager)
+        BotController(self.bot, self.dp, self.finance_manager, self.currency_manager, DatabaseManager(self.pool),
+                      self.goal_manager, self.user_manager)
+
+        self.latencies = defaultdict(list)
+        self.errors = 0
+        self._update_ids = itertools.count(1)
+
+    async def start(self):
+        # Процессы отрисовки создаются до потоков aiosqlite
+        await self.chart_renderer.start()
+        await self.pool.open()
+        await DatabaseManager(self.pool).init_db()
+        self.write_queue.start()
+        self.storage.start()
+        self.notifier.start()
+
+    async def close(self):
+        await self.notifier.close()
+        await self.storage.close()
+        await self.write_queue.close()
+        await self.pool.close()
+        self.chart_renderer.close()
+        await (await self.bot.get_session()).close()
+
+    async def send(self, label, user_id, text):
+        update_id = next(self._update_ids)
+        update = types.Update(**{
+            'update_id': update_id,
+            'message': {
+                'message_id': update_id,
+                'date': int(time.time()),
+                'chat': {'id': user_id, 'type': 'private'},
+                'from': {'id': user_id, 'is_bot': False, 'first_name': 'Load'},
+                'text': text,
+            },
+        })
+        Dispatcher.set_current(self.dp)
+        Bot.set_current(self.bot)
+
+        started = time.perf_counter()
+        try:
+            await self.dp.process_update(update)
+        except Exception:
+            self.errors += 1
+        self.latencies[label].append(time.perf_counter() - started)
+
+    async def prepare_user(self, user_id):
+        await self.send('set_goal', user_id, '/set_goal Отпуск 100000 2999-12-31')
+        goals = await self.goal_manager.get_financial_goals(user_id)
+        return goals[0]['id']
+
+    async def run_user(self, user_id, scenarios, weights, think_time):
+        goal_id = await self.prepare_user(user_id)
+        names, probabilities = list(weights), list(weights.values())
+        for _ in range(scenarios):
+            name = random.choices(names, probabilities)[0]
+            await SCENARIOS[name](self, user_id, goal_id)
+            if think_time:
+                await asyncio.sleep(random.uniform(0, think_time))
+
+
+async def add_expense(load_test, user_id, goal_id):
+    await load_test.send('add_expense', user_id, '/add_expense')
+    await load_test.send('add_expense:category', user_id, random.choice(FinanceManager.categories_expense))
+    await load_test.send('add_expense:amount', user_id, str(random.randint(1, 5000)))
+    await load_test.send('add_expense:currency', user_id, random.choice(['RUB', 'USD', 'EUR']))
+
+
+async def convert(load_test, user_id, goal_id):
+    await load_test.send('convert', user_id, f'/convert {random.randint(1, 1000)} USD EUR')
+
+
+async def statistics(load_test, user_id, goal_id):
+    await load_test.send('statistics', user_id, '/statistics')
+
+
+async def contribute(load_test, user_id, goal_id):
+    await load_test.send('contribute', user_id, f'/contribute {goal_id} {random.randint(1, 500)}')
+
+
+SCENARIOS = {
+    'add_expense': add_expense,
+    'convert': convert,
+    'statistics': statistics,
+    'contribute': contribute,
+}
+
+
+async def run_load_test(users=1000, scenarios=5, mix=DEFAULT_MIX, think_time=0.0, concurrency=None,
+                        chart_workers=1, seed=0) -> dict:
+    random.seed(seed)
+    weights = parse_mix(mix)
+    api = FakeTelegramAPI()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        api_url = await api.start()
+        load_test = LoadTest(os.path.join(tmp_dir, 'load.db'), api_url, chart_workers)
+        await load_test.start()
+
+        semaphore = asyncio.Semaphore(concurrency or users)
+
+        async def user(user_id):
+            async with semaphore:
+                await load_test.run_user(user_id, scenarios, weights, think_time)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(user(user_id) for user_id in range(1, users + 1)))
+        elapsed = time.perf_counter() - started
+
+        db_stats = load_test.pool.lock_stats()
+        await load_test.close()
+        await api.close()
+
+    measured = {label: samples for label, samples in load_test.latencies.items() if label != 'set_goal'}
+    total_updates = sum(len(samples) for samples in load_test.latencies.values())
+    return {
+        'revision': git_revision(),
+        'python': sys.version.split()[0],
+        'config': {'users': users, 'scenarios': scenarios, 'mix': weights, 'think_time': think_time,
+                   'concurrency': concurrency or users, 'chart_workers': chart_workers, 'seed': seed},
+        'duration_s': round(elapsed, 3),
+        'updates': total_updates,
+        'updates_per_s': round(total_updates / elapsed, 1),
+        'errors': load_test.errors,
+        'telegram_calls': len(api.calls),
+        'latency': {
+            'all': percentiles(list(itertools.chain.from_iterable(measured.values()))),
+            **{label: percentiles(samples) for label, samples in sorted(load_test.latencies.items())},
+        },
+        'db_locks': db_stats,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Сквозной нагрузочный тест бота против локальной заглушки Bot API")
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--scenarios', type=int, default=5, help="сценариев на пользователя")
+    parser.add_argument('--mix', default=DEFAULT_MIX, help="веса сценариев, например add_expense=40,convert=60")
+    parser.add_argument('--think-time', type=float, default=0.0, help="максимальная пауза между сценариями, с")
+    parser.add_argument('--concurrency', type=int, default=None, help="одновременно активных пользователей")
+    parser.add_argument('--chart-workers', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="файл для JSON-отчёта; по умолчанию stdout")
+    args = parser.parse_args()
+
+    report = asyncio.run(run_load_test(args.users, args.scenarios, args.mix, args.think_time, args.concurrency,
+                                       args.chart_workers, args.seed))
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            file.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,29 @@
+import asyncio
+import io
+import tempfile
+import time
+from datetime import date
+
 from aiogram import types
 from aiogram.dispatcher import FSMContext
-from aiogram.types import BotCommand, ReplyKeyboardMarkup, KeyboardButton
+from aiogram.types import BotCommand, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.utils.markdown import quote_html
+
+from chart_renderer import ChartRendererBusy
+from history_export import EXPORT_WRITERS, upload_file
+from states import AddIncome, AddExpense, ImportTransactions
+from transaction_search import parse_search_query
 
-from states import AddIncome, AddExpense
+# Bot API отдаёт боту файлы не больше 20 МБ
+MAX_IMPORT_BYTES = 20 * 1024 * 1024
+IMPORT_PROGRESS_INTERVAL = 2.0
+# Bot API принимает от бота документы не больше 50 МБ
+MAX_EXPORT_BYTES = 50 * 1024 * 1024
 
 
 class BotController:
-    def __init__(self, bot, dp, finance_manager, currency_manager, db_manager, goal_manager, user_manager):
+    def __init__(self, bot, dp, finance_manager, currency_manager, db_manager, goal_manager, user_manager,
+                 export_queue=None):
         self.bot = bot
         self.dp = dp
         self.finance_manager = finance_manager
@@ -14,6 +31,7 @@ class BotController:
         self.db_manager = db_manager
         self.goal_manager = goal_manager
         self.user_manager = user_manager
+        self.export_queue = export_queue
 
         self.register_handlers()
 
@@ -24,7 +42,13 @@ class BotController:
             BotCommand(command="/convert", description="Конвертация сумм из одной валюты в другую"),
             BotCommand(command="/add_income", description="Добавить доход"),
             BotCommand(command="/add_expense", description="Добавить расход"),
-            BotCommand(command="/statistics", description="Показать статистику"),
+            BotCommand(command="/import", description="Загрузить операции из CSV-выписки банка"),
+            BotCommand(command="/export", description="Выгрузить все операции [csv|jsonl]"),
+            BotCommand(command="/statistics", description="Показать статистику [с YYYY-MM-DD] [по YYYY-MM-DD]"),
+            BotCommand(command="/search", description="Найти операции: слова [>сумма] [<сумма] [ГГГГ-ММ..ГГГГ-ММ]"),
+            BotCommand(command="/summary", description="Итоги в одной валюте по курсам на даты операций"),
+            BotCommand(command="/set_budget", description="Установить месячный бюджет категории расходов"),
+            BotCommand(command="/budgets", description="Показать бюджеты и расходы за месяц"),
             BotCommand(command="/set_goal", description="Установить финансовую цель"),
             BotCommand(command="/set_reminder", description="Установить напоминание"),
             BotCommand(command="/goals", description="Показать мои финансовые цели"),
@@ -48,7 +72,19 @@ class BotController:
         self.dp.message_handler(lambda message: message.text.isdigit(), state=AddExpense.amount)(
             self.process_expense_amount)
         self.dp.message_handler(state=AddExpense.currency)(self.process_expense_currency)
+        self.dp.message_handler(commands=['import'])(self.import_start)
+        self.dp.message_handler(content_types=types.ContentType.DOCUMENT, state=ImportTransactions.file)(
+            self.import_document)
+        self.dp.message_handler(commands=['export'])(self.export_history)
         self.dp.message_handler(commands=['statistics'])(self.show_statistics)
+        self.dp.callback_query_handler(lambda callback: callback.data.startswith('stats:'))(
+            self.navigate_statistics)
+        self.dp.message_handler(commands=['search'])(self.search_transactions)
+        self.dp.callback_query_handler(lambda callback: callback.data.startswith('search:'))(
+            self.navigate_search)
+        self.dp.message_handler(commands=['summary'])(self.show_base_currency_summary)
+        self.dp.message_handler(commands=['set_budget'])(self.set_budget)
+        self.dp.message_handler(commands=['budgets'])(self.show_budgets)
         self.dp.message_handler(commands=['set_goal'])(self.set_goal_start)
         self.dp.message_handler(commands=['set_reminder'])(self.set_reminder)
         self.dp.message_handler(commands=['goals'])(self.show_goals)
@@ -122,7 +158,7 @@ class BotController:
         async with state.proxy() as data:
             category = data['category']
             amount = data['amount']
-            currency = message.text
+            currency = message.text.strip().upper()
             await self.finance_manager.add_income(message.from_user.id, category, amount, currency)
         await state.finish()
         await message.answer("Доход успешно добавлен!", parse_mode='Markdown')
@@ -156,19 +192,235 @@ class BotController:
         async with state.proxy() as data:
             category = data['category']
             amount = data['amount']
-            currency = message.text
+            currency = message.text.strip().upper()
             await self.finance_manager.add_expense(message.from_user.id, category, amount, currency)
         await state.finish()
         await message.answer("Расход успешно добавлен!", parse_mode='Markdown')
 
+    async def import_start(self, message: types.Message):
+        await message.answer(
+            "Отправьте CSV-выписку банка документом. Обязательные столбцы: «Дата» и «Сумма»; необязательные: "
+            "«Валюта», «Категория», «Тип». Отрицательные суммы без столбца «Тип» считаются расходами.",
+            parse_mode='Markdown')
+        await ImportTransactions.file.set()
+
+    async def import_document(self, message: types.Message, state: FSMContext):
+        await state.finish()
+        if message.document.file_size and message.document.file_size > MAX_IMPORT_BYTES:
+            await message.answer("Файл слишком большой: Telegram позволяет боту скачивать файлы до 20 МБ.",
+                                 parse_mode='Markdown')
+            return
+
+        status = await message.answer("Импорт начат…", parse_mode='Markdown')
+        last_update = time.monotonic()
+
+        async def progress(result):
+            nonlocal last_update
+            # Редактирование сообщения ограничено по частоте, чтобы не упереться в лимиты Telegram
+            if time.monotonic() - last_update >= IMPORT_PROGRESS_INTERVAL:
+                last_update = time.monotonic()
+                await status.edit_text(f"Импортировано операций: {result.imported}…", parse_mode='Markdown')
+
+        # Файл скачивается на диск и читается пакетами, поэтому память не зависит от размера выписки
+        with tempfile.TemporaryFile() as file:
+            await message.document.download(destination_file=file)
+            file.seek(0)
+            try:
+                result = await self.finance_manager.import_transactions(message.from_user.id, file, progress)
+            except ValueError as error:
+                await message.answer(f"Не удалось прочитать файл: {quote_html(str(error))}", parse_mode='HTML')
+                return
+
+        report = f"Импорт завершён. Добавлено операций: {result.imported}, пропущено строк: {result.skipped}."
+        if result.errors:
+            report += "\n" + "\n".join(quote_html(error) for error in result.errors)
+        await message.answer(report, parse_mode='HTML')
+
+    async def export_history(self, message: types.Message):
+        args = message.text.split()[1:]
+        export_format = args[0].lower() if args else 'csv'
+        if len(args) > 1 or export_format not in EXPORT_WRITERS:
+            await message.answer("Пожалуйста, используйте команду в формате `/export [csv|jsonl]`.",
+                                 parse_mode='Markdown')
+            return
+        if self.export_queue is None:
+            await message.answer("Выгрузка сейчас недоступна.", parse_mode='Markdown')
+            return
+
+        async def deliver(file, filename):
+            file.seek(0, io.SEEK_END)
+            if file.tell() > MAX_EXPORT_BYTES:
+                await message.answer("Выгрузка больше 50 МБ и не может быть отправлена. Попробуйте формат jsonl.",
+                                     parse_mode='Markdown')
+                return
+            file.seek(0)
+            await message.answer_document(types.InputFile(upload_file(file), filename=filename),
+                                          caption="Выгрузка операций")
+
+        async def failed():
+            await message.answer("Не удалось подготовить выгрузку, попробуйте позже.", parse_mode='Markdown')
+
+        try:
+            position = self.export_queue.submit(message.from_user.id, export_format, deliver, failed)
+        except ValueError:
+            await message.answer("Выгрузка уже готовится, дождитесь файла.", parse_mode='Markdown')
+            return
+        except RuntimeError:
+            await message.answer("Сервис выгрузки перегружен, попробуйте позже.", parse_mode='Markdown')
+            return
+
+        text = "Выгрузка поставлена в очередь, файл придёт отдельным сообщением."
+        if position:
+            text += f" Перед вами в очереди: {position}."
+        await message.answer(text, parse_mode='Markdown')
+
     async def show_statistics(self, message: types.Message):
-        stats = await self.finance_manager.get_statistics(message.from_user.id)
+        try:
+            date_from, date_to = self._parse_statistics_period(message.text)
+        except ValueError:
+            await message.answer("Пожалуйста, используйте команду в формате `/statistics [YYYY-MM-DD] [YYYY-MM-DD]`.",
+                                 parse_mode='Markdown')
+            return
 
-        image_data = await self.finance_manager.create_statistics_chart(message.from_user.id)
+        summary = await self.finance_manager.get_summary(message.from_user.id)
+        page = await self.finance_manager.get_statistics_page(message.from_user.id, date_from=date_from,
+                                                              date_to=date_to)
 
-        await message.answer(stats, parse_mode='Markdown')
+        await message.answer(summary, parse_mode='Markdown')
+        await message.answer(page.text, reply_markup=self._statistics_keyboard(page, date_from, date_to),
+                             parse_mode='Markdown')
+
+        try:
+            chart = await self.finance_manager.create_statistics_chart(message.from_user.id)
+        except (ChartRendererBusy, asyncio.TimeoutError):
+            await message.answer("Диаграмма сейчас недоступна, попробуйте позже.", parse_mode='Markdown')
+            return
+
+        # Повторная отправка по file_id не загружает PNG в Telegram заново
+        photo = chart.file_id or io.BytesIO(chart.png)
+        sent = await message.answer_photo(photo, caption="Диаграмма доходов и расходов", parse_mode='Markdown')
+        if not chart.file_id and sent and sent.photo:
+            await self.finance_manager.remember_chart_file_id(chart.key, sent.photo[-1].file_id)
+
+    async def navigate_statistics(self, callback: types.CallbackQuery):
+        try:
+            _, direction, cursor, date_from, date_to = callback.data.split(':')
+            date_from = date.fromisoformat(date_from) if date_from else None
+            date_to = date.fromisoformat(date_to) if date_to else None
+            page = await self.finance_manager.get_statistics_page(callback.from_user.id, cursor=cursor,
+                                                                  backward=direction == 'prev',
+                                                                  date_from=date_from, date_to=date_to)
+        except ValueError:
+            await callback.answer("Не удалось открыть страницу статистики.")
+            return
+
+        await callback.message.edit_text(page.text, reply_markup=self._statistics_keyboard(page, date_from, date_to),
+                                         parse_mode='Markdown')
+        await callback.answer()
+
+    @staticmethod
+    def _parse_statistics_period(text):
+        args = (text or '').split()[1:]
+        if len(args) > 2:
+            raise ValueError("Слишком много аргументов.")
+        dates = [date.fromisoformat(arg) for arg in args]
+        return (dates + [None, None])[:2]
+
+    def _statistics_keyboard(self, page, date_from, date_to):
+        period = f"{date_from.isoformat() if date_from else ''}:{date_to.isoformat() if date_to else ''}"
+        return self._page_keyboard('stats', page, f":{period}")
+
+    async def search_transactions(self, message: types.Message, state: FSMContext):
+        text = message.get_args()
+        try:
+            query = parse_search_query(text)
+        except ValueError:
+            await message.answer("Пожалуйста, используйте команду в формате "
+                                 "`/search <слова> [>сумма] [<сумма] [ГГГГ-ММ-ДД..ГГГГ-ММ-ДД] [доходы|расходы]`.\n"
+                                 "Например: `/search такси >1000 2024-03..2024-05`. "
+                                 "Звёздочка в конце слова ищет по началу: `аптек*`.", parse_mode='Markdown')
+            return
+
+        # Запрос не помещается в 64 байта callback_data, поэтому для листания он хранится в данных диалога
+        await state.update_data(search_query=text)
+        page = await self.finance_manager.search_transactions(message.from_user.id, query)
+        await message.answer(page.text, reply_markup=self._page_keyboard('search', page), parse_mode='HTML')
+
+    async def navigate_search(self, callback: types.CallbackQuery, state: FSMContext):
+        text = (await state.get_data()).get('search_query')
+        try:
+            _, direction, cursor = callback.data.split(':')
+            if text is None:
+                raise ValueError("Нет сохранённого запроса.")
+            page = await self.finance_manager.search_transactions(callback.from_user.id, parse_search_query(text),
+                                                                  cursor=cursor, backward=direction == 'prev')
+        except ValueError:
+            await callback.answer("Не удалось открыть страницу, повторите поиск.")
+            return
+
+        await callback.message.edit_text(page.text, reply_markup=self._page_keyboard('search', page),
+                                         parse_mode='HTML')
+        await callback.answer()
+
+    @staticmethod
+    def _page_keyboard(prefix, page, suffix=''):
+        buttons = []
+        if page.prev_cursor:
+            buttons.append(InlineKeyboardButton("« Новее", callback_data=f"{prefix}:prev:{page.prev_cursor}{suffix}"))
+        if page.next_cursor:
+            buttons.append(InlineKeyboardButton("Старее »", callback_data=f"{prefix}:next:{page.next_cursor}{suffix}"))
+        if not buttons:
+            return None
+        return InlineKeyboardMarkup().row(*buttons)
+
+    async def show_base_currency_summary(self, message: types.Message):
+        args = message.text.split()
+        if len(args) > 2:
+            await message.answer("Пожалуйста, используйте команду в формате /summary `<код_валюты>`.",
+                                 parse_mode='Markdown')
+            return
+
+        base_currency = args[1].upper() if len(args) == 2 else 'RUB'
+        try:
+            report = await self.finance_manager.get_base_currency_report(message.from_user.id, base_currency)
+        except ValueError:
+            await message.answer("Не удалось пересчитать операции в указанную валюту. Проверьте код валюты.",
+                                 parse_mode='Markdown')
+            return
+
+        await message.answer(report, parse_mode='Markdown')
+
+    async def set_budget(self, message: types.Message):
+        args = message.text.split()[1:]
+        currency = args.pop().upper() if len(args) >= 3 and args[-1].isalpha() and len(args[-1]) == 3 else 'RUB'
+        if len(args) < 2:
+            await message.answer("Пожалуйста, используйте команду в формате `/set_budget <категория> <сумма> [валюта]`.",
+                                 parse_mode='Markdown')
+            return
+
+        try:
+            amount = float(args[-1].replace(',', '.'))
+            await self.finance_manager.set_budget(message.from_user.id, ' '.join(args[:-1]), amount, currency)
+        except ValueError:
+            await message.answer("Ошибка в данных. Категории расходов: "
+                                 f"{', '.join(self.finance_manager.categories_expense)}; сумма — неотрицательное число.",
+                                 parse_mode='Markdown')
+            return
+
+        if amount == 0:
+            await message.reply("Бюджет удалён.", parse_mode='Markdown')
+        else:
+            await message.reply(f"Бюджет установлен: {amount:.2f} {currency} в месяц.", parse_mode='Markdown')
+
+    async def show_budgets(self, message: types.Message):
+        budgets = await self.finance_manager.get_budgets(message.from_user.id)
+        if not budgets:
+            await message.reply("Бюджеты не заданы. Используйте /set\\_budget.", parse_mode='Markdown')
+            return
 
-        await message.answer_photo(image_data, caption="Диаграмма доходов и расходов", parse_mode='Markdown')
+        lines = [f"{category}: {spent:.2f} из {amount:.2f} {currency} ({spent / amount:.0%})"
+                 for category, amount, currency, spent in budgets]
+        await message.reply("Бюджеты на текущий месяц:\n" + "\n".join(lines), parse_mode='Markdown')
 
     async def set_goal_start(self, message: types.Message):
         if len(message.text.split()) != 4:
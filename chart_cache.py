@@ -0,0 +1,125 @@
+import asyncio
+import hashlib
+import os
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional
+
+
+@dataclass
+class CachedChart:
+    key: str
+    png: Optional[bytes] = None
+    file_id: Optional[str] = None
+
+
+class ChartCache:
+    def __init__(self, max_bytes: int = 32 * 1024 * 1024, disk_dir: str = None,
+                 max_disk_bytes: int = 256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = OrderedDict()
+        self._size = 0
+        self._puts_since_prune = 0
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    @staticmethod
+    def key(user_id: int, data_version: int, kind: str = 'statistics') -> str:
+        # Версия данных меняется при каждой новой записи пользователя, поэтому старые ключи просто вытесняются
+        return hashlib.sha256(f'{kind}:{user_id}:{data_version}'.encode()).hexdigest()
+
+    async def get(self, key: str) -> Optional[CachedChart]:
+        chart = self._entries.get(key)
+        if chart is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return chart
+
+        if self.disk_dir:
+            chart = await asyncio.get_running_loop().run_in_executor(None, self._read_disk, key)
+            if chart is not None:
+                self._remember(chart)
+                self.hits += 1
+                return chart
+
+        self.misses += 1
+        return None
+
+    async def put(self, key: str, png: bytes) -> CachedChart:
+        chart = CachedChart(key, png)
+        self._remember(chart)
+        if self.disk_dir:
+            await asyncio.get_running_loop().run_in_executor(None, self._write_disk, key, '.png', png)
+        return chart
+
+    async def set_file_id(self, key: str, file_id: str):
+        chart = self._entries.get(key)
+        if chart is not None:
+            chart.file_id = file_id
+        if self.disk_dir:
+            await asyncio.get_running_loop().run_in_executor(None, self._write_disk, key, '.file_id',
+                                                             file_id.encode())
+
+    def stats(self) -> dict:
+        return {'entries': len(self._entries), 'bytes': self._size, 'hits': self.hits, 'misses': self.misses}
+
+    def _remember(self, chart: CachedChart):
+        previous = self._entries.pop(chart.key, None)
+        if previous is not None:
+            self._size -= len(previous.png or b'')
+        self._entries[chart.key] = chart
+        self._size += len(chart.png or b'')
+        while self._size > self.max_bytes and len(self._entries) > 1:
+            _, evicted = self._entries.popitem(last=False)
+            self._size -= len(evicted.png or b'')
+
+    def _path(self, key: str, suffix: str) -> str:
+        return os.path.join(self.disk_dir, key + suffix)
+
+    def _read_disk(self, key: str) -> Optional[CachedChart]:
+        try:
+            with open(self._path(key, '.png'), 'rb') as file:
+                png = file.read()
+        except FileNotFoundError:
+            return None
+        try:
+            with open(self._path(key, '.file_id'), 'rb') as file:
+                file_id = file.read().decode()
+        except FileNotFoundError:
+            file_id = None
+        return CachedChart(key, png, file_id)
+
+    def _write_disk(self, key: str, suffix: str, data: bytes):
+        # Запись через временный файл, чтобы читатель не увидел недописанный PNG
+        path = self._path(key, suffix)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as file:
+            file.write(data)
+        os.replace(tmp_path, path)
+
+        self._puts_since_prune += 1
+        if self._puts_since_prune >= 50:
+            self._puts_since_prune = 0
+            self._prune_disk()
+
+    def _prune_disk(self):
+        files = []
+        for entry in os.scandir(self.disk_dir):
+            if entry.is_file() and not entry.name.endswith('.tmp'):
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
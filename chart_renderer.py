@@ -0,0 +1,86 @@
+import asyncio
+import io
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from metrics import CHART_RENDER_REJECTED, CHART_RENDER_SECONDS
+
+
+class ChartRendererBusy(RuntimeError):
+    pass
+
+
+def render_statistics_chart(income_data: dict, expenses_data: dict) -> bytes:
+    # Выполняется в дочернем процессе: объектный API Figure + Agg без глобального состояния pyplot
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    # Создание двух графиков: один для доходов, другой для расходов
+    fig = Figure(figsize=(14, 7))
+    FigureCanvasAgg(fig)
+    ax1, ax2 = fig.subplots(1, 2)
+
+    # График доходов
+    ax1.pie(income_data.values(), labels=income_data.keys(), autopct='%1.1f%%', startangle=140)
+    ax1.set_title('Доходы по категориям')
+
+    # График расходов
+    ax2.pie(expenses_data.values(), labels=expenses_data.keys(), autopct='%1.1f%%', startangle=140)
+    ax2.set_title('Расходы по категориям')
+
+    buf = io.BytesIO()
+    fig.savefig(buf, format='png')
+    return buf.getvalue()
+
+
+def _warm_up():
+    import matplotlib.figure  # noqa: F401
+
+
+class ChartRenderer:
+    def __init__(self, max_workers: int = 2, timeout: float = 10.0, max_pending: int = None,
+                 queue_timeout: float = 1.0):
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.max_pending = max_pending or max_workers * 2
+        self.queue_timeout = queue_timeout
+
+        self._executor = None
+        self._slots = asyncio.Semaphore(self.max_pending)
+
+    async def start(self):
+        if self._executor is not None:
+            return
+
+        # Рабочие процессы форкаются сразу, пока в родителе ещё нет потоков aiosqlite
+        self._executor = ProcessPoolExecutor(max_workers=self.max_workers,
+                                             mp_context=multiprocessing.get_context('fork'))
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*(loop.run_in_executor(self._executor, _warm_up) for _ in range(self.max_workers)))
+
+    async def render(self, income_data: dict, expenses_data: dict) -> bytes:
+        if self._executor is None:
+            raise RuntimeError("Сервис отрисовки диаграмм не запущен.")
+
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            CHART_RENDER_REJECTED.inc()
+            raise ChartRendererBusy("Все процессы отрисовки заняты.")
+
+        loop = asyncio.get_running_loop()
+        try:
+            future = self._executor.submit(render_statistics_chart, dict(income_data), dict(expenses_data))
+        except BaseException:
+            self._slots.release()
+            raise
+        # Слот освобождается, только когда процесс действительно закончил работу, даже после таймаута
+        future.add_done_callback(lambda _: loop.call_soon_threadsafe(self._slots.release))
+
+        with CHART_RENDER_SECONDS.time():
+            return await asyncio.wait_for(asyncio.wrap_future(future), self.timeout)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
@@ -0,0 +1,170 @@
+import asyncio
+import os
+import time
+from contextlib import asynccontextmanager
+
+import aiosqlite
+
+from archive import ARCHIVE_FILE_RE, ARCHIVED_TABLES, archive_alias, archive_file_name, history_source
+from metrics import InstrumentedConnection
+
+
+class ConnectionPool:
+    def __init__(self, db_path: str, readers: int = 4, synchronous: str = 'FULL',
+                 cache_size: int = -16000, mmap_size: int = 128 * 1024 * 1024, busy_timeout: int = 5000,
+                 instrument: bool = False, archive_dir: str = None):
+        self.db_path = db_path
+        self.readers_count = max(1, readers)
+        # FULL: в режиме WAL каждый COMMIT сразу синхронизируется с диском; очередь записи делит этот fsync
+        # на весь пакет, поэтому подтверждённая запись переживает отключение питания
+        self.synchronous = synchronous
+        self.cache_size = cache_size
+        self.mmap_size = mmap_size
+        self.busy_timeout = busy_timeout
+        self.instrument = instrument
+        self.archive_dir = archive_dir
+
+        self._writer = None
+        self._write_lock = asyncio.Lock()
+        self._readers = asyncio.Queue()
+        self._all_readers = []
+        # Сколько раз соединение пришлось ждать и сколько секунд ушло на ожидание
+        self._waits = {'writer': [0, 0, 0.0], 'reader': [0, 0, 0.0]}
+        self._archive_years = ()
+        self._archive_dir_mtime = None
+        # Годы архивов, уже присоединённых к каждому соединению
+        self._attached = {}
+
+    def archive_years(self) -> tuple:
+        if self.archive_dir is None:
+            return ()
+        try:
+            mtime = os.stat(self.archive_dir).st_mtime_ns
+        except FileNotFoundError:
+            return ()
+        # Каталог перечитывается, только когда в нём появился или пропал файл
+        if mtime != self._archive_dir_mtime:
+            matches = (ARCHIVE_FILE_RE.fullmatch(name) for name in os.listdir(self.archive_dir))
+            self._archive_years = tuple(sorted(int(match.group(1)) for match in matches if match))
+            self._archive_dir_mtime = mtime
+        return self._archive_years
+
+    async def attach_archives(self, db) -> tuple:
+        # ATTACH нельзя выполнить внутри транзакции, поэтому вызывается сразу после получения соединения
+        years = self.archive_years()
+        attached = self._attached.setdefault(id(db), set())
+        for year in years:
+            if year not in attached:
+                await db.execute(f'ATTACH DATABASE ? AS {archive_alias(year)}',
+                                 (os.path.join(self.archive_dir, archive_file_name(year)),))
+                attached.add(year)
+        return years
+
+    async def history_tables(self, db, since: str = '') -> tuple:
+        # Источники для income и expenses: запрос, не заходящий в архивные годы, читает только основную БД
+        years = await self.attach_archives(db)
+        if not years or since >= f'{years[-1] + 1:04d}-01-01':
+            return ARCHIVED_TABLES
+        return tuple(history_source(table, years) for table in ARCHIVED_TABLES)
+
+    def lock_stats(self) -> dict:
+        return {
+            role: {'acquired': acquired, 'contended': contended, 'wait_seconds': wait_seconds}
+            for role, (acquired, contended, wait_seconds) in self._waits.items()
+        }
+
+    def _record_wait(self, role, contended, started):
+        stats = self._waits[role]
+        stats[0] += 1
+        if contended:
+            stats[1] += 1
+            stats[2] += time.perf_counter() - started
+
+    async def open(self):
+        if self._writer is not None:
+            return
+
+        try:
+            self._writer = await self._connect()
+            # Действует только для новой БД; существующую переводит manage.py enable-incremental-vacuum
+            await self._pragma(self._writer, 'auto_vacuum=INCREMENTAL')
+            # WAL сохраняется в файле БД, поэтому достаточно включить его один раз на соединении-писателе
+            await self._pragma(self._writer, 'journal_mode=WAL')
+
+            for _ in range(self.readers_count):
+                reader = await self._connect()
+                self._all_readers.append(reader)
+                await self._pragma(reader, 'query_only=ON')
+                self._readers.put_nowait(reader)
+        except BaseException:
+            await self._close_all()
+            raise
+
+    async def _connect(self):
+        db = await aiosqlite.connect(self.db_path)
+        try:
+            await self._pragma(db, f'busy_timeout={int(self.busy_timeout)}')
+            await self._pragma(db, f'synchronous={self.synchronous}')
+            await self._pragma(db, f'cache_size={int(self.cache_size)}')
+            await self._pragma(db, f'mmap_size={int(self.mmap_size)}')
+        except BaseException:
+            await db.close()
+            raise
+        # Обёртка создаётся один раз на соединение и замеряет каждый запрос по метке выражения
+        return InstrumentedConnection(db) if self.instrument else db
+
+    @staticmethod
+    async def _pragma(db, pragma: str):
+        # Незакрытый курсор PRAGMA удерживает блокировку файла БД
+        async with db.execute(f'PRAGMA {pragma}') as cursor:
+            await cursor.fetchall()
+
+    @asynccontextmanager
+    async def writer(self):
+        if self._writer is None:
+            raise RuntimeError("Пул соединений не открыт.")
+
+        contended, started = self._write_lock.locked(), time.perf_counter()
+        async with self._write_lock:
+            self._record_wait('writer', contended, started)
+            try:
+                yield self._writer
+            finally:
+                # Незавершённая транзакция не должна достаться следующему владельцу писателя
+                if self._writer.in_transaction:
+                    await self._writer.rollback()
+
+    @asynccontextmanager
+    async def reader(self):
+        if not self._all_readers:
+            raise RuntimeError("Пул соединений не открыт.")
+
+        contended, started = self._readers.empty(), time.perf_counter()
+        db = await self._readers.get()
+        self._record_wait('reader', contended, started)
+        try:
+            yield db
+        finally:
+            self._readers.put_nowait(db)
+
+    async def close(self):
+        if self._writer is None:
+            return
+
+        async with self._write_lock:
+            await self._writer.close()
+            self._writer = None
+
+        # Дожидаемся возврата всех читателей в очередь, чтобы не закрыть занятое соединение
+        for _ in range(len(self._all_readers)):
+            await self._readers.get()
+        await self._close_all()
+
+    async def _close_all(self):
+        for db in [self._writer, *self._all_readers]:
+            if db is not None:
+                await db.close()
+        self._writer = None
+        self._all_readers = []
+        self._readers = asyncio.Queue()
+        self._attached = {}
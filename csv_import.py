@@ -0,0 +1,158 @@
+import csv
+import datetime
+import io
+import itertools
+from dataclasses import dataclass, field
+
+IMPORT_CHUNK_SIZE = 1000
+MAX_REPORTED_ERRORS = 5
+DEFAULT_CURRENCY = 'RUB'
+DEFAULT_CATEGORY = 'Другое'
+
+# Заголовки столбцов в выгрузках популярных банков
+COLUMN_ALIASES = {
+    'date': ('date', 'дата', 'дата операции', 'дата платежа'),
+    'amount': ('amount', 'сумма', 'сумма операции', 'сумма платежа'),
+    'currency': ('currency', 'валюта', 'валюта операции', 'валюта платежа'),
+    'category': ('category', 'категория'),
+    'kind': ('type', 'kind', 'тип', 'тип операции'),
+    'note': ('note', 'description', 'описание', 'описание операции', 'комментарий', 'назначение платежа'),
+}
+DATE_FORMATS = ('%Y-%m-%d', '%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M:%S.%f', '%d.%m.%Y',
+                '%d.%m.%Y %H:%M:%S', '%d.%m.%Y %H:%M')
+KIND_ALIASES = {
+    'income': 'income', 'доход': 'income', 'пополнение': 'income', 'зачисление': 'income',
+    'expense': 'expense', 'расход': 'expense', 'списание': 'expense', 'покупка': 'expense',
+}
+# Банковские категории, сведённые к категориям бота
+CATEGORY_ALIASES = {
+    'income': {
+        'зарплата': 'Зарплата', 'заработная плата': 'Зарплата',
+        'бонусы': 'Бонусы', 'кэшбэк': 'Бонусы', 'проценты': 'Бонусы',
+        'подарки': 'Подарки', 'переводы': 'Подарки',
+        'инвестиции': 'Инвестиции', 'дивиденды': 'Инвестиции', 'брокерский счёт': 'Инвестиции',
+    },
+    'expense': {
+        'продукты': 'Продукты', 'супермаркеты': 'Продукты', 'фастфуд': 'Продукты', 'рестораны': 'Продукты',
+        'транспорт': 'Транспорт', 'такси': 'Транспорт', 'топливо': 'Транспорт', 'азс': 'Транспорт',
+        'развлечения': 'Развлечения', 'кино': 'Развлечения', 'театры': 'Развлечения',
+        'оплата жилья': 'Оплата жилья', 'жкх': 'Оплата жилья', 'аренда': 'Оплата жилья',
+    },
+}
+
+
+@dataclass
+class ImportResult:
+    imported: int = 0
+    skipped: int = 0
+    errors: list = field(default_factory=list)
+
+    def add_error(self, line, message):
+        self.skipped += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append(f"строка {line}: {message}")
+
+
+def open_csv_text(binary_file) -> io.TextIOWrapper:
+    # Выгрузки бывают в UTF-8 (часто с BOM) и в cp1251; кодировка определяется по началу файла
+    head = binary_file.read(64 * 1024)
+    binary_file.seek(0)
+    try:
+        # Многобайтный символ может оказаться разрезан границей прочитанного фрагмента
+        head.decode('utf-8')
+        encoding = 'utf-8-sig'
+    except UnicodeDecodeError as error:
+        encoding = 'utf-8-sig' if error.start > len(head) - 4 else 'cp1251'
+    return io.TextIOWrapper(binary_file, encoding=encoding, newline='')
+
+
+def open_csv_reader(text_file):
+    sample = text_file.read(16 * 1024)
+    text_file.seek(0)
+    try:
+        dialect = csv.Sniffer().sniff(sample, delimiters=';,\t')
+    except csv.Error:
+        dialect = csv.excel
+    reader = csv.reader(text_file, dialect)
+
+    header = next(reader, None)
+    if header is None:
+        raise ValueError("Файл пуст.")
+    columns = {}
+    normalized = [name.strip().lower() for name in header]
+    for column, aliases in COLUMN_ALIASES.items():
+        for index, name in enumerate(normalized):
+            if name in aliases:
+                columns[column] = index
+                break
+    missing = [column for column in ('date', 'amount') if column not in columns]
+    if missing:
+        raise ValueError(f"В заголовке CSV нет обязательных столбцов: {', '.join(missing)}.")
+    return reader, columns
+
+
+def parse_amount(text: str) -> float:
+    cleaned = text.replace('\xa0', '').replace(' ', '').replace(',', '.')
+    amount = float(cleaned)
+    if amount != amount or amount in (float('inf'), float('-inf')):
+        raise ValueError(f"некорректная сумма {text!r}")
+    return amount
+
+
+def parse_date(text: str) -> str:
+    text = text.strip()
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(text, date_format).isoformat()
+        except ValueError:
+            pass
+    raise ValueError(f"неизвестный формат даты {text!r}")
+
+
+def map_category(kind: str, category: str) -> str:
+    category = category.strip()
+    known = CATEGORY_ALIASES[kind]
+    return known.get(category.lower(), category if category in known.values() else DEFAULT_CATEGORY)
+
+
+def parse_row(row, columns):
+    def value(column, default=''):
+        index = columns.get(column)
+        return row[index].strip() if index is not None and index < len(row) else default
+
+    amount = parse_amount(value('amount'))
+    kind_text = value('kind').lower()
+    if kind_text:
+        kind = KIND_ALIASES.get(kind_text)
+        if kind is None:
+            raise ValueError(f"неизвестный тип операции {kind_text!r}")
+    else:
+        # Без столбца типа направление определяется знаком суммы, как в большинстве банковских выгрузок
+        kind = 'expense' if amount < 0 else 'income'
+    if amount == 0:
+        raise ValueError("нулевая сумма")
+
+    currency = (value('currency') or DEFAULT_CURRENCY).upper()
+    if len(currency) != 3 or not currency.isalpha():
+        raise ValueError(f"некорректный код валюты {currency!r}")
+    bank_category = value('category')
+    category = map_category(kind, bank_category)
+    # Исходная категория банка остаётся в заметке, чтобы по ней работал поиск
+    note = ' '.join(filter(None, (bank_category if bank_category != category else '', value('note')))) or None
+    return kind, category, abs(amount), currency, parse_date(value('date')), note
+
+
+def read_chunk(reader, columns, result: ImportResult, chunk_size: int = IMPORT_CHUNK_SIZE):
+    # Вызывается в потоке: разбор CSV не блокирует цикл событий, в памяти не больше одного пакета.
+    # Возвращает записи пакета и признак конца файла
+    records = []
+    rows = 0
+    for row in itertools.islice(reader, chunk_size):
+        rows += 1
+        if not any(cell.strip() for cell in row):
+            continue
+        try:
+            records.append(parse_row(row, columns))
+        except (ValueError, IndexError) as error:
+            result.add_error(reader.line_num, error)
+    return records, rows < chunk_size
@@ -1,41 +1,184 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from datetime import datetime, timedelta
 from xml.etree import ElementTree
 
-import requests
+import aiohttp
+import numpy as np
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+
+from metrics import CBR_FETCH_SECONDS
+
+logger = logging.getLogger(__name__)
+
+CBR_URL = "https://www.cbr.ru/scripts/XML_daily.asp"
+
+
+def parse_cbr_xml(content):
+    tree = ElementTree.fromstring(content)
+    currencies = {}
+
+    for currency in tree.findall('Valute'):
+        char_code = currency.find('CharCode').text
+        value = currency.find('Value').text.replace(',', '.')
+        nominal = currency.find('Nominal').text
+
+        currencies[char_code] = {
+            'value': float(value),
+            'nominal': int(nominal)
+        }
+
+    rates_date = tree.get('Date')
+    if rates_date:
+        rates_date = datetime.strptime(rates_date, '%d.%m.%Y').date().isoformat()
+    return rates_date, currencies
+
+
+class RateTable:
+    def __init__(self, currencies):
+        self.currencies = currencies
+        self.codes = sorted(currencies)
+        self.index = {code: i for i, code in enumerate(self.codes)}
+        # rub_rates[i] — сколько рублей стоит единица валюты i; cross[i, j] — сколько единиц j за единицу i
+        self.rub_rates = np.array([currencies[code]['value'] / currencies[code]['nominal'] for code in self.codes],
+                                  dtype=np.float64)
+        self.cross = self.rub_rates[:, np.newaxis] / self.rub_rates[np.newaxis, :]
+
+    def position(self, currency_code):
+        try:
+            return self.index[currency_code]
+        except KeyError:
+            raise ValueError(f"Валюта {currency_code} не найдена")
 
 
 class CurrencyManager:
-    def __init__(self):
-        self.cbr_url = "https://www.cbr.ru/scripts/XML_daily.asp"
-        self.currencies = {}
-        self._fetch_rates()
+    def __init__(self, snapshot_path: str = None, cbr_url: str = CBR_URL, refresh_interval: int = 3600,
+                 request_timeout: float = 10, rate_store=None, retry_interval: float = 60):
+        self.cbr_url = cbr_url
+        self.rate_store = rate_store
+        self.snapshot_path = snapshot_path
+        self.refresh_interval = refresh_interval
+        self.retry_interval = retry_interval
+        self.request_timeout = request_timeout
+        self.scheduler = AsyncIOScheduler()
+
+        self.rates_date = None
+        # Рубль доступен всегда, даже если снимка нет и первая загрузка не удалась
+        self.set_rates({})
+        self.etag = None
+        self.last_modified = None
 
-    def _fetch_rates(self):
-        response = requests.get(self.cbr_url)
-        tree = ElementTree.fromstring(response.content)
+        if snapshot_path:
+            self.load_snapshot()
 
-        for currency in tree.findall('Valute'):
-            char_code = currency.find('CharCode').text
-            value = currency.find('Value').text.replace(',', '.')
-            nominal = currency.find('Nominal').text
+    def set_rates(self, currencies, rates_date=None):
+        currencies = dict(currencies)
+        currencies['RUB'] = {'value': 1.0, 'nominal': 1}
+        # Таблица курсов и матрица кросс-курсов строятся заранее и подменяются одним присваиванием
+        self._table = RateTable(currencies)
+        self.rates_date = rates_date
 
-            self.currencies[char_code] = {
-                'value': float(value),
-                'nominal': int(nominal)
-            }
+    @property
+    def currencies(self):
+        return self._table.currencies
 
-        self.currencies['RUB'] = {'value': 1.0, 'nominal': 1}
+    def load_snapshot(self) -> bool:
+        try:
+            with open(self.snapshot_path, encoding='utf-8') as file:
+                snapshot = json.load(file)
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError):
+            logger.exception("Не удалось прочитать снимок курсов %s", self.snapshot_path)
+            return False
+
+        self.set_rates(snapshot['currencies'], snapshot.get('date'))
+        self.etag = snapshot.get('etag')
+        self.last_modified = snapshot.get('last_modified')
+        return True
+
+    def _save_snapshot(self, snapshot):
+        tmp_path = f'{self.snapshot_path}.tmp'
+        os.makedirs(os.path.dirname(os.path.abspath(self.snapshot_path)), exist_ok=True)
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            json.dump(snapshot, file, ensure_ascii=False)
+        os.replace(tmp_path, self.snapshot_path)
+
+    async def refresh(self) -> bool:
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+
+        started = time.perf_counter()
+        try:
+            timeout = aiohttp.ClientTimeout(total=self.request_timeout)
+            async with aiohttp.ClientSession(timeout=timeout) as session:
+                async with session.get(self.cbr_url, headers=headers) as response:
+                    if response.status == 304:
+                        CBR_FETCH_SECONDS.labels('not_modified').observe(time.perf_counter() - started)
+                        return False
+                    response.raise_for_status()
+                    content = await response.read()
+                    etag = response.headers.get('ETag')
+                    last_modified = response.headers.get('Last-Modified')
+            rates_date, currencies = parse_cbr_xml(content)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ElementTree.ParseError, AttributeError, ValueError):
+            CBR_FETCH_SECONDS.labels('error').observe(time.perf_counter() - started)
+            # Старые курсы остаются в силе до следующей успешной попытки
+            logger.exception("Не удалось обновить курсы валют ЦБ РФ")
+            self._schedule_retry()
+            return False
+        CBR_FETCH_SECONDS.labels('ok').observe(time.perf_counter() - started)
+
+        self.set_rates(currencies, rates_date)
+        self.etag = etag
+        self.last_modified = last_modified
+
+        if self.snapshot_path:
+            snapshot = {'date': rates_date, 'etag': etag, 'last_modified': last_modified, 'currencies': currencies}
+            await asyncio.get_running_loop().run_in_executor(None, self._save_snapshot, snapshot)
+        if self.rate_store is not None and rates_date:
+            await self.rate_store.save_rates(rates_date, currencies)
+        return True
+
+    def start(self):
+        self.scheduler.add_job(self.refresh, 'interval', seconds=self.refresh_interval, next_run_time=datetime.now())
+        self.scheduler.start()
+
+    def _schedule_retry(self):
+        # Без курсов бот умеет только рубль, поэтому повтор не ждёт полного интервала обновления
+        if len(self.currencies) > 1 or not self.scheduler.running:
+            return
+        self.scheduler.add_job(self.refresh, 'date', run_date=datetime.now() + timedelta(seconds=self.retry_interval),
+                               id='cbr_retry', replace_existing=True)
+
+    def stop(self):
+        if self.scheduler.running:
+            self.scheduler.shutdown(wait=False)
 
     def get_rate(self, currency_code):
-        if currency_code in self.currencies:
-            return self.currencies[currency_code]['value'] / self.currencies[currency_code]['nominal']
-        else:
-            raise ValueError(f"Валюта {currency_code} не найдена")
+        table = self._table
+        return float(table.rub_rates[table.position(currency_code)])
 
     def convert(self, amount, from_currency, to_currency):
-        if from_currency == 'RUB':
-            result = amount / self.get_rate(to_currency)
-        elif to_currency == 'RUB':
-            result = amount * self.get_rate(from_currency)
-        else:
-            result = amount * self.get_rate(from_currency) / self.get_rate(to_currency)
-        return result
+        table = self._table
+        return amount * float(table.cross[table.position(from_currency), table.position(to_currency)])
+
+    def convert_many(self, amounts, from_codes, to_code):
+        table = self._table
+        amounts = np.asarray(amounts, dtype=np.float64)
+        from_codes = np.asarray(from_codes)
+        if amounts.shape != from_codes.shape:
+            raise ValueError("Количество сумм и кодов валют должно совпадать.")
+        if not amounts.size:
+            return amounts
+
+        # Индексы ищутся только для уникальных кодов, остальное — одна векторная операция
+        codes, inverse = np.unique(from_codes, return_inverse=True)
+        rows = np.array([table.position(code) for code in codes.tolist()], dtype=np.intp)
+        return amounts * table.cross[rows[inverse.reshape(amounts.shape)], table.position(to_code)]
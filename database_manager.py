@@ -1,66 +1,27 @@
-import aiosqlite
+from migrations import apply_migrations, rebuild_category_totals_statements
 
 
 class DatabaseManager:
-    def __init__(self, db_path: str):
-        self.db_path = db_path
+    def __init__(self, pool):
+        self.pool = pool
 
 
     async def init_db(self):
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute('''
-                        CREATE TABLE IF NOT EXISTS users (
-                            id INTEGER PRIMARY KEY AUTOINCREMENT,
-                            telegram_id INTEGER NOT NULL UNIQUE
-                        )
-                    ''')
-            await db.execute('''
-                                CREATE TABLE IF NOT EXISTS income (
-                                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                                    user_id INTEGER,
-                                    category TEXT,
-                                    amount REAL,
-                                    currency TEXT,
-                                    date TEXT,
-                                    FOREIGN KEY(user_id) REFERENCES users(id)
-                                )
-                            ''')
-            await db.execute('''
-                                CREATE TABLE IF NOT EXISTS expenses (
-                                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                                    user_id INTEGER,
-                                    category TEXT,
-                                    amount REAL,
-                                    currency TEXT,
-                                    date TEXT,
-                                    FOREIGN KEY(user_id) REFERENCES users(id)
-                                )
-                            ''')
-            await db.execute('''
-                        CREATE TABLE IF NOT EXISTS financial_goals (
-                            id INTEGER PRIMARY KEY AUTOINCREMENT,
-                            user_id INTEGER,
-                            goal_name TEXT,
-                            target_amount REAL,
-                            deadline DATE,
-                            current_amount REAL DEFAULT 0,
-                            FOREIGN KEY (user_id) REFERENCES users(id)
-                        )
-            ''')
-            await db.execute('''
-                        CREATE TABLE IF NOT EXISTS reminders (
-                            id INTEGER PRIMARY KEY AUTOINCREMENT,
-                            user_id INTEGER,
-                            message TEXT,
-                            remind_at TIMESTAMP,
-                            FOREIGN KEY (user_id) REFERENCES users(id)
-                        )
-            ''')
-            await db.commit()
+        async with self.pool.writer() as db:
+            return await apply_migrations(db)
 
 
     async def add_user(self, telegram_id: int):
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.pool.writer() as db:
             await db.execute('INSERT OR IGNORE INTO users (telegram_id) VALUES (?)', (telegram_id,))
             await db.commit()
 
+
+    async def rebuild_category_totals(self):
+        async with self.pool.writer() as db:
+            # Архивы присоединяются до BEGIN: ATTACH внутри транзакции невозможен
+            tables = await self.pool.history_tables(db)
+            await db.execute('BEGIN')
+            for statement in rebuild_category_totals_statements(*tables):
+                await db.execute(statement)
+            await db.commit()
@@ -0,0 +1,91 @@
+import itertools
+import time
+
+from aiohttp import web
+
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'FakeBot', 'username': 'fake_bot'}
+
+
+# Локальная заглушка Bot API для тестов и нагрузочных прогонов
+class FakeTelegramAPI:
+    def __init__(self, host: str = '127.0.0.1', port: int = 0):
+        self.host = host
+        self.port = port
+        self.url = None
+        self.calls = []
+        self.blocked_chats = set()
+        self.flood_responses = 0
+        self.retry_after = 1
+
+        self._message_ids = itertools.count(1)
+        self._runner = None
+
+    @property
+    def sent_messages(self):
+        return [(call['chat_id'], call['text']) for call in self.calls if call['method'] == 'sendMessage']
+
+    def flood(self, responses: int, retry_after: int = 1):
+        # Следующие responses запросов получат 429 Too Many Requests
+        self.flood_responses = responses
+        self.retry_after = retry_after
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post('/bot{token}/{method}', self._handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        self.url = f'http://{self.host}:{self.port}'
+        return self.url
+
+    async def close(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def _handle(self, request):
+        method = request.match_info['method']
+        params = dict(await request.post())
+
+        if self.flood_responses > 0:
+            self.flood_responses -= 1
+            return web.json_response({
+                'ok': False, 'error_code': 429,
+                'description': f'Too Many Requests: retry after {self.retry_after}',
+                'parameters': {'retry_after': self.retry_after},
+            }, status=429)
+
+        chat_id = params.get('chat_id')
+        if chat_id is not None and int(chat_id) in self.blocked_chats:
+            return web.json_response({
+                'ok': False, 'error_code': 403, 'description': 'Forbidden: bot was blocked by the user',
+            }, status=403)
+
+        self.calls.append({
+            'method': method,
+            'chat_id': int(chat_id) if chat_id is not None else None,
+            'text': params.get('text') or params.get('caption'),
+            'time': time.monotonic(),
+        })
+
+        if method == 'getMe':
+            return web.json_response({'ok': True, 'result': BOT_USER})
+        if method.startswith('send'):
+            return web.json_response({'ok': True, 'result': self._message(int(chat_id), method, params)})
+        return web.json_response({'ok': True, 'result': True})
+
+    def _message(self, chat_id, method, params):
+        message = {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': BOT_USER,
+        }
+        if 'text' in params:
+            message['text'] = params['text']
+        if method == 'sendPhoto':
+            file_id = f"photo-{message['message_id']}"
+            message['photo'] = [{'file_id': file_id, 'file_unique_id': file_id, 'width': 800, 'height': 600}]
+        return message
@@ -1,98 +1,503 @@
+import asyncio
 import datetime
-import io
+import logging
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import Optional
 
-import aiosqlite
-from matplotlib import pyplot as plt
+import numpy as np
+from aiogram.utils.markdown import escape_md, quote_html
 
-from user_manager import UserManager
+from csv_import import IMPORT_CHUNK_SIZE, ImportResult, open_csv_reader, open_csv_text, read_chunk
+from rate_store import lookup_rub_rates
+from transaction_search import SEARCH_PAGE_SIZE
+
+logger = logging.getLogger(__name__)
+
+INSERT_INCOME = '''
+    INSERT INTO income (user_id, category, amount, currency, date)
+    VALUES (?, ?, ?, ?, ?)
+'''
+INSERT_EXPENSE = '''
+    INSERT INTO expenses (user_id, category, amount, currency, date)
+    VALUES (?, ?, ?, ?, ?)
+'''
+IMPORT_INCOME = '''
+    INSERT INTO income (user_id, category, amount, currency, date, note)
+    VALUES (?, ?, ?, ?, ?, ?)
+'''
+IMPORT_EXPENSE = '''
+    INSERT INTO expenses (user_id, category, amount, currency, date, note)
+    VALUES (?, ?, ?, ?, ?, ?)
+'''
+UPSERT_CATEGORY_TOTAL = '''
+    INSERT INTO category_totals (user_id, kind, category, currency, month, total, count)
+    VALUES (?, ?, ?, ?, ?, ?, 1)
+    ON CONFLICT (user_id, kind, category, currency, month)
+    DO UPDATE SET total = total + excluded.total, count = count + 1
+'''
+# Пакетный вариант для импорта: итоги пакета предварительно сгруппированы по ключу сводной таблицы
+UPSERT_CATEGORY_TOTALS = '''
+    INSERT INTO category_totals (user_id, kind, category, currency, month, total, count)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (user_id, kind, category, currency, month)
+    DO UPDATE SET total = total + excluded.total, count = count + excluded.count
+'''
+BUMP_DATA_VERSION = 'UPDATE users SET data_version = data_version + 1 WHERE id = ?'
+
+BUDGET_THRESHOLDS = (0.8, 1.0)
+# Порог проверяется по счётчику месяца из category_totals, обновлённому в той же транзакции: поиск по ключам
+# budgets и category_totals вместо пересчёта расходов. Уведомление фиксируется один раз на порог в месяц
+RECORD_BUDGET_ALERTS = f'''
+    INSERT OR IGNORE INTO budget_alerts (user_id, category, month, threshold, budget, spent, currency)
+    SELECT b.user_id, b.category, t.month, thresholds.value, b.amount, t.total, b.currency
+    FROM budgets b
+    JOIN category_totals t ON t.user_id = b.user_id AND t.kind = 'expense' AND t.category = b.category
+        AND t.currency = b.currency AND t.month = ?
+    JOIN ({' UNION ALL '.join(f'SELECT {value} AS value' for value in BUDGET_THRESHOLDS)}) thresholds
+    WHERE b.user_id = ? AND b.category = ? AND b.currency = ? AND t.total >= b.amount * thresholds.value
+'''
+
+# Условия keyset-пагинации по (date, kind, id); {kind} подставляется литералом ветки UNION
+STATISTICS_BEFORE = (
+    'AND date <= :key_date AND (date < :key_date OR {kind} < :key_kind OR ({kind} = :key_kind AND id < :key_id))'
+)
+STATISTICS_AFTER = (
+    'AND date >= :key_date AND (date > :key_date OR {kind} > :key_kind OR ({kind} = :key_kind AND id > :key_id))'
+)
+STATISTICS_PAGE_SIZE = 20
+EXPORT_BATCH_SIZE = 1000
+
+
+@dataclass
+class StatisticsPage:
+    text: str
+    prev_cursor: Optional[str] = None
+    next_cursor: Optional[str] = None
 
 
 class FinanceManager:
-    def __init__(self, db_name):
-        self.db_name = db_name
-        self.user_manager = UserManager(db_name)
+    def __init__(self, pool, user_manager, write_queue, chart_renderer, chart_cache, rate_store, notifier=None):
+        self.pool = pool
+        self.user_manager = user_manager
+        self.write_queue = write_queue
+        self.chart_renderer = chart_renderer
+        self.chart_cache = chart_cache
+        self.rate_store = rate_store
+        self.notifier = notifier
+        self._alert_tasks = set()
 
     categories_income = ["Зарплата", "Бонусы", "Подарки", "Инвестиции", "Другое"]
     categories_expense = ["Продукты", "Транспорт", "Развлечения", "Оплата жилья", "Другое"]
 
     async def add_income(self, telegram_id, category, amount, currency):
         user_id = await self.user_manager.get_user_id(telegram_id)
-        async with aiosqlite.connect(self.db_name) as db:
-            await db.execute('''
-                INSERT INTO income (user_id, category, amount, currency, date)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (user_id, category, amount, currency, datetime.datetime.now().isoformat()))
-            await db.commit()
+        date = datetime.datetime.now().isoformat()
+        # Сводная таблица обновляется в той же транзакции, что и сама запись
+        await self.write_queue.submit(
+            (INSERT_INCOME, (user_id, category, amount, currency, date)),
+            (UPSERT_CATEGORY_TOTAL, (user_id, 'income', category, currency, date[:7], amount)),
+            (BUMP_DATA_VERSION, (user_id,)),
+        )
 
     async def add_expense(self, telegram_id, category, amount, currency):
         user_id = await self.user_manager.get_user_id(telegram_id)
-        async with aiosqlite.connect(self.db_name) as db:
-            await db.execute('''
-                INSERT INTO expenses (user_id, category, amount, currency, date)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (user_id, category, amount, currency, datetime.datetime.now().isoformat()))
+        date = datetime.datetime.now().isoformat()
+        changes = await self.write_queue.submit(
+            (INSERT_EXPENSE, (user_id, category, amount, currency, date)),
+            (UPSERT_CATEGORY_TOTAL, (user_id, 'expense', category, currency, date[:7], amount)),
+            (BUMP_DATA_VERSION, (user_id,)),
+            (RECORD_BUDGET_ALERTS, (date[:7], user_id, category, currency)),
+        )
+        # Обычно порог не пересечён, и сама запись сообщает об этом числом добавленных уведомлений
+        if changes[-1] != 0:
+            self._schedule_budget_alerts(user_id, telegram_id)
+
+    async def set_budget(self, telegram_id, category, amount, currency='RUB'):
+        if category not in self.categories_expense:
+            raise ValueError(f"Неизвестная категория расходов: {category}")
+        if amount < 0:
+            raise ValueError("Сумма бюджета не может быть отрицательной.")
+
+        user_id = await self.user_manager.get_user_id(telegram_id)
+        # Нулевая сумма снимает бюджет
+        if amount == 0:
+            await self.write_queue.submit(('DELETE FROM budgets WHERE user_id = ? AND category = ?',
+                                           (user_id, category)))
+            return
+        await self.write_queue.submit(('''
+            INSERT INTO budgets (user_id, category, amount, currency) VALUES (?, ?, ?, ?)
+            ON CONFLICT (user_id, category) DO UPDATE SET amount = excluded.amount, currency = excluded.currency
+        ''', (user_id, category, amount, currency.upper())))
+
+    async def get_budgets(self, telegram_id, month=None):
+        user_id = await self.user_manager.get_user_id(telegram_id)
+        month = month or datetime.date.today().isoformat()[:7]
+        async with self.pool.reader() as db:
+            async with db.execute('''
+                SELECT b.category, b.amount, b.currency, COALESCE(t.total, 0)
+                FROM budgets b
+                LEFT JOIN category_totals t ON t.user_id = b.user_id AND t.kind = 'expense'
+                    AND t.category = b.category AND t.currency = b.currency AND t.month = ?
+                WHERE b.user_id = ?
+                ORDER BY b.category
+            ''', (month, user_id)) as cursor:
+                return await cursor.fetchall()
+
+    def _schedule_budget_alerts(self, user_id, telegram_id):
+        if self.notifier is None:
+            return
+        # Уведомление отправляется фоновой задачей и не задерживает подтверждение расхода
+        task = asyncio.get_running_loop().create_task(self._send_budget_alerts(user_id, telegram_id))
+        self._alert_tasks.add(task)
+        task.add_done_callback(self._alert_tasks.discard)
+
+    async def join_alerts(self):
+        while self._alert_tasks:
+            await asyncio.gather(*self._alert_tasks, return_exceptions=True)
+
+    async def _send_budget_alerts(self, user_id, telegram_id):
+        # Уведомления забираются одним UPDATE ... RETURNING, чтобы параллельный расход не отправил их повторно
+        try:
+            async with self.pool.writer() as db:
+                async with db.execute('''
+                    UPDATE budget_alerts SET notified = 1 WHERE user_id = ? AND notified = 0
+                    RETURNING category, month, threshold, budget, spent, currency
+                ''', (user_id,)) as cursor:
+                    alerts = await cursor.fetchall()
+                await db.commit()
+        except Exception:
+            logger.exception("Не удалось забрать уведомления о бюджете пользователя %s", user_id)
+            return
+
+        # Если пакет расходов перешагнул сразу несколько порогов, сообщаем только о старшем
+        highest = {}
+        for category, month, threshold, budget, spent, currency in alerts:
+            if threshold > highest.get((category, month), (0,))[0]:
+                highest[(category, month)] = (threshold, budget, spent, currency)
+
+        for (category, month), (threshold, budget, spent, currency) in highest.items():
+            if threshold >= 1:
+                text = f"Бюджет «{category}» на {month} превышен: потрачено {spent:.2f} из {budget:.2f} {currency}."
+            else:
+                text = (f"Потрачено {threshold:.0%} бюджета «{category}» на {month}: "
+                        f"{spent:.2f} из {budget:.2f} {currency}.")
+            await self.notifier.send(telegram_id, escape_md(text))
+
+    async def import_transactions(self, telegram_id, binary_file, progress=None,
+                                  chunk_size: int = IMPORT_CHUNK_SIZE) -> ImportResult:
+        user_id = await self.user_manager.get_user_id(telegram_id)
+        loop = asyncio.get_running_loop()
+        text_file = await loop.run_in_executor(None, open_csv_text, binary_file)
+        reader, columns = await loop.run_in_executor(None, open_csv_reader, text_file)
+
+        result = ImportResult()
+        done = False
+        while not done:
+            records, done = await loop.run_in_executor(None, read_chunk, reader, columns, result, chunk_size)
+            if records:
+                await self._insert_transactions(user_id, telegram_id, records)
+                result.imported += len(records)
+            if progress is not None:
+                await progress(result)
+        return result
+
+    async def _insert_transactions(self, user_id, telegram_id, records):
+        income, expenses = [], []
+        totals = defaultdict(lambda: [0.0, 0])
+        for kind, category, amount, currency, date, note in records:
+            (income if kind == 'income' else expenses).append((user_id, category, amount, currency, date, note))
+            total = totals[(kind, category, currency, date[:7])]
+            total[0] += amount
+            total[1] += 1
+
+        # Пакет — одна транзакция мимо очереди записи: писатель занят ненадолго, а сводная таблица
+        # и версия данных меняются вместе с самими записями
+        async with self.pool.writer() as db:
+            await db.executemany(IMPORT_INCOME, income)
+            await db.executemany(IMPORT_EXPENSE, expenses)
+            await db.executemany(UPSERT_CATEGORY_TOTALS, [
+                (user_id, kind, category, currency, month, total, count)
+                for (kind, category, currency, month), (total, count) in totals.items()
+            ])
+            await db.execute(BUMP_DATA_VERSION, (user_id,))
+            # Пороги проверяются только для текущего месяца: импорт прошлых выписок не должен присылать
+            # уведомления о давно закрытых бюджетах
+            month = datetime.date.today().isoformat()[:7]
+            cursor = await db.executemany(RECORD_BUDGET_ALERTS, [
+                (month, user_id, category, currency)
+                for kind, category, currency, total_month in totals if kind == 'expense' and total_month == month
+            ])
+            recorded = cursor.rowcount
             await db.commit()
+        if recorded > 0:
+            self._schedule_budget_alerts(user_id, telegram_id)
+
+    async def get_category_totals(self, telegram_id):
+        user_id = await self.user_manager.get_user_id(telegram_id)
+        totals = {'income': {}, 'expense': {}}
+        async with self.pool.reader() as db:
+            async with db.execute('''
+                SELECT kind, category, SUM(total) FROM category_totals
+                WHERE user_id = ? GROUP BY kind, category
+            ''', (user_id,)) as cursor:
+                async for kind, category, total in cursor:
+                    totals[kind][category] = total
+        return totals
+
+    async def get_summary(self, telegram_id):
+        user_id = await self.user_manager.get_user_id(telegram_id)
+        totals = {'income': [], 'expense': []}
+        async with self.pool.reader() as db:
+            async with db.execute('''
+                SELECT kind, currency, SUM(total) FROM category_totals
+                WHERE user_id = ? GROUP BY kind, currency ORDER BY kind, currency
+            ''', (user_id,)) as cursor:
+                async for kind, currency, total in cursor:
+                    totals[kind].append(f"{total:.2f} {currency}")
+
+        return (f"Итого доходов: {', '.join(totals['income']) or '0'}\n"
+                f"Итого расходов: {', '.join(totals['expense']) or '0'}")
+
+    async def get_base_currency_report(self, telegram_id, base_currency='RUB'):
+        user_id = await self.user_manager.get_user_id(telegram_id)
+        kinds, categories, amounts, codes, days = [], [], [], [], []
+        async with self.pool.reader() as db:
+            income, expenses = await self.pool.history_tables(db)
+            async with db.execute(f'''
+                SELECT 0, category, amount, currency, substr(date, 1, 10) FROM {income} WHERE user_id = :user_id
+                UNION ALL
+                SELECT 1, category, amount, currency, substr(date, 1, 10) FROM {expenses} WHERE user_id = :user_id
+            ''', {'user_id': user_id}) as cursor:
+                async for kind, category, amount, currency, day in cursor:
+                    kinds.append(kind)
+                    categories.append(category or '')
+                    amounts.append(amount or 0.0)
+                    codes.append((currency or '').strip().upper())
+                    days.append(day)
+
+        history = await self.rate_store.load_history(set(codes) | {base_currency})
+        if base_currency != 'RUB' and base_currency not in history:
+            raise ValueError(f"Валюта {base_currency} не найдена")
+        if not amounts:
+            return f"Итоги в {base_currency}:\nОпераций пока нет."
+
+        # Весь пересчёт — векторные операции по массивам операций пользователя
+        codes = np.array(codes)
+        days = np.array(days, dtype='datetime64[D]')
+        rub_amounts = np.array(amounts, dtype=np.float64) * lookup_rub_rates(history, codes, days)
+        converted = rub_amounts / lookup_rub_rates(history, np.full(codes.shape, base_currency), days)
+        converted_mask = ~np.isnan(converted)
+
+        names, category_index = np.unique(np.array(categories), return_inverse=True)
+        groups = np.array(kinds) * len(names) + category_index
+        sums = np.bincount(groups[converted_mask], weights=converted[converted_mask], minlength=2 * len(names))
+        income_sums, expense_sums = sums[:len(names)], sums[len(names):]
+
+        lines = [f"Итоги в {base_currency}:", f"Доходы: {income_sums.sum():.2f}"]
+        lines += [f"  {name}: {total:.2f}" for name, total in zip(names, income_sums) if total]
+        lines.append(f"Расходы: {expense_sums.sum():.2f}")
+        lines += [f"  {name}: {total:.2f}" for name, total in zip(names, expense_sums) if total]
+        lines.append(f"Баланс: {income_sums.sum() - expense_sums.sum():.2f}")
+
+        skipped = codes[~converted_mask]
+        if skipped.size:
+            lines.append(f"Не пересчитано операций: {skipped.size} (нет курсов: {', '.join(sorted(set(skipped)))})")
+        return "\n".join(lines)
+
+    async def iter_transactions(self, telegram_id, batch_size: int = EXPORT_BATCH_SIZE):
+        user_id = await self.user_manager.get_user_id(telegram_id)
+        condition, key, last_date = '', {}, ''
+        while True:
+            # Читатель берётся на один пакет: долгая выгрузка не занимает соединение и не держит снимок WAL
+            async with self.pool.reader() as db:
+                # Выгрузка идёт от старых строк к новым: дойдя до горячих лет, она перестаёт читать архивы
+                income, expenses = await self.pool.history_tables(db, last_date)
+                async with db.execute(f'''
+                    SELECT date, kind, id, category, amount, currency, note FROM (
+                        SELECT date, 'i' AS kind, id, category, amount, currency, note FROM {income}
+                        WHERE user_id = :user_id {condition.format(kind="'i'")}
+                        UNION ALL
+                        SELECT date, 'e' AS kind, id, category, amount, currency, note FROM {expenses}
+                        WHERE user_id = :user_id {condition.format(kind="'e'")}
+                    )
+                    ORDER BY date, kind, id
+                    LIMIT :limit
+                ''', {'user_id': user_id, 'limit': batch_size, **key}) as cursor:
+                    rows = await cursor.fetchall()
+
+            if not rows:
+                return
+            yield [(row_date, 'income' if kind == 'i' else 'expense', category, amount, currency, note)
+                   for row_date, kind, _, category, amount, currency, note in rows]
+            if len(rows) < batch_size:
+                return
+            last_date, last_kind, last_id = rows[-1][:3]
+            condition, key = STATISTICS_AFTER, {'key_date': last_date, 'key_kind': last_kind, 'key_id': last_id}
+
+    async def get_statistics_page(self, telegram_id, cursor=None, backward=False, date_from=None, date_to=None,
+                                  page_size=STATISTICS_PAGE_SIZE):
+        user_id = await self.user_manager.get_user_id(telegram_id)
+        # Границы периода: date_from включительно, date_to включительно по дню
+        lower = date_from.isoformat() if date_from else ''
+        upper = (date_to + datetime.timedelta(days=1)).isoformat() if date_to else '9999'
+
+        async with self.pool.reader() as db:
+            # Период, начинающийся после последнего архивного года, читается только из основной БД
+            tables = await self.pool.history_tables(db, lower)
+            key = await self._statistics_key(db, tables, user_id, cursor) if cursor else None
+            # Страницы идут от новых записей к старым; ключ (date, kind, id) однозначно упорядочивает обе таблицы
+            if key is None:
+                condition, key_params = '', {}
+            elif backward:
+                condition, key_params = STATISTICS_AFTER, key
+            else:
+                condition, key_params = STATISTICS_BEFORE, key
+            order = 'ASC' if backward else 'DESC'
+
+            async with db.execute(f'''
+                SELECT date, kind, id, category, amount, currency FROM (
+                    SELECT date, 'i' AS kind, id, category, amount, currency FROM {tables[0]}
+                    WHERE user_id = :user_id AND date >= :lower AND date < :upper {condition.format(kind="'i'")}
+                    UNION ALL
+                    SELECT date, 'e' AS kind, id, category, amount, currency FROM {tables[1]}
+                    WHERE user_id = :user_id AND date >= :lower AND date < :upper {condition.format(kind="'e'")}
+                )
+                ORDER BY date {order}, kind {order}, id {order}
+                LIMIT :limit
+            ''', {'user_id': user_id, 'lower': lower, 'upper': upper, 'limit': page_size + 1, **key_params}) as rows:
+                rows = await rows.fetchall()
+
+        has_more = len(rows) > page_size
+        rows = rows[:page_size]
+        if backward:
+            rows.reverse()
+            has_newer, has_older = has_more, True
+        else:
+            has_newer, has_older = cursor is not None, has_more
 
-    async def get_statistics(self, telegram_id):
+        return StatisticsPage(
+            text=self._format_statistics_page(rows),
+            prev_cursor=f"{rows[0][1]}{rows[0][2]}" if rows and has_newer else None,
+            next_cursor=f"{rows[-1][1]}{rows[-1][2]}" if rows and has_older else None,
+        )
+
+    async def search_transactions(self, telegram_id, query, cursor=None, backward=False,
+                                  page_size=SEARCH_PAGE_SIZE):
         user_id = await self.user_manager.get_user_id(telegram_id)
-        income_data = []
-        expenses_data = []
-        async with aiosqlite.connect(self.db_name) as db:
-            async with db.execute('SELECT category, amount, currency, date FROM income WHERE user_id = ?',
-                                  (user_id,)) as cursor:
-                income_data = await cursor.fetchall()
-            async with db.execute('SELECT category, amount, currency, date FROM expenses WHERE user_id = ?',
-                                  (user_id,)) as cursor:
-                expenses_data = await cursor.fetchall()
-
-        statistics = "Статистика доходов и расходов:\n\nДоходы:\n"
-        for category, amount, currency, date in income_data:
-            statistics += f"{category}: {amount} {currency} (Дата: {date})\n"
-
-        statistics += "\nРасходы:\n"
-        for category, amount, currency, date in expenses_data:
-            statistics += f"{category}: {amount} {currency} (Дата: {date})\n"
-
-        return statistics
+        params = {'user_id': user_id, 'lower': query.date_from, 'upper': query.date_to,
+                  'match': query.match_expression(user_id), 'limit': page_size + 1}
+        amount_filter = ''
+        if query.min_amount is not None:
+            amount_filter += ' AND amount > :min_amount'
+            params['min_amount'] = query.min_amount
+        if query.max_amount is not None:
+            amount_filter += ' AND amount < :max_amount'
+            params['max_amount'] = query.max_amount
+
+        async with self.pool.reader() as db:
+            tables = await self.pool.history_tables(db, query.date_from)
+            key = await self._statistics_key(db, tables, user_id, cursor) if cursor else None
+            if key is None:
+                condition = ''
+            else:
+                condition = STATISTICS_AFTER if backward else STATISTICS_BEFORE
+                params.update(key)
+            order = 'ASC' if backward else 'DESC'
+
+            # Совпадения индекса материализуются один раз в список rowid, а строки идут по индексу (user_id, date)
+            # в порядке страницы: LIMIT останавливает проход, не сортируя все совпадения
+            branches = [
+                f'''
+                SELECT date, '{kind}' AS kind, id, category, amount, currency, note FROM {table}
+                WHERE user_id = :user_id AND date >= :lower AND date < :upper{amount_filter}
+                    {condition.format(kind=f"'{kind}'")}
+                    AND id IN (SELECT rowid >> 1 FROM transactions_fts
+                               WHERE transactions_fts MATCH :match AND rowid & 1 = {parity})
+                '''
+                for parity, (kind, table) in enumerate(zip('ie', tables)) if query.kind in (None, kind)
+            ]
+            async with db.execute(f'''
+                SELECT * FROM ({' UNION ALL '.join(branches)})
+                ORDER BY date {order}, kind {order}, id {order}
+                LIMIT :limit
+            ''', params) as rows:
+                rows = await rows.fetchall()
+
+        has_more = len(rows) > page_size
+        rows = rows[:page_size]
+        if backward:
+            rows.reverse()
+            has_newer, has_older = has_more, True
+        else:
+            has_newer, has_older = cursor is not None, has_more
+
+        return StatisticsPage(
+            text=self._format_search_page(rows),
+            prev_cursor=f"{rows[0][1]}{rows[0][2]}" if rows and has_newer else None,
+            next_cursor=f"{rows[-1][1]}{rows[-1][2]}" if rows and has_older else None,
+        )
+
+    @staticmethod
+    async def _statistics_key(db, tables, user_id, cursor):
+        # Курсор вида "i123"/"e45" ссылается на строку, дату которой берём из БД
+        kind, row_id = cursor[:1], cursor[1:]
+        if kind not in ('i', 'e') or not row_id.isdigit():
+            raise ValueError("Некорректный курсор страницы статистики.")
+        table = tables[0] if kind == 'i' else tables[1]
+        async with db.execute(f'SELECT date FROM {table} WHERE id = ? AND user_id = ?',
+                              (int(row_id), user_id)) as result:
+            row = await result.fetchone()
+        if row is None:
+            return None
+        return {'key_date': row[0], 'key_kind': kind, 'key_id': int(row_id)}
+
+    @staticmethod
+    def _format_statistics_page(rows):
+        if not rows:
+            return "Нет операций за выбранный период."
+
+        income = [f"{category}: {amount} {currency} (Дата: {date})"
+                  for date, kind, _, category, amount, currency in rows if kind == 'i']
+        expenses = [f"{category}: {amount} {currency} (Дата: {date})"
+                    for date, kind, _, category, amount, currency in rows if kind == 'e']
+
+        parts = ["Статистика доходов и расходов:"]
+        if income:
+            parts.append("Доходы:\n" + "\n".join(income))
+        if expenses:
+            parts.append("Расходы:\n" + "\n".join(expenses))
+        return "\n\n".join(parts)
+
+    @staticmethod
+    def _format_search_page(rows):
+        # Заметки приходят из банковских выписок, поэтому текст экранируется для HTML-разметки
+        if not rows:
+            return "Ничего не найдено."
+        lines = ["Найденные операции:"]
+        for date, kind, _, category, amount, currency, note in rows:
+            line = f"{date[:10]} {'+' if kind == 'i' else '-'}{amount:.2f} {currency} · {category}"
+            lines.append(quote_html(f"{line} — {note}" if note else line))
+        return "\n".join(lines)
+
+    async def get_data_version(self, user_id):
+        async with self.pool.reader() as db:
+            async with db.execute('SELECT data_version FROM users WHERE id = ?', (user_id,)) as cursor:
+                row = await cursor.fetchone()
+                return row[0] if row else 0
 
     async def create_statistics_chart(self, telegram_id):
         user_id = await self.user_manager.get_user_id(telegram_id)
+        key = self.chart_cache.key(user_id, await self.get_data_version(user_id))
+
+        chart = await self.chart_cache.get(key)
+        if chart is not None:
+            return chart
+
+        totals = await self.get_category_totals(telegram_id)
+        image = await self.chart_renderer.render(totals['income'], totals['expense'])
+
+        return await self.chart_cache.put(key, image)
 
-        income_data = {}
-        expenses_data = {}
-
-        async with aiosqlite.connect(self.db_name) as db:
-            async with db.execute('SELECT category, amount FROM income WHERE user_id = ?', (user_id,)) as cursor:
-                async for row in cursor:
-                    category, amount = row
-                    if category in income_data:
-                        income_data[category] += amount
-                    else:
-                        income_data[category] = amount
-
-            async with db.execute('SELECT category, amount FROM expenses WHERE user_id = ?', (user_id,)) as cursor:
-                async for row in cursor:
-                    category, amount = row
-                    if category in expenses_data:
-                        expenses_data[category] += amount
-                    else:
-                        expenses_data[category] = amount
-
-        # Создание двух графиков: один для доходов, другой для расходов
-        fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(14, 7))
-
-        # График доходов
-        ax1.pie(income_data.values(), labels=income_data.keys(), autopct='%1.1f%%', startangle=140)
-        ax1.set_title('Доходы по категориям')
-
-        # График расходов
-        ax2.pie(expenses_data.values(), labels=expenses_data.keys(), autopct='%1.1f%%', startangle=140)
-        ax2.set_title('Расходы по категориям')
-
-        # Сохранение изображения в буфер
-        buf = io.BytesIO()
-        plt.savefig(buf, format='png')
-        buf.seek(0)
-        plt.close(fig)
-
-        return buf
+    async def remember_chart_file_id(self, key, file_id):
+        await self.chart_cache.set_file_id(key, file_id)
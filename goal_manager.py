@@ -1,54 +1,130 @@
-from datetime import datetime
+import asyncio
+import logging
+from datetime import date, datetime, timedelta
+from functools import partial
 
-import aiosqlite
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
-from user_manager import UserManager
+from reminder_scheduler import ReminderScheduler
+
+logger = logging.getLogger(__name__)
 
 
 class GoalManager:
-    def __init__(self, bot, db_name):
-        self.bot = bot
-        self.db_name = db_name
+    def __init__(self, notifier, pool, user_manager, goal_batch_size: int = 500, delete_batch_size: int = 500,
+                 delete_interval: float = 0.05):
+        self.notifier = notifier
+        self.pool = pool
+        self.goal_batch_size = goal_batch_size
+        self.delete_batch_size = delete_batch_size
+        self.delete_interval = delete_interval
         self.scheduler = AsyncIOScheduler()
-        self.user_manager = UserManager(db_name)
-
-    async def send_reminders(self):
-        now = datetime.now()
-        async with aiosqlite.connect(self.db_name) as db:
-            async with db.execute('SELECT id, user_id, message FROM reminders WHERE remind_at <= ?', (now,)) as cursor:
+        self.reminder_scheduler = ReminderScheduler(pool, self.deliver_reminders)
+        self.user_manager = user_manager
+
+        # Доставленные уведомления копятся и удаляются пачками, а не отдельной транзакцией на каждое
+        self._sent = {'financial_goals': [], 'reminders': []}
+        self._flush_task = None
+
+    async def deliver_reminders(self, reminder_ids):
+        placeholders = ', '.join('?' * len(reminder_ids))
+        # Получатели всей пачки разрешаются в том же запросе, без отдельного SELECT на каждое напоминание
+        async with self.pool.reader() as db:
+            async with db.execute(f'''
+                SELECT r.id, u.telegram_id, r.message
+                FROM reminders r
+                LEFT JOIN users u ON u.id = r.user_id
+                WHERE r.id IN ({placeholders})
+            ''', list(reminder_ids)) as cursor:
                 reminders = await cursor.fetchall()
-                for reminder in reminders:
-                    reminder_id, user_id, message_text = reminder
-                    telegram_id = await self.user_manager.get_telegram_id(user_id)
-                    await self.bot.send_message(telegram_id, message_text)
-                    await db.execute('DELETE FROM reminders WHERE id = ?', (reminder_id,))
 
-            await db.commit()
+        failed_ids = []
+        for reminder_id, telegram_id, message_text in reminders:
+            if telegram_id is None:
+                logger.error("Не удалось найти получателя напоминания %s", reminder_id)
+                failed_ids.append(reminder_id)
+                continue
+            # Напоминание удаляется только после успешной отправки, иначе планируется повтор
+            await self.notifier.send(telegram_id, message_text,
+                                     on_delivered=partial(self._delete_sent, 'reminders', [reminder_id]),
+                                     on_failed=partial(self._reminder_failed, reminder_id))
+        return failed_ids
+
+    async def _reminder_failed(self, reminder_id):
+        retry_at = datetime.now() + timedelta(seconds=self.reminder_scheduler.retry_delay)
+        self.reminder_scheduler.add(reminder_id, retry_at)
+
+    async def check_goals(self, today=None):
+        today = (today or date.today()).isoformat()
+        last_deadline, last_id = '', 0
+
+        while True:
+            # Индекс по deadline отдаёт только наступившие цели; keyset по (deadline, id) пропускает уже обработанные
+            async with self.pool.reader() as db:
+                async with db.execute('''
+                    SELECT g.id, g.deadline, u.telegram_id, g.goal_name, g.target_amount, g.current_amount
+                    FROM financial_goals g
+                    JOIN users u ON u.id = g.user_id
+                    WHERE g.deadline <= ? AND (g.deadline, g.id) > (?, ?)
+                    ORDER BY g.deadline, g.id
+                    LIMIT ?
+                ''', (today, last_deadline, last_id, self.goal_batch_size)) as cursor:
+                    goals = await cursor.fetchall()
+
+            if not goals:
+                return
+
+            for goal_id, deadline, telegram_id, goal_name, target_amount, current_amount in goals:
+                remaining_amount = target_amount - current_amount
+                if remaining_amount > 0:
+                    message_text = f"Вы не достигли цели '{goal_name}'. Осталось собрать {remaining_amount}."
+                else:
+                    message_text = f"Поздравляем. Вы достигли цели '{goal_name}'."
 
-    async def check_goals(self):
-        now = datetime.now()
-        async with aiosqlite.connect(self.db_name) as db:
-            async with db.execute(
-                    'SELECT id, user_id, goal_name, target_amount, deadline, current_amount FROM financial_goals') as cursor:
-                goals = await cursor.fetchall()
+                message_text = message_text.replace(".", "\\.").replace("-", "\\-")
+                # Недоставленная цель остаётся в БД и будет обработана при следующем запуске
+                await self.notifier.send(telegram_id, message_text,
+                                         on_delivered=partial(self._delete_sent, 'financial_goals', [goal_id]))
 
-                for goal in goals:
-                    goal_id, user_id, goal_name, target_amount, deadline, current_amount = goal
-                    deadline_dt = datetime.strptime(deadline, '%Y-%m-%d')
-                    if deadline_dt <= now:
-                        remaining_amount = target_amount - current_amount
-                        if remaining_amount > 0:
-                            message_text = f"Вы не достигли цели '{goal_name}'. Осталось собрать {remaining_amount}."
-                        else:
-                            message_text = f"Поздравляем. Вы достигли цели '{goal_name}'."
-
-                        message_text = message_text.replace(".", "\\.").replace("-", "\\-")
-                        telegram_id = await self.user_manager.get_telegram_id(user_id)
-                        await self.bot.send_message(telegram_id, message_text)
-                        await db.execute('DELETE FROM financial_goals WHERE id = ?', (goal_id,))
+            last_deadline, last_id = goals[-1][1], goals[-1][0]
 
-            await db.commit()
+    async def _delete_sent(self, table, ids):
+        self._sent[table].extend(ids)
+        if sum(len(sent) for sent in self._sent.values()) >= self.delete_batch_size:
+            await self.flush_sent()
+        elif self._flush_task is None:
+            self._flush_task = asyncio.get_running_loop().create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.delete_interval)
+        self._flush_task = None
+        try:
+            await self.flush_sent()
+        except Exception:
+            logger.exception("Не удалось удалить доставленные уведомления")
+
+    async def flush_sent(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+
+        sent = {table: ids for table, ids in self._sent.items() if ids}
+        if not sent:
+            return
+        self._sent = {table: [] for table in self._sent}
+        # Отправка идёт без блокировки писателя, удаляем отправленное одной короткой транзакцией
+        try:
+            async with self.pool.writer() as db:
+                for table, ids in sent.items():
+                    for start in range(0, len(ids), self.delete_batch_size):
+                        chunk = ids[start:start + self.delete_batch_size]
+                        await db.execute(f'DELETE FROM {table} WHERE id IN ({", ".join("?" * len(chunk))})', chunk)
+                await db.commit()
+        except Exception:
+            # Неудалённые записи вернутся в буфер; иначе после перезапуска уведомление ушло бы повторно
+            for table, ids in sent.items():
+                self._sent[table][:0] = ids
+            raise
 
     async def set_financial_goal(self, telegram_id, goal_name, target_amount, deadline):
         user_id = await self.user_manager.get_user_id(telegram_id)
@@ -59,7 +135,7 @@ class GoalManager:
             raise ValueError("Дата должна быть в формате YYYY-MM-DD.")
 
         # Вставляем финансовую цель в базу данных
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self.pool.writer() as db:
             await db.execute('''
                 INSERT INTO financial_goals (user_id, goal_name, target_amount, deadline)
                 VALUES (?, ?, ?, ?)
@@ -74,16 +150,19 @@ class GoalManager:
         except ValueError:
             raise ValueError("Дата и время должны быть в формате YYYY-MM-DDTHH:MM:SS.")
 
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self.pool.writer() as db:
             await db.execute('''
                 INSERT INTO reminders (user_id, message, remind_at)
                 VALUES (?, ?, ?)
             ''', (user_id, message, remind_at_datetime))
             await db.commit()
 
+        # Своей очереди у воркера нет: напоминание из БД подхватывает процесс, в котором запущено расписание
+        self.reminder_scheduler.notify_new()
+
     async def get_financial_goals(self, telegram_id):
         user_id = await self.user_manager.get_user_id(telegram_id)
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self.pool.reader() as db:
             async with db.execute(
                     'SELECT id, goal_name, target_amount, deadline, current_amount FROM financial_goals WHERE user_id = ?',
                     (user_id,)) as cursor:
@@ -101,7 +180,7 @@ class GoalManager:
 
     async def contribute_to_goal(self, telegram_id, goal_id: int, amount: float):
         user_id = await self.user_manager.get_user_id(telegram_id)
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self.pool.writer() as db:
             async with db.execute('SELECT current_amount FROM financial_goals WHERE id = ? AND user_id = ?',
                                   (goal_id, user_id)) as cursor:
                 row = await cursor.fetchone()
@@ -115,7 +194,14 @@ class GoalManager:
                 else:
                     raise ValueError(f"Финансовая цель с id {goal_id} для пользователя {user_id} не найдена.")
 
-    def start(self):
-        self.scheduler.add_job(self.send_reminders, 'interval', minutes=1)
-        self.scheduler.add_job(self.check_goals, 'interval', minutes=1)
+    async def start(self):
+        await self.reminder_scheduler.start()
+        # Сроки целей — это даты, поэтому достаточно проверки на границе суток и одной при запуске
+        self.scheduler.add_job(self.check_goals, 'cron', hour=0, minute=0, second=5, next_run_time=datetime.now())
         self.scheduler.start()
+
+    async def stop(self):
+        await self.reminder_scheduler.stop()
+        if self.scheduler.running:
+            self.scheduler.shutdown(wait=False)
+        await self.flush_sent()
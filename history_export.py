@@ -0,0 +1,139 @@
+import asyncio
+import codecs
+import csv
+import gzip
+import io
+import json
+import logging
+import tempfile
+from datetime import date
+
+from finance_manager import EXPORT_BATCH_SIZE
+
+logger = logging.getLogger(__name__)
+
+# Столбцы совпадают с форматом /import, поэтому выгрузку можно загрузить обратно
+EXPORT_COLUMNS = ('date', 'type', 'category', 'amount', 'currency', 'note')
+# Небольшие выгрузки остаются в памяти, крупные уходят на диск
+EXPORT_SPOOL_BYTES = 1024 * 1024
+
+
+class CsvExportWriter:
+    extension = 'csv'
+
+    def __init__(self, file):
+        self.file = file
+        self._buffer = io.StringIO()
+        self._writer = csv.writer(self._buffer)
+        # BOM нужен Excel, чтобы открыть кириллицу в UTF-8
+        file.write(codecs.BOM_UTF8)
+        self.write_rows([EXPORT_COLUMNS])
+
+    def write_rows(self, rows):
+        self._writer.writerows(rows)
+        self.file.write(self._buffer.getvalue().encode('utf-8'))
+        self._buffer.seek(0)
+        self._buffer.truncate()
+
+    def close(self):
+        pass
+
+
+class JsonLinesExportWriter:
+    extension = 'jsonl.gz'
+
+    def __init__(self, file):
+        self._gzip = gzip.GzipFile(fileobj=file, mode='wb')
+
+    def write_rows(self, rows):
+        self._gzip.write(''.join(
+            json.dumps(dict(zip(EXPORT_COLUMNS, row)), ensure_ascii=False) + '\n' for row in rows
+        ).encode('utf-8'))
+
+    def close(self):
+        # Закрывает только поток gzip, сам файл остаётся открытым для отправки
+        self._gzip.close()
+
+
+EXPORT_WRITERS = {
+    'csv': CsvExportWriter,
+    'jsonl': JsonLinesExportWriter,
+}
+
+
+def upload_file(file):
+    # До Python 3.11 SpooledTemporaryFile не наследует io.IOBase, и aiogram не принимает его как файл
+    return file if isinstance(file, io.IOBase) else file._file
+
+
+class ExportQueue:
+    def __init__(self, finance_manager, workers: int = 1, max_pending: int = 100,
+                 batch_size: int = EXPORT_BATCH_SIZE, spool_bytes: int = EXPORT_SPOOL_BYTES):
+        self.finance_manager = finance_manager
+        self.workers = workers
+        self.batch_size = batch_size
+        self.spool_bytes = spool_bytes
+
+        self._queue = asyncio.Queue(max_pending)
+        self._pending_users = set()
+        self._tasks = []
+
+    def qsize(self) -> int:
+        return self._queue.qsize()
+
+    def start(self):
+        if not self._tasks:
+            loop = asyncio.get_running_loop()
+            self._tasks = [loop.create_task(self._run()) for _ in range(self.workers)]
+
+    async def close(self):
+        # Незавершённые выгрузки не переживают перезапуск: пользователь может запросить их заново
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def submit(self, telegram_id, export_format, deliver, on_failed=None) -> int:
+        if not self._tasks:
+            raise RuntimeError("Очередь выгрузок не запущена.")
+        if export_format not in EXPORT_WRITERS:
+            raise ValueError(f"Неизвестный формат выгрузки: {export_format}")
+        if telegram_id in self._pending_users:
+            raise ValueError("Выгрузка для пользователя уже в очереди.")
+
+        position = self._queue.qsize()
+        try:
+            self._queue.put_nowait((telegram_id, export_format, deliver, on_failed))
+        except asyncio.QueueFull:
+            raise RuntimeError("Очередь выгрузок переполнена.")
+        self._pending_users.add(telegram_id)
+        return position
+
+    async def _run(self):
+        while True:
+            telegram_id, export_format, deliver, on_failed = await self._queue.get()
+            try:
+                await self._export(telegram_id, export_format, deliver)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Не удалось выгрузить историю пользователя %s", telegram_id)
+                if on_failed is not None:
+                    try:
+                        await on_failed()
+                    except Exception:
+                        logger.exception("Ошибка уведомления о неудачной выгрузке")
+            finally:
+                self._pending_users.discard(telegram_id)
+                self._queue.task_done()
+
+    async def _export(self, telegram_id, export_format, deliver):
+        loop = asyncio.get_running_loop()
+        with tempfile.SpooledTemporaryFile(max_size=self.spool_bytes) as file:
+            writer = EXPORT_WRITERS[export_format](file)
+            # Форматирование и сжатие идут в потоке, цикл событий свободен для интерактивных хендлеров
+            async for rows in self.finance_manager.iter_transactions(telegram_id, self.batch_size):
+                await loop.run_in_executor(None, writer.write_rows, rows)
+            await loop.run_in_executor(None, writer.close)
+            file.seek(0)
+            await deliver(file, f'transactions-{date.today().isoformat()}.{writer.extension}')
@@ -1,50 +1,202 @@
+import asyncio
 import logging
 import os
 
 from aiogram import Bot, Dispatcher
-from aiogram.contrib.fsm_storage.memory import MemoryStorage
 from aiogram.contrib.middlewares.logging import LoggingMiddleware
 from aiogram.types import ParseMode
 from aiogram.utils import executor
 from dotenv import load_dotenv
 
+from archive import ArchiveManager
 from bot_controller import BotController
+from chart_cache import ChartCache
+from chart_renderer import ChartRenderer
+from connection_pool import ConnectionPool
 from currency_manager import CurrencyManager
 from database_manager import DatabaseManager
 from finance_manager import FinanceManager
 from goal_manager import GoalManager
+from history_export import ExportQueue
+from metrics import Gauge, MetricsMiddleware, MetricsServer
+from notification_dispatcher import NotificationDispatcher
+from rate_store import RateStore
+from sqlite_storage import SQLiteStorage
+from sharding import ShardRouter, ShardingDispatcher, run_worker
 from user_manager import UserManager
+from webhook import WebhookServer, run_webhook
+from write_queue import WriteQueue
 
 load_dotenv()
 
 API_TOKEN = os.getenv('API_TOKEN')
+DB_PATH = os.getenv('DB_PATH', './app_data/finances.db')
+DB_READERS = int(os.getenv('DB_READERS', '4'))
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', '10000'))
+WRITE_BATCH_SIZE = int(os.getenv('WRITE_BATCH_SIZE', '256'))
+WRITE_FLUSH_INTERVAL = float(os.getenv('WRITE_FLUSH_INTERVAL', '0.005'))
+CHART_WORKERS = int(os.getenv('CHART_WORKERS', '2'))
+CHART_TIMEOUT = float(os.getenv('CHART_TIMEOUT', '10'))
+CHART_CACHE_BYTES = int(os.getenv('CHART_CACHE_BYTES', str(32 * 1024 * 1024)))
+RATES_SNAPSHOT_PATH = os.getenv('RATES_SNAPSHOT_PATH', './app_data/cbr_rates.json')
+RATES_REFRESH_INTERVAL = int(os.getenv('RATES_REFRESH_INTERVAL', '3600'))
+CHART_CACHE_DIR = os.getenv('CHART_CACHE_DIR', './app_data/charts') or None
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+BOT_WORKERS = int(os.getenv('BOT_WORKERS', '0'))
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8080'))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET') or None
+WEBHOOK_MAX_IN_FLIGHT = int(os.getenv('WEBHOOK_MAX_IN_FLIGHT', '100'))
+FSM_CACHE_SIZE = int(os.getenv('FSM_CACHE_SIZE', '10000'))
+NOTIFY_WORKERS = int(os.getenv('NOTIFY_WORKERS', '4'))
+NOTIFY_GLOBAL_RATE = float(os.getenv('NOTIFY_GLOBAL_RATE', '30'))
+NOTIFY_PER_CHAT_RATE = float(os.getenv('NOTIFY_PER_CHAT_RATE', '1'))
+EXPORT_WORKERS = int(os.getenv('EXPORT_WORKERS', '1'))
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+# Пустое значение отключает метрики вместе с замером запросов к БД
+METRICS_PORT = os.getenv('METRICS_PORT', '9100')
+
+# Пустое значение отключает архивацию старых операций
+ARCHIVE_DIR = os.getenv('ARCHIVE_DIR', './app_data/archive') or None
+ARCHIVE_AFTER_DAYS = int(os.getenv('ARCHIVE_AFTER_DAYS', '730'))
+ARCHIVE_INTERVAL_HOURS = float(os.getenv('ARCHIVE_INTERVAL_HOURS', '24'))
 
 logging.basicConfig(level=logging.INFO)
 
+pool = ConnectionPool(DB_PATH, readers=DB_READERS, instrument=bool(METRICS_PORT), archive_dir=ARCHIVE_DIR)
+rate_store = RateStore(pool)
+write_queue = WriteQueue(pool, max_batch=WRITE_BATCH_SIZE, flush_interval=WRITE_FLUSH_INTERVAL)
+
 bot = Bot(token=API_TOKEN, parse_mode=ParseMode.MARKDOWN_V2)
-storage = MemoryStorage()
+# Состояния диалогов хранятся в той же БД и переживают перезапуск бота
+storage = SQLiteStorage(pool, write_queue, cache_size=FSM_CACHE_SIZE)
 dp = Dispatcher(bot, storage=storage)
 dp.middleware.setup(LoggingMiddleware())
+dp.middleware.setup(MetricsMiddleware())
+
+chart_renderer = ChartRenderer(max_workers=CHART_WORKERS, timeout=CHART_TIMEOUT)
+chart_cache = ChartCache(max_bytes=CHART_CACHE_BYTES, disk_dir=CHART_CACHE_DIR)
+
+# Глобальный лимит Telegram общий для бота, поэтому в шардированном режиме делится между воркерами
+notification_dispatcher = NotificationDispatcher(bot, workers=NOTIFY_WORKERS,
+                                                 global_rate=NOTIFY_GLOBAL_RATE / max(1, BOT_WORKERS),
+                                                 per_chat_rate=NOTIFY_PER_CHAT_RATE)
+
+user_manager = UserManager(pool, cache_size=USER_CACHE_SIZE)
+finance_manager = FinanceManager(pool, user_manager, write_queue, chart_renderer, chart_cache, rate_store,
+                                 notification_dispatcher)
+currency_manager = CurrencyManager(snapshot_path=RATES_SNAPSHOT_PATH, refresh_interval=RATES_REFRESH_INTERVAL,
+                                   rate_store=rate_store)
+db_manager = DatabaseManager(pool)
+goal_manager = GoalManager(notification_dispatcher, pool, user_manager)
+archive_manager = ArchiveManager(pool, max_age_days=ARCHIVE_AFTER_DAYS,
+                                 interval_hours=ARCHIVE_INTERVAL_HOURS) if ARCHIVE_DIR else None
+
+# Выгрузки истории выполняются по очереди небольшим числом воркеров, чтобы не отнимать время у диалогов
+export_queue = ExportQueue(finance_manager, workers=EXPORT_WORKERS)
 
-user_manager = UserManager("./app_data/finances.db")
-finance_manager = FinanceManager("./app_data/finances.db")
-currency_manager = CurrencyManager()
-db_manager = DatabaseManager('./app_data/finances.db')
-goal_manager = GoalManager(bot, './app_data/finances.db')
+bot_controller = BotController(bot, dp, finance_manager, currency_manager, db_manager, goal_manager, user_manager,
+                               export_queue)
 
-bot_controller = BotController(bot, dp, finance_manager, currency_manager, db_manager, goal_manager, user_manager)
+Gauge('bot_notification_queue_depth', 'Уведомлений в очереди на отправку', notification_dispatcher.qsize)
+Gauge('bot_write_queue_depth', 'Записей в очереди на запись в БД', write_queue.qsize)
+Gauge('bot_export_queue_depth', 'Выгрузок истории в очереди', export_queue.qsize)
+metrics_server = MetricsServer(host=METRICS_HOST, port=int(METRICS_PORT)) if METRICS_PORT else None
+
+background_jobs = True
 
 
 async def on_startup(dispatcher):
+    # Процессы отрисовки запускаются первыми, до появления фоновых потоков
+    await chart_renderer.start()
+
     await bot_controller.set_commands()
 
+    await pool.open()
     await db_manager.init_db()
-
-    goal_manager.start()
+    write_queue.start()
+    storage.start()
+    notification_dispatcher.start()
+    export_queue.start()
+    if metrics_server is not None:
+        await metrics_server.start()
+
+    if background_jobs:
+        await goal_manager.start()
+        if archive_manager is not None:
+            archive_manager.start()
+    currency_manager.start()
 
     print("Бот успешно запущен!")
 
 
+async def on_shutdown(dispatcher):
+    if metrics_server is not None:
+        await metrics_server.close()
+    await goal_manager.stop()
+    if archive_manager is not None:
+        archive_manager.stop()
+    currency_manager.stop()
+    await finance_manager.join_alerts()
+    # Колбэки доставки пишут в БД, поэтому очередь уведомлений закрывается раньше пула
+    await notification_dispatcher.close()
+    # Подтверждения, пришедшие уже после остановки планировщиков, удаляются последней пачкой
+    await goal_manager.flush_sent()
+    await export_queue.close()
+
+    # Executor закрывает хранилище уже после on_shutdown, поэтому несохранённые состояния сбрасываются здесь
+    await storage.close()
+    await write_queue.close()
+    await pool.close()
+    chart_renderer.close()
+
+
+def run_shard_worker(index, queue):
+    global background_jobs
+    # Напоминания и цели рассылает только первый воркер, иначе каждое уведомление ушло бы N раз
+    background_jobs = index == 0
+    # Каждый воркер отдаёт свои метрики на отдельном порту: METRICS_PORT + номер воркера
+    if metrics_server is not None:
+        metrics_server.port += index
+    run_worker(queue, dp, on_startup, on_shutdown, max_in_flight=WEBHOOK_MAX_IN_FLIGHT)
+
+
+def run_sharded():
+    router = ShardRouter(run_shard_worker, BOT_WORKERS)
+    router.start()
+
+    front_dp = ShardingDispatcher(Bot(token=API_TOKEN), router)
+
+    async def start_front(dispatcher):
+        print(f"Бот запущен с {BOT_WORKERS} воркерами")
+
+    async def stop_front(dispatcher):
+        await router.close()
+
+    if BOT_MODE == 'webhook':
+        server = WebhookServer(front_dp, host=WEBHOOK_HOST, port=WEBHOOK_PORT, path=WEBHOOK_PATH,
+                               max_in_flight=WEBHOOK_MAX_IN_FLIGHT, secret_token=WEBHOOK_SECRET)
+        asyncio.get_event_loop().run_until_complete(run_webhook(server, start_front, stop_front,
+                                                                webhook_url=WEBHOOK_URL))
+    else:
+        executor.start_polling(front_dp, on_startup=start_front, on_shutdown=stop_front, skip_updates=True)
+
+
 if __name__ == '__main__':
-    executor.start_polling(dp, on_startup=on_startup, skip_updates=True)
+    if BOT_MODE not in ('polling', 'webhook'):
+        raise ValueError(f"Неизвестный режим BOT_MODE: {BOT_MODE}")
+
+    if BOT_WORKERS > 0:
+        # Воркеры создаются fork до запуска цикла событий фронтового процесса
+        run_sharded()
+    elif BOT_MODE == 'webhook':
+        server = WebhookServer(dp, host=WEBHOOK_HOST, port=WEBHOOK_PORT, path=WEBHOOK_PATH,
+                               max_in_flight=WEBHOOK_MAX_IN_FLIGHT, secret_token=WEBHOOK_SECRET)
+        # Тот же цикл событий, что и у executor: к нему уже привязаны примитивы синхронизации менеджеров
+        asyncio.get_event_loop().run_until_complete(run_webhook(server, on_startup, on_shutdown,
+                                                                webhook_url=WEBHOOK_URL))
+    else:
+        executor.start_polling(dp, on_startup=on_startup, on_shutdown=on_shutdown, skip_updates=True)
 
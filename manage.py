@@ -0,0 +1,76 @@
+import argparse
+import asyncio
+import logging
+import os
+
+from dotenv import load_dotenv
+
+from archive import ArchiveManager
+from connection_pool import ConnectionPool
+from database_manager import DatabaseManager
+from rate_store import RateStore
+
+load_dotenv()
+
+logging.basicConfig(level=logging.INFO)
+
+
+async def rebuild_rollups(pool, args):
+    await DatabaseManager(pool).rebuild_category_totals()
+    print("Сводная таблица category_totals пересобрана.")
+
+
+async def import_rates(pool, args):
+    imported = await RateStore(pool).import_xml_files(args.files)
+    print(f"Импортировано курсов: {imported}.")
+
+
+async def archive(pool, args):
+    moved = await ArchiveManager(pool, max_age_days=args.age_days, attach_grace=0).run()
+    print(f"Перенесено в архив операций: {moved}.")
+
+
+async def enable_incremental_vacuum(pool, args):
+    # Режим auto_vacuum существующей БД меняется только полным VACUUM; бот на это время нужно остановить
+    async with pool.writer() as db:
+        await db.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        await db.execute('VACUUM')
+    print("Инкрементальная очистка включена.")
+
+
+async def run(args):
+    pool = ConnectionPool(args.db, readers=1, archive_dir=args.archive_dir or None)
+    await pool.open()
+    try:
+        await DatabaseManager(pool).init_db()
+        await args.handler(pool, args)
+    finally:
+        await pool.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Служебные команды FinanceMate")
+    parser.add_argument('--db', default=os.getenv('DB_PATH', './app_data/finances.db'))
+    parser.add_argument('--archive-dir', default=os.getenv('ARCHIVE_DIR', './app_data/archive'))
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    rebuild = commands.add_parser('rebuild-rollups', help="Пересобрать сводную таблицу по категориям")
+    rebuild.set_defaults(handler=rebuild_rollups)
+
+    rates = commands.add_parser('import-rates', help="Импортировать архивные XML-файлы курсов ЦБ РФ")
+    rates.add_argument('files', nargs='+')
+    rates.set_defaults(handler=import_rates)
+
+    archive_parser = commands.add_parser('archive', help="Перенести старые операции в архивные БД по годам")
+    archive_parser.add_argument('--age-days', type=int, default=int(os.getenv('ARCHIVE_AFTER_DAYS', '730')))
+    archive_parser.set_defaults(handler=archive)
+
+    vacuum = commands.add_parser('enable-incremental-vacuum', help="Включить auto_vacuum=INCREMENTAL (полный VACUUM)")
+    vacuum.set_defaults(handler=enable_incremental_vacuum)
+
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,272 @@
+import re
+import time
+from bisect import bisect_left
+
+from aiogram.dispatcher.handler import current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from aiohttp import web
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in (*zip(names, values), *extra)]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Timer:
+    __slots__ = ('_child', '_started')
+
+    def __init__(self, child):
+        self._child = child
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._child.observe(time.perf_counter() - self._started)
+
+
+class _HistogramChild:
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # Счётчики корзин выделяются один раз; наблюдение — поиск корзины и два инкремента без блокировок,
+        # все вызовы идут из одного потока цикла событий
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def time(self):
+        return _Timer(self)
+
+
+class Histogram:
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS, registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._children = {}
+        if not self.labelnames:
+            self._children[()] = _HistogramChild(self.buckets)
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def labels(self, *values) -> _HistogramChild:
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"Метрика {self.name} ожидает метки {self.labelnames}")
+            child = self._children[values] = _HistogramChild(self.buckets)
+        return child
+
+    def observe(self, value: float):
+        self._children[()].observe(value)
+
+    def time(self):
+        return self._children[()].time()
+
+    def collect(self):
+        for values, child in list(self._children.items()):
+            cumulative = 0
+            for bound, count in zip((*self.buckets, '+Inf'), child.counts):
+                cumulative += count
+                le = bound if bound == '+Inf' else _format_value(float(bound))
+                yield f'{self.name}_bucket{_format_labels(self.labelnames, values, [("le", le)])} {cumulative}'
+            labels = _format_labels(self.labelnames, values)
+            yield f'{self.name}_sum{labels} {_format_value(child.sum)}'
+            yield f'{self.name}_count{labels} {child.count}'
+
+
+class Counter:
+    type = 'counter'
+
+    def __init__(self, name: str, documentation: str, registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.value = 0
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def collect(self):
+        yield f'{self.name}_total {_format_value(self.value)}'
+
+
+class Gauge:
+    type = 'gauge'
+
+    def __init__(self, name: str, documentation: str, function, registry=None):
+        self.name = name
+        self.documentation = documentation
+        # Значение вычисляется только при опросе, поэтому на горячем пути не стоит ничего
+        self.function = function
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def collect(self):
+        yield f'{self.name} {_format_value(self.function())}'
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Метрика {metric.name} уже зарегистрирована")
+        self._metrics[metric.name] = metric
+
+    def unregister(self, name: str):
+        self._metrics.pop(name, None)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            lines.extend(metric.collect())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+
+HANDLER_SECONDS = Histogram('bot_handler_seconds', 'Время обработки апдейта хендлером', ['handler'])
+DB_QUERY_SECONDS = Histogram('bot_db_query_seconds', 'Время выполнения SQL-запроса', ['statement'])
+CHART_RENDER_SECONDS = Histogram('bot_chart_render_seconds', 'Время отрисовки диаграммы')
+CHART_RENDER_REJECTED = Counter('bot_chart_render_rejected', 'Отказы в отрисовке из-за перегрузки пула')
+CBR_FETCH_SECONDS = Histogram('bot_cbr_fetch_seconds', 'Время загрузки курсов ЦБ РФ', ['result'])
+
+_STATEMENT_RE = re.compile(
+    r'^\s*(?=(SELECT|INSERT|UPDATE|DELETE|REPLACE|CREATE|DROP|ALTER|PRAGMA|WITH)\b)'
+    r'(?:.*?\b(?:FROM|INTO|UPDATE|TABLE)\s+(?:IF\s+NOT\s+EXISTS\s+)?(\w+))?',
+    re.IGNORECASE | re.DOTALL)
+MAX_STATEMENT_LABELS = 1000
+_statement_labels = {}
+
+
+def statement_label(sql: str) -> str:
+    # Все запросы проекта — константные строки, поэтому метка разбирается один раз на текст запроса
+    label = _statement_labels.get(sql)
+    if label is None:
+        match = _STATEMENT_RE.match(sql)
+        if match is None:
+            label = 'other'
+        elif match.group(1).upper() == 'PRAGMA':
+            label = 'PRAGMA'
+        else:
+            label = ' '.join(filter(None, (match.group(1).upper(), match.group(2))))
+        if len(_statement_labels) < MAX_STATEMENT_LABELS:
+            _statement_labels[sql] = label
+    return label
+
+
+class _TimedResult:
+    def __init__(self, coroutine, child):
+        self._coroutine = coroutine
+        self._child = child
+        self._cursor = None
+
+    async def _run(self):
+        started = time.perf_counter()
+        try:
+            return await self._coroutine
+        finally:
+            self._child.observe(time.perf_counter() - started)
+
+    def __await__(self):
+        return self._run().__await__()
+
+    async def __aenter__(self):
+        self._cursor = await self._run()
+        return self._cursor
+
+    async def __aexit__(self, *exc_info):
+        await self._cursor.close()
+
+
+class InstrumentedConnection:
+    def __init__(self, db, histogram=DB_QUERY_SECONDS):
+        self._db = db
+        self._histogram = histogram
+
+    def __getattr__(self, name):
+        return getattr(self._db, name)
+
+    def execute(self, sql, parameters=None):
+        return _TimedResult(self._db.execute(sql, parameters), self._histogram.labels(statement_label(sql)))
+
+    def executemany(self, sql, parameters):
+        return _TimedResult(self._db.executemany(sql, parameters), self._histogram.labels(statement_label(sql)))
+
+
+class MetricsMiddleware(BaseMiddleware):
+    def __init__(self, histogram=HANDLER_SECONDS):
+        super().__init__()
+        self.histogram = histogram
+
+    @staticmethod
+    def _start(data):
+        data['_metrics_handler'] = getattr(current_handler.get(), '__name__', 'unknown')
+        data['_metrics_started'] = time.perf_counter()
+
+    def _finish(self, data):
+        started = data.pop('_metrics_started', None)
+        if started is not None:
+            self.histogram.labels(data.pop('_metrics_handler')).observe(time.perf_counter() - started)
+
+    async def on_process_message(self, message, data):
+        self._start(data)
+
+    async def on_post_process_message(self, message, results, data):
+        self._finish(data)
+
+    async def on_process_callback_query(self, callback_query, data):
+        self._start(data)
+
+    async def on_post_process_callback_query(self, callback_query, results, data):
+        self._finish(data)
+
+
+class MetricsServer:
+    def __init__(self, registry=REGISTRY, host: str = '127.0.0.1', port: int = 9100, path: str = '/metrics'):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self.path = path
+        self._runner = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get(self.path, self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def _handle(self, request):
+        return web.Response(body=self.registry.render().encode('utf-8'), headers={'Content-Type': CONTENT_TYPE})
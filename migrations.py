@@ -0,0 +1,244 @@
+def rebuild_category_totals_statements(income: str = 'income', expenses: str = 'expenses'):
+    # Источниками могут быть подзапросы, объединяющие основную таблицу с архивами
+    return [
+        'DELETE FROM category_totals',
+        f'''
+        INSERT INTO category_totals (user_id, kind, category, currency, month, total, count)
+        SELECT user_id, 'income', COALESCE(category, ''), COALESCE(currency, ''), COALESCE(substr(date, 1, 7), ''),
+               COALESCE(SUM(amount), 0), COUNT(*)
+        FROM {income}
+        WHERE user_id IS NOT NULL
+        GROUP BY 1, 2, 3, 4, 5
+        ''',
+        f'''
+        INSERT INTO category_totals (user_id, kind, category, currency, month, total, count)
+        SELECT user_id, 'expense', COALESCE(category, ''), COALESCE(currency, ''), COALESCE(substr(date, 1, 7), ''),
+               COALESCE(SUM(amount), 0), COUNT(*)
+        FROM {expenses}
+        WHERE user_id IS NOT NULL
+        GROUP BY 1, 2, 3, 4, 5
+        ''',
+    ]
+
+
+REBUILD_CATEGORY_TOTALS = rebuild_category_totals_statements()
+
+SEARCH_INDEX_COLUMNS = 'rowid, category, note, currency, owner'
+
+
+def search_text(value: str) -> str:
+    # unicode61 не считает «ё» вариантом «е», поэтому в индекс попадает текст с заменой
+    return f"replace(replace({value}, 'ё', 'е'), 'Ё', 'Е')"
+
+
+def search_index_statements(table: str, kind: int):
+    def row(prefix):
+        return (f"{prefix}id * 2 + {kind}, {search_text(prefix + 'category')}, {search_text(prefix + 'note')}, "
+                f"{prefix}currency, 'u' || {prefix}user_id")
+
+    # Из индекса без содержимого строка удаляется командой 'delete' с прежними значениями столбцов
+    return [
+        f'INSERT INTO transactions_fts ({SEARCH_INDEX_COLUMNS}) SELECT {row("")} FROM {table}',
+        f'''
+        CREATE TRIGGER IF NOT EXISTS {table}_search_insert AFTER INSERT ON {table} BEGIN
+            INSERT INTO transactions_fts ({SEARCH_INDEX_COLUMNS}) VALUES ({row('new.')});
+        END
+        ''',
+        f'''
+        CREATE TRIGGER IF NOT EXISTS {table}_search_delete AFTER DELETE ON {table} BEGIN
+            INSERT INTO transactions_fts (transactions_fts, {SEARCH_INDEX_COLUMNS}) VALUES ('delete', {row('old.')});
+        END
+        ''',
+        f'''
+        CREATE TRIGGER IF NOT EXISTS {table}_search_update AFTER UPDATE OF user_id, category, note, currency ON {table}
+        BEGIN
+            INSERT INTO transactions_fts (transactions_fts, {SEARCH_INDEX_COLUMNS}) VALUES ('delete', {row('old.')});
+            INSERT INTO transactions_fts ({SEARCH_INDEX_COLUMNS}) VALUES ({row('new.')});
+        END
+        ''',
+    ]
+
+
+MIGRATIONS = [
+    (1, [
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            telegram_id INTEGER NOT NULL UNIQUE
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS income (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            category TEXT,
+            amount REAL,
+            currency TEXT,
+            date TEXT,
+            FOREIGN KEY(user_id) REFERENCES users(id)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS expenses (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            category TEXT,
+            amount REAL,
+            currency TEXT,
+            date TEXT,
+            FOREIGN KEY(user_id) REFERENCES users(id)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS financial_goals (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            goal_name TEXT,
+            target_amount REAL,
+            deadline DATE,
+            current_amount REAL DEFAULT 0,
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS reminders (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            message TEXT,
+            remind_at TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        )
+        ''',
+    ]),
+    (2, [
+        'CREATE INDEX IF NOT EXISTS idx_income_user_date ON income (user_id, date)',
+        'CREATE INDEX IF NOT EXISTS idx_expenses_user_date ON expenses (user_id, date)',
+        'CREATE INDEX IF NOT EXISTS idx_reminders_remind_at ON reminders (remind_at)',
+        'CREATE INDEX IF NOT EXISTS idx_financial_goals_deadline ON financial_goals (deadline)',
+        'CREATE INDEX IF NOT EXISTS idx_financial_goals_user ON financial_goals (user_id)',
+    ]),
+    (3, [
+        '''
+        CREATE TABLE IF NOT EXISTS category_totals (
+            user_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            category TEXT NOT NULL,
+            currency TEXT NOT NULL,
+            month TEXT NOT NULL,
+            total REAL NOT NULL DEFAULT 0,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, kind, category, currency, month)
+        ) WITHOUT ROWID
+        ''',
+        *REBUILD_CATEGORY_TOTALS,
+    ]),
+    (4, [
+        'ALTER TABLE users ADD COLUMN data_version INTEGER NOT NULL DEFAULT 0',
+    ]),
+    (5, [
+        '''
+        CREATE TABLE IF NOT EXISTS exchange_rates (
+            date TEXT NOT NULL,
+            code TEXT NOT NULL,
+            value REAL NOT NULL,
+            nominal INTEGER NOT NULL,
+            PRIMARY KEY (code, date)
+        ) WITHOUT ROWID
+        ''',
+    ]),
+    (6, [
+        '''
+        CREATE TABLE IF NOT EXISTS fsm_storage (
+            chat TEXT NOT NULL,
+            user TEXT NOT NULL,
+            state TEXT,
+            data TEXT NOT NULL DEFAULT '{}',
+            bucket TEXT NOT NULL DEFAULT '{}',
+            PRIMARY KEY (chat, user)
+        ) WITHOUT ROWID
+        ''',
+    ]),
+    (7, [
+        '''
+        CREATE TABLE IF NOT EXISTS budgets (
+            user_id INTEGER NOT NULL,
+            category TEXT NOT NULL,
+            amount REAL NOT NULL,
+            currency TEXT NOT NULL,
+            PRIMARY KEY (user_id, category)
+        ) WITHOUT ROWID
+        ''',
+        # Уникальный ключ гарантирует одно уведомление на порог в месяц, даже если расходы записаны одним пакетом
+        '''
+        CREATE TABLE IF NOT EXISTS budget_alerts (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            category TEXT NOT NULL,
+            month TEXT NOT NULL,
+            threshold REAL NOT NULL,
+            budget REAL NOT NULL,
+            spent REAL NOT NULL,
+            currency TEXT NOT NULL,
+            notified INTEGER NOT NULL DEFAULT 0,
+            UNIQUE (user_id, category, month, threshold, budget)
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_budget_alerts_pending ON budget_alerts (user_id) WHERE notified = 0',
+    ]),
+    (8, [
+        'ALTER TABLE income ADD COLUMN note TEXT',
+        'ALTER TABLE expenses ADD COLUMN note TEXT',
+        # Индекс без хранения текста: значения берутся из самих таблиц операций. rowid = id * 2 для доходов
+        # и id * 2 + 1 для расходов, owner — токен владельца, сужающий совпадения до одного пользователя
+        '''
+        CREATE VIRTUAL TABLE IF NOT EXISTS transactions_fts USING fts5(
+            category, note, currency, owner,
+            content = '', columnsize = 0, tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3'
+        )
+        ''',
+        *search_index_statements('income', 0),
+        *search_index_statements('expenses', 1),
+    ]),
+]
+
+
+async def get_schema_version(db) -> int:
+    async with db.execute('SELECT MAX(version) FROM schema_version') as cursor:
+        row = await cursor.fetchone()
+        return row[0] or 0
+
+
+async def apply_migrations(db, migrations=None) -> int:
+    migrations = sorted(migrations if migrations is not None else MIGRATIONS, key=lambda step: step[0])
+
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            applied_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    await db.commit()
+
+    current_version = await get_schema_version(db)
+    for version, statements in migrations:
+        if version <= current_version:
+            continue
+
+        # Каждая миграция применяется атомарно вместе с записью о её версии. IMMEDIATE сразу берёт блокировку
+        # записи, а повторная проверка версии не даёт параллельному процессу применить ту же миграцию дважды
+        await db.execute('BEGIN IMMEDIATE')
+        try:
+            if await get_schema_version(db) >= version:
+                await db.commit()
+                current_version = version
+                continue
+            for statement in statements:
+                await db.execute(statement)
+            await db.execute('INSERT INTO schema_version (version) VALUES (?)', (version,))
+            await db.commit()
+        except BaseException:
+            await db.rollback()
+            raise
+        current_version = version
+
+    return current_version
@@ -0,0 +1,139 @@
+import asyncio
+import logging
+
+import aiohttp
+from aiogram.utils.exceptions import NetworkError, RetryAfter, TelegramAPIError
+
+from lru_cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = None
+
+    def reserve(self, now: float) -> float:
+        # Токен резервируется сразу, даже в долг, поэтому конкурирующие воркеры встают в очередь, а не в гонку
+        if self._updated is not None:
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        self._tokens -= 1
+        return max(0.0, -self._tokens / self.rate)
+
+    async def acquire(self):
+        delay = self.reserve(asyncio.get_running_loop().time())
+        if delay:
+            await asyncio.sleep(delay)
+
+
+class NotificationDispatcher:
+    def __init__(self, bot, workers: int = 4, global_rate: float = 30, per_chat_rate: float = 1,
+                 per_chat_burst: float = 1, max_retries: int = 5, retry_delay: float = 1.0,
+                 max_queue: int = 10000, chat_buckets: int = 10000):
+        self.bot = bot
+        self.workers = workers
+        self.per_chat_rate = per_chat_rate
+        self.per_chat_burst = per_chat_burst
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+
+        self._global_bucket = TokenBucket(global_rate)
+        # Простаивающий бакет чата всё равно полон, поэтому вытеснение давно молчавших чатов безопасно
+        self._chat_buckets = LRUCache(chat_buckets)
+        self._queue = asyncio.Queue(max_queue)
+        self._tasks = []
+        self._paused_until = 0.0
+        self.delivered = 0
+        self.failed = 0
+
+    def qsize(self) -> int:
+        return self._queue.qsize()
+
+    def start(self):
+        if self._tasks:
+            return
+        loop = asyncio.get_running_loop()
+        self._tasks = [loop.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def send(self, chat_id, text, on_delivered=None, on_failed=None, **kwargs):
+        if not self._tasks:
+            raise RuntimeError("Очередь уведомлений не запущена.")
+        # При переполненной очереди отправитель ждёт, а не копит уведомления в памяти
+        await self._queue.put((chat_id, text, kwargs, on_delivered, on_failed))
+
+    async def join(self):
+        await self._queue.join()
+
+    async def close(self, timeout: float = 10):
+        if not self._tasks:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Не отправлено уведомлений при остановке: %s", self._queue.qsize())
+
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _worker(self):
+        while True:
+            chat_id, text, kwargs, on_delivered, on_failed = await self._queue.get()
+            try:
+                if await self._deliver(chat_id, text, kwargs):
+                    self.delivered += 1
+                    callback = on_delivered
+                else:
+                    self.failed += 1
+                    callback = on_failed
+                if callback is not None:
+                    await callback()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Ошибка обработки уведомления для чата %s", chat_id)
+            finally:
+                self._queue.task_done()
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = TokenBucket(self.per_chat_rate, self.per_chat_burst)
+            self._chat_buckets.put(chat_id, bucket)
+        return bucket
+
+    async def _deliver(self, chat_id, text, kwargs) -> bool:
+        loop = asyncio.get_running_loop()
+        for attempt in range(self.max_retries + 1):
+            pause = self._paused_until - loop.time()
+            if pause > 0:
+                await asyncio.sleep(pause)
+            # Сначала лимит чата, затем глобальный: глобальный токен не простаивает, пока чат ждёт своей очереди
+            await self._chat_bucket(chat_id).acquire()
+            await self._global_bucket.acquire()
+
+            try:
+                await self.bot.send_message(chat_id, text, **kwargs)
+                return True
+            except RetryAfter as error:
+                # Flood control действует на весь бот, поэтому приостанавливаются все воркеры
+                self._paused_until = max(self._paused_until, loop.time() + error.timeout)
+                logger.warning("Telegram просит подождать %s с перед отправкой в чат %s", error.timeout, chat_id)
+            except (NetworkError, aiohttp.ClientError, asyncio.TimeoutError) as error:
+                logger.warning("Сетевая ошибка при отправке в чат %s: %s", chat_id, error)
+                await asyncio.sleep(self.retry_delay * 2 ** attempt)
+            except TelegramAPIError:
+                # Заблокированный бот, удалённый чат и т.п. — повтор не поможет
+                logger.exception("Telegram отклонил уведомление для чата %s", chat_id)
+                return False
+            except Exception as error:
+                logger.warning("Не удалось отправить уведомление в чат %s: %s", chat_id, error)
+                await asyncio.sleep(self.retry_delay * 2 ** attempt)
+
+        logger.error("Уведомление для чата %s не доставлено после %s попыток", chat_id, self.max_retries + 1)
+        return False
@@ -0,0 +1,72 @@
+import asyncio
+from itertools import groupby
+from operator import itemgetter
+
+import numpy as np
+
+from currency_manager import parse_cbr_xml
+
+
+def lookup_rub_rates(history, codes, days):
+    # Курс на дату операции: последний опубликованный не позже неё, а для дат до начала истории — самый ранний
+    codes = np.asarray(codes)
+    days = np.asarray(days, dtype='datetime64[D]')
+    result = np.full(codes.shape, np.nan, dtype=np.float64)
+    result[codes == 'RUB'] = 1.0
+
+    for code, (history_days, history_rates) in history.items():
+        mask = codes == code
+        if not mask.any():
+            continue
+        positions = np.searchsorted(history_days, days[mask], side='right') - 1
+        result[mask] = history_rates[np.clip(positions, 0, len(history_days) - 1)]
+    return result
+
+
+class RateStore:
+    def __init__(self, pool):
+        self.pool = pool
+
+    async def save_rates(self, rates_date, currencies):
+        rows = [(rates_date, code, rate['value'], rate['nominal'])
+                for code, rate in currencies.items() if code != 'RUB']
+        async with self.pool.writer() as db:
+            await db.executemany('''
+                INSERT OR REPLACE INTO exchange_rates (date, code, value, nominal) VALUES (?, ?, ?, ?)
+            ''', rows)
+            await db.commit()
+        return len(rows)
+
+    async def import_xml_files(self, paths):
+        loop = asyncio.get_running_loop()
+        imported = 0
+        for path in paths:
+            rates_date, currencies = await loop.run_in_executor(None, self._parse_file, path)
+            if not rates_date:
+                raise ValueError(f"В файле {path} нет даты курсов.")
+            imported += await self.save_rates(rates_date, currencies)
+        return imported
+
+    @staticmethod
+    def _parse_file(path):
+        with open(path, 'rb') as file:
+            return parse_cbr_xml(file.read())
+
+    async def load_history(self, codes):
+        codes = [code for code in set(codes) if code != 'RUB']
+        history = {}
+        if not codes:
+            return history
+
+        placeholders = ', '.join('?' * len(codes))
+        async with self.pool.reader() as db:
+            async with db.execute(f'''
+                SELECT code, date, value / nominal FROM exchange_rates
+                WHERE code IN ({placeholders}) ORDER BY code, date
+            ''', codes) as cursor:
+                rows = await cursor.fetchall()
+
+        for code, code_rows in groupby(rows, key=itemgetter(0)):
+            _, dates, rates = zip(*code_rows)
+            history[code] = (np.array(dates, dtype='datetime64[D]'), np.array(rates, dtype=np.float64))
+        return history
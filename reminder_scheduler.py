@@ -0,0 +1,136 @@
+import asyncio
+import heapq
+import logging
+import time
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+
+class ReminderScheduler:
+    def __init__(self, pool, deliver, batch_size: int = 500, retry_delay: float = 60, poll_interval: float = 1):
+        self.pool = pool
+        self.deliver = deliver
+        self.batch_size = batch_size
+        self.retry_delay = retry_delay
+        self.poll_interval = poll_interval
+
+        self._heap = []
+        self._pending = set()
+        self._last_id = 0
+        self._wakeup = None
+        self._poll_now = None
+        self._task = None
+        self._poll_task = None
+
+    def __len__(self):
+        return len(self._heap)
+
+    async def start(self):
+        if self._task is not None:
+            return
+
+        self._wakeup = asyncio.Event()
+        self._poll_now = asyncio.Event()
+        await self._load_new()
+
+        self._task = asyncio.get_running_loop().create_task(self._run())
+        self._poll_task = asyncio.get_running_loop().create_task(self._poll())
+
+    async def stop(self):
+        if self._task is None:
+            return
+
+        for task in (self._task, self._poll_task):
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
+        self._poll_task = None
+        self._wakeup = None
+        self._poll_now = None
+
+    def notify_new(self):
+        # Напоминания создаёт любой воркер, а расписание держит только один: новые строки он забирает из БД
+        # сразу после вставки в своём процессе и не позже poll_interval — из остальных
+        if self._poll_now is not None:
+            self._poll_now.set()
+
+    async def _poll(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._poll_now.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._poll_now.clear()
+            try:
+                await self._load_new()
+            except Exception:
+                logger.exception("Не удалось загрузить новые напоминания")
+
+    async def _load_new(self):
+        # id в reminders объявлен с AUTOINCREMENT и не переиспользуется, поэтому каждая строка читается ровно один раз
+        async with self.pool.reader() as db:
+            async with db.execute('SELECT id, remind_at FROM reminders WHERE id > ? ORDER BY id',
+                                  (self._last_id,)) as cursor:
+                async for reminder_id, remind_at in cursor:
+                    self.add(reminder_id, remind_at)
+                    self._last_id = reminder_id
+
+    def add(self, reminder_id: int, remind_at):
+        earliest = self._heap[0][0] if self._heap else None
+        due = self._timestamp(remind_at)
+        if not self._push(reminder_id, due):
+            return
+        # Будим цикл, только если новое напоминание наступает раньше текущего ближайшего
+        if self._wakeup is not None and (earliest is None or due < earliest):
+            self._wakeup.set()
+
+    def _push(self, reminder_id, due):
+        if reminder_id in self._pending:
+            return False
+        self._pending.add(reminder_id)
+        heapq.heappush(self._heap, (due, reminder_id))
+        return True
+
+    @staticmethod
+    def _timestamp(remind_at):
+        if isinstance(remind_at, str):
+            remind_at = datetime.fromisoformat(remind_at)
+        return remind_at.timestamp()
+
+    async def _run(self):
+        while True:
+            if not self._heap:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+                continue
+
+            delay = self._heap[0][0] - time.time()
+            if delay > 0:
+                # Спим ровно до ближайшего срока или до появления более раннего напоминания
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+                continue
+
+            now = time.time()
+            due_ids = []
+            while self._heap and self._heap[0][0] <= now and len(due_ids) < self.batch_size:
+                _, reminder_id = heapq.heappop(self._heap)
+                self._pending.discard(reminder_id)
+                due_ids.append(reminder_id)
+
+            try:
+                failed_ids = await self.deliver(due_ids)
+            except Exception:
+                logger.exception("Не удалось доставить напоминания")
+                failed_ids = due_ids
+
+            # Недоставленные напоминания остаются в БД и повторяются позже
+            for reminder_id in failed_ids or ():
+                self._push(reminder_id, time.time() + self.retry_delay)
@@ -0,0 +1,188 @@
+import asyncio
+import logging
+import multiprocessing
+import queue as queue_module
+import signal
+
+from aiogram import Dispatcher
+
+from webhook import UpdateProcessor, update_user_id
+
+logger = logging.getLogger(__name__)
+
+RECEIVE_BATCH = 100
+
+
+def shard_for(user_id, shards: int) -> int:
+    # Апдейты без отправителя (опросы и т.п.) не участвуют в диалогах и всегда идут в первый воркер
+    if user_id is None:
+        return 0
+    return user_id % shards
+
+
+class ShardRouter:
+    def __init__(self, worker_main, workers: int, queue_size: int = 1000, channel_size: int = 1000):
+        if workers < 1:
+            raise ValueError("Количество воркеров должно быть положительным.")
+        self.worker_main = worker_main
+        self.workers = workers
+        self.queue_size = queue_size
+        self.channel_size = channel_size
+
+        self._queues = []
+        self._processes = []
+        self._channels = []
+        self._forwarders = []
+        self._room = None
+
+    def start(self):
+        # fork выполняется до запуска цикла событий и фоновых потоков, воркеры наследуют готовые объекты приложения
+        context = multiprocessing.get_context('fork')
+        for index in range(self.workers):
+            queue = context.Queue(self.queue_size)
+            process = context.Process(target=self.worker_main, args=(index, queue), name=f'bot-worker-{index}')
+            process.start()
+            self._queues.append(queue)
+            self._processes.append(process)
+
+    def _start_forwarders(self):
+        # Каналы и задачи создаются в цикле событий фронта, которого при fork ещё нет
+        loop = asyncio.get_running_loop()
+        self._room = asyncio.Event()
+        self._room.set()
+        self._channels = [asyncio.Queue() for _ in self._queues]
+        self._forwarders = [loop.create_task(self._forward(channel, queue))
+                            for channel, queue in zip(self._channels, self._queues)]
+
+    def pending(self) -> int:
+        return sum(channel.qsize() for channel in self._channels)
+
+    def submit(self, payload: dict):
+        # Постановка синхронная: апдейты попадают в канал воркера строго в порядке вызовов, без ожиданий между ними
+        if not self._forwarders:
+            self._start_forwarders()
+        self._channels[shard_for(update_user_id(payload), self.workers)].put_nowait(payload)
+        if self.pending() >= self.channel_size:
+            self._room.clear()
+
+    async def wait_for_room(self):
+        if self._room is not None:
+            await self._room.wait()
+
+    async def route(self, payload: dict):
+        self.submit(payload)
+        await self.wait_for_room()
+
+    async def _forward(self, channel, queue):
+        loop = asyncio.get_running_loop()
+        while True:
+            payload = await channel.get()
+            if self.pending() < self.channel_size:
+                self._room.set()
+            try:
+                queue.put_nowait(payload)
+            except queue_module.Full:
+                # Единственная задача на очередь воркера: пока она ждёт места, следующие апдейты копятся за ней
+                await loop.run_in_executor(None, queue.put, payload)
+            if payload is None:
+                return
+
+    async def close(self, timeout: float = 30):
+        loop = asyncio.get_running_loop()
+        if self._forwarders:
+            # Сигнал остановки идёт за ещё не переданными апдейтами
+            for channel in self._channels:
+                channel.put_nowait(None)
+            await asyncio.gather(*self._forwarders)
+        else:
+            for queue in self._queues:
+                await loop.run_in_executor(None, queue.put, None)
+        for process in self._processes:
+            await loop.run_in_executor(None, process.join, timeout)
+            if process.is_alive():
+                logger.error("Воркер %s не завершился вовремя", process.name)
+                process.terminate()
+        # Фоновые потоки очередей завершаются, чтобы последующий fork не унаследовал захваченные ими блокировки
+        for queue in self._queues:
+            queue.close()
+            await loop.run_in_executor(None, queue.join_thread)
+        self._queues = []
+        self._processes = []
+        self._channels = []
+        self._forwarders = []
+        self._room = None
+
+
+class ShardingDispatcher(Dispatcher):
+    def __init__(self, bot, router: ShardRouter, **kwargs):
+        super().__init__(bot, **kwargs)
+        self.router = router
+
+    async def start_polling(self, *args, **kwargs):
+        # aiogram обрабатывает каждую пачку getUpdates отдельной задачей и сразу запрашивает следующую.
+        # Пока каналы воркеров заполнены, следующий запрос не отправляется: апдейты подождут на стороне Telegram
+        get_updates = self.bot.get_updates
+
+        async def get_updates_with_backpressure(*get_args, **get_kwargs):
+            await self.router.wait_for_room()
+            return await get_updates(*get_args, **get_kwargs)
+
+        self.bot.get_updates = get_updates_with_backpressure
+        try:
+            await super().start_polling(*args, **kwargs)
+        finally:
+            self.bot.get_updates = get_updates
+
+    async def process_updates(self, updates, fast=True):
+        # Пачка ставится в каналы целиком до первого await, поэтому следующая пачка не может её обогнать
+        for update in updates:
+            self.router.submit(update.to_python())
+        return []
+
+    async def process_update(self, update):
+        await self.router.route(update.to_python())
+
+
+def _receive(queue):
+    items = [queue.get()]
+    while len(items) < RECEIVE_BATCH:
+        try:
+            items.append(queue.get_nowait())
+        except queue_module.Empty:
+            break
+    return items
+
+
+async def consume(queue, processor: UpdateProcessor):
+    loop = asyncio.get_running_loop()
+    while True:
+        for payload in await loop.run_in_executor(None, _receive, queue):
+            if payload is None:
+                await processor.join()
+                return
+            await processor.acquire()
+            processor.dispatch(payload)
+
+
+def run_worker(queue, dispatcher, on_startup, on_shutdown, max_in_flight: int = 100):
+    # Остановкой воркеров управляет фронтовой процесс через сигнальный None в очереди
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    async def main():
+        await on_startup(dispatcher)
+        try:
+            await consume(queue, UpdateProcessor(dispatcher, max_in_flight))
+        finally:
+            await on_shutdown(dispatcher)
+            await dispatcher.storage.close()
+            await dispatcher.storage.wait_closed()
+            session = await dispatcher.bot.get_session()
+            await session.close()
+
+    # Тот же цикл событий, что унаследован от родителя: к нему привязаны примитивы синхронизации менеджеров
+    try:
+        loop = asyncio.get_event_loop()
+    except RuntimeError:
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+    loop.run_until_complete(main())
@@ -0,0 +1,179 @@
+import asyncio
+import copy
+import json
+import logging
+import typing
+
+from aiogram.dispatcher.storage import BaseStorage
+
+from lru_cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+UPSERT_FSM_RECORD = '''
+    INSERT INTO fsm_storage (chat, user, state, data, bucket) VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT(chat, user) DO UPDATE SET state = excluded.state, data = excluded.data, bucket = excluded.bucket
+'''
+DELETE_FSM_RECORD = 'DELETE FROM fsm_storage WHERE chat = ? AND user = ?'
+SELECT_FSM_RECORD = 'SELECT state, data, bucket FROM fsm_storage WHERE chat = ? AND user = ?'
+
+
+class SQLiteStorage(BaseStorage):
+    def __init__(self, pool, write_queue, cache_size: int = 10000, flush_interval: float = 0.05):
+        self.pool = pool
+        self.write_queue = write_queue
+        self.flush_interval = flush_interval
+
+        self._cache = LRUCache(cache_size)
+        # Изменённые записи держатся здесь до сброса в БД, даже если LRU их уже вытеснил
+        self._dirty = {}
+        self._dirty_event = None
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._dirty_event = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+        self._cache.clear()
+
+    async def wait_closed(self):
+        pass
+
+    async def _run(self):
+        while True:
+            await self._dirty_event.wait()
+            # Все изменения одной записи за интервал сливаются в один upsert
+            await asyncio.sleep(self.flush_interval)
+            self._dirty_event.clear()
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Не удалось сохранить состояния FSM")
+                self._dirty_event.set()
+
+    async def flush(self):
+        if not self._dirty:
+            return
+
+        dirty, self._dirty = self._dirty, {}
+        statements = []
+        for (chat, user), record in dirty.items():
+            if record['state'] is None and not record['data'] and not record['bucket']:
+                statements.append((DELETE_FSM_RECORD, (chat, user)))
+            else:
+                statements.append((UPSERT_FSM_RECORD, (chat, user, record['state'],
+                                                       json.dumps(record['data'], ensure_ascii=False),
+                                                       json.dumps(record['bucket'], ensure_ascii=False))))
+        try:
+            await self.write_queue.submit(*statements)
+        except BaseException:
+            # Более свежие изменения, сделанные во время записи, важнее возвращаемых
+            for key, record in dirty.items():
+                self._dirty.setdefault(key, record)
+            raise
+
+    def _key(self, chat, user):
+        chat, user = self.check_address(chat=chat, user=user)
+        return str(chat), str(user)
+
+    async def _record(self, chat, user):
+        key = self._key(chat, user)
+        record = self._dirty.get(key) or self._cache.get(key)
+        if record is not None:
+            return key, record
+
+        async with self.pool.reader() as db:
+            async with db.execute(SELECT_FSM_RECORD, key) as cursor:
+                row = await cursor.fetchone()
+
+        # Пока шёл запрос, запись могла появиться из параллельного обработчика
+        record = self._dirty.get(key) or self._cache.get(key)
+        if record is not None:
+            return key, record
+
+        if row is None:
+            record = {'state': None, 'data': {}, 'bucket': {}}
+        else:
+            record = {'state': row[0], 'data': json.loads(row[1]), 'bucket': json.loads(row[2])}
+        self._cache.put(key, record)
+        return key, record
+
+    def _mark_dirty(self, key, record):
+        self._cache.put(key, record)
+        self._dirty[key] = record
+        if self._dirty_event is not None:
+            self._dirty_event.set()
+
+    async def get_state(self, *,
+                        chat: typing.Union[str, int, None] = None,
+                        user: typing.Union[str, int, None] = None,
+                        default: typing.Optional[str] = None) -> typing.Optional[str]:
+        _, record = await self._record(chat, user)
+        return record['state'] if record['state'] is not None else self.resolve_state(default)
+
+    async def get_data(self, *,
+                       chat: typing.Union[str, int, None] = None,
+                       user: typing.Union[str, int, None] = None,
+                       default: typing.Optional[dict] = None) -> typing.Dict:
+        _, record = await self._record(chat, user)
+        return copy.deepcopy(record['data'])
+
+    async def set_state(self, *,
+                        chat: typing.Union[str, int, None] = None,
+                        user: typing.Union[str, int, None] = None,
+                        state: typing.AnyStr = None):
+        key, record = await self._record(chat, user)
+        record['state'] = self.resolve_state(state)
+        self._mark_dirty(key, record)
+
+    async def set_data(self, *,
+                       chat: typing.Union[str, int, None] = None,
+                       user: typing.Union[str, int, None] = None,
+                       data: typing.Dict = None):
+        key, record = await self._record(chat, user)
+        record['data'] = copy.deepcopy(data or {})
+        self._mark_dirty(key, record)
+
+    async def update_data(self, *,
+                          chat: typing.Union[str, int, None] = None,
+                          user: typing.Union[str, int, None] = None,
+                          data: typing.Dict = None, **kwargs):
+        key, record = await self._record(chat, user)
+        record['data'].update(data or {}, **kwargs)
+        self._mark_dirty(key, record)
+
+    def has_bucket(self):
+        return True
+
+    async def get_bucket(self, *,
+                         chat: typing.Union[str, int, None] = None,
+                         user: typing.Union[str, int, None] = None,
+                         default: typing.Optional[dict] = None) -> typing.Dict:
+        _, record = await self._record(chat, user)
+        return copy.deepcopy(record['bucket'])
+
+    async def set_bucket(self, *,
+                         chat: typing.Union[str, int, None] = None,
+                         user: typing.Union[str, int, None] = None,
+                         bucket: typing.Dict = None):
+        key, record = await self._record(chat, user)
+        record['bucket'] = copy.deepcopy(bucket or {})
+        self._mark_dirty(key, record)
+
+    async def update_bucket(self, *,
+                            chat: typing.Union[str, int, None] = None,
+                            user: typing.Union[str, int, None] = None,
+                            bucket: typing.Dict = None, **kwargs):
+        key, record = await self._record(chat, user)
+        record['bucket'].update(bucket or {}, **kwargs)
+        self._mark_dirty(key, record)
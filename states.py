@@ -11,3 +11,7 @@ class AddExpense(StatesGroup):
     category = State()
     amount = State()
     currency = State()
+
+
+class ImportTransactions(StatesGroup):
+    file = State()
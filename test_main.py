@@ -1,12 +1,49 @@
+import asyncio
+import csv
+import datetime
+import gzip
+import io
+import json
+import multiprocessing
+import os
+import sqlite3
+import tempfile
+import time
 import unittest
 from unittest.mock import AsyncMock, MagicMock, patch
 
+import aiohttp
+from aiogram import Bot, Dispatcher, types
+from aiogram.bot.api import TelegramAPIServer
+from aiogram.contrib.fsm_storage.memory import MemoryStorage
+from aiogram.utils.exceptions import BotBlocked
+from aiohttp import web
+
+from archive import ArchiveManager
+from benchmarks.load_test import run_load_test
 from bot_controller import BotController
-from currency_manager import CurrencyManager
+from chart_cache import CachedChart, ChartCache
+from chart_renderer import ChartRenderer, ChartRendererBusy, render_statistics_chart
+from connection_pool import ConnectionPool
+from csv_import import ImportResult
+from currency_manager import CurrencyManager, parse_cbr_xml
 from database_manager import DatabaseManager
-from finance_manager import FinanceManager
+from fake_telegram import FakeTelegramAPI
+from finance_manager import (BUMP_DATA_VERSION, RECORD_BUDGET_ALERTS, FinanceManager, StatisticsPage,
+                             UPSERT_CATEGORY_TOTAL)
 from goal_manager import GoalManager
+from history_export import ExportQueue
+from metrics import (DB_QUERY_SECONDS, Counter, Gauge, Histogram, MetricsMiddleware, MetricsRegistry, MetricsServer,
+                     statement_label)
+from migrations import MIGRATIONS, apply_migrations
+from notification_dispatcher import NotificationDispatcher, TokenBucket
+from rate_store import RateStore
+from sharding import ShardRouter, ShardingDispatcher, shard_for
+from sqlite_storage import SQLiteStorage
+from transaction_search import SearchQuery, parse_search_query
 from user_manager import UserManager
+from webhook import WebhookServer, update_user_id
+from write_queue import WriteQueue
 
 
 class TestBot(unittest.IsolatedAsyncioTestCase):
@@ -58,16 +95,180 @@ class TestBot(unittest.IsolatedAsyncioTestCase):
         message.answer.assert_called_once_with("Пожалуйста, используйте команду в формате /rate `<код_валюты>`.",
                                                parse_mode='Markdown')
 
+    async def test_import_document_reports_result(self):
+        message = AsyncMock()
+        message.document.file_size = 1024
+        state = AsyncMock()
+        self.finance_manager.import_transactions.return_value = ImportResult(3, 1, ["строка 4: <плохая дата>"])
+
+        await self.bot_controller.import_document(message, state)
+
+        state.finish.assert_awaited_once()
+        message.document.download.assert_awaited_once()
+        self.finance_manager.import_transactions.assert_awaited_once()
+        message.answer.assert_called_with(
+            "Импорт завершён. Добавлено операций: 3, пропущено строк: 1.\nстрока 4: &lt;плохая дата&gt;",
+            parse_mode='HTML')
+
+    async def test_import_document_rejects_large_files(self):
+        message = AsyncMock()
+        message.document.file_size = 50 * 1024 * 1024
+
+        await self.bot_controller.import_document(message, AsyncMock())
+
+        message.document.download.assert_not_awaited()
+        self.finance_manager.import_transactions.assert_not_awaited()
+
+    async def test_set_budget_parses_multiword_category(self):
+        message = AsyncMock()
+        message.text = '/set_budget Оплата жилья 30000 usd'
+
+        await self.bot_controller.set_budget(message)
+
+        self.finance_manager.set_budget.assert_awaited_once_with(message.from_user.id, 'Оплата жилья', 30000.0, 'USD')
+        message.reply.assert_called_once_with("Бюджет установлен: 30000.00 USD в месяц.", parse_mode='Markdown')
+
+    async def test_export_history_is_queued(self):
+        message = AsyncMock()
+        message.text = '/export jsonl'
+        export_queue = MagicMock()
+        export_queue.submit.return_value = 2
+        controller = BotController(self.bot, self.dp, self.finance_manager, self.currency_manager, self.db_manager,
+                                   self.goal_manager, self.user_manager, export_queue)
+
+        await controller.export_history(message)
+
+        export_queue.submit.assert_called_once_with(message.from_user.id, 'jsonl', unittest.mock.ANY,
+                                                    unittest.mock.ANY)
+        message.answer.assert_called_once_with("Выгрузка поставлена в очередь, файл придёт отдельным сообщением. "
+                                               "Перед вами в очереди: 2.", parse_mode='Markdown')
+
+    async def test_export_history_rejects_unknown_format(self):
+        message = AsyncMock()
+        message.text = '/export xlsx'
+
+        await self.bot_controller.export_history(message)
+
+        message.answer.assert_called_once_with("Пожалуйста, используйте команду в формате `/export [csv|jsonl]`.",
+                                               parse_mode='Markdown')
+
+    async def test_search_saves_query_for_paging(self):
+        message = AsyncMock()
+        message.get_args = MagicMock(return_value='Такси >1000 2024-03..2024-05')
+        state = AsyncMock()
+        self.finance_manager.search_transactions.return_value = StatisticsPage("Найденные операции:",
+                                                                               next_cursor='e7')
+
+        await self.bot_controller.search_transactions(message, state)
+
+        state.update_data.assert_awaited_once_with(search_query='Такси >1000 2024-03..2024-05')
+        self.finance_manager.search_transactions.assert_awaited_once_with(
+            message.from_user.id, SearchQuery(['такси'], min_amount=1000.0, date_from='2024-03-01',
+                                              date_to='2024-06-01'))
+        markup = message.answer.call_args.kwargs['reply_markup']
+        self.assertEqual(markup.inline_keyboard[0][0].callback_data, 'search:next:e7')
+
+        callback = AsyncMock()
+        callback.data = 'search:next:e7'
+        state.get_data.return_value = {'search_query': 'Такси >1000 2024-03..2024-05'}
+        await self.bot_controller.navigate_search(callback, state)
+
+        self.finance_manager.search_transactions.assert_awaited_with(
+            callback.from_user.id, unittest.mock.ANY, cursor='e7', backward=False)
+        callback.message.edit_text.assert_awaited_once()
+
+    async def test_search_requires_query(self):
+        message = AsyncMock()
+        message.get_args = MagicMock(return_value='')
+
+        await self.bot_controller.search_transactions(message, AsyncMock())
+
+        self.finance_manager.search_transactions.assert_not_awaited()
+        self.assertIn('/search', message.answer.call_args.args[0])
+
     async def test_show_statistics(self):
         message = AsyncMock()
-        self.finance_manager.get_statistics.return_value = "Статистика за месяц"
-        self.finance_manager.create_statistics_chart.return_value = b'image_data'
+        message.text = '/statistics'
+        self.finance_manager.get_summary.return_value = "Итого доходов: 0"
+        self.finance_manager.get_statistics_page.return_value = StatisticsPage("Статистика за месяц")
+        self.finance_manager.create_statistics_chart.return_value = CachedChart('key', b'image_data')
+        message.answer_photo.return_value.photo = [MagicMock(file_id='small'), MagicMock(file_id='large')]
+
+        await self.bot_controller.show_statistics(message)
+
+        self.finance_manager.get_statistics_page.assert_awaited_once_with(message.from_user.id, date_from=None,
+                                                                          date_to=None)
+        message.answer.assert_has_calls([
+            unittest.mock.call("Итого доходов: 0", parse_mode='Markdown'),
+            unittest.mock.call("Статистика за месяц", reply_markup=None, parse_mode='Markdown'),
+        ])
+        message.answer_photo.assert_called_once_with(unittest.mock.ANY, caption="Диаграмма доходов и расходов",
+                                                     parse_mode='Markdown')
+        self.assertEqual(message.answer_photo.call_args.args[0].getvalue(), b'image_data')
+        self.finance_manager.remember_chart_file_id.assert_awaited_once_with('key', 'large')
+
+    async def test_show_statistics_resends_cached_file_id(self):
+        message = AsyncMock()
+        message.text = '/statistics'
+        self.finance_manager.get_statistics_page.return_value = StatisticsPage("Страница")
+        self.finance_manager.create_statistics_chart.return_value = CachedChart('key', b'image_data', 'file-id')
 
         await self.bot_controller.show_statistics(message)
 
-        message.answer.assert_called_once_with("Статистика за месяц", parse_mode='Markdown')
-        message.answer_photo.assert_called_once_with(b'image_data', caption="Диаграмма доходов и расходов",
+        message.answer_photo.assert_called_once_with('file-id', caption="Диаграмма доходов и расходов",
                                                      parse_mode='Markdown')
+        self.finance_manager.remember_chart_file_id.assert_not_called()
+
+    async def test_show_statistics_with_period_and_navigation(self):
+        message = AsyncMock()
+        message.text = '/statistics 2024-01-01 2024-01-31'
+        self.finance_manager.get_statistics_page.return_value = StatisticsPage("Страница", next_cursor='e7')
+
+        await self.bot_controller.show_statistics(message)
+
+        keyboard = message.answer.call_args_list[1].kwargs['reply_markup']
+        self.assertEqual(keyboard.inline_keyboard[0][0].callback_data, 'stats:next:e7:2024-01-01:2024-01-31')
+
+        callback = AsyncMock()
+        callback.data = 'stats:next:e7:2024-01-01:2024-01-31'
+        await self.bot_controller.navigate_statistics(callback)
+
+        self.finance_manager.get_statistics_page.assert_awaited_with(
+            callback.from_user.id, cursor='e7', backward=False,
+            date_from=datetime.date(2024, 1, 1), date_to=datetime.date(2024, 1, 31))
+        callback.message.edit_text.assert_awaited_once()
+        callback.answer.assert_awaited_once_with()
+
+    async def test_show_statistics_when_renderer_busy(self):
+        message = AsyncMock()
+        message.text = '/statistics'
+        self.finance_manager.get_statistics_page.return_value = StatisticsPage("Страница")
+        self.finance_manager.create_statistics_chart.side_effect = ChartRendererBusy()
+
+        await self.bot_controller.show_statistics(message)
+
+        message.answer.assert_called_with("Диаграмма сейчас недоступна, попробуйте позже.", parse_mode='Markdown')
+        message.answer_photo.assert_not_called()
+
+    async def test_show_statistics_invalid_period(self):
+        message = AsyncMock()
+        message.text = '/statistics вчера'
+
+        await self.bot_controller.show_statistics(message)
+
+        self.finance_manager.get_statistics_page.assert_not_called()
+        message.answer.assert_called_once_with(
+            "Пожалуйста, используйте команду в формате `/statistics [YYYY-MM-DD] [YYYY-MM-DD]`.", parse_mode='Markdown')
+
+    async def test_show_base_currency_summary(self):
+        message = AsyncMock()
+        message.text = '/summary usd'
+        self.finance_manager.get_base_currency_report.return_value = "Итоги в USD"
+
+        await self.bot_controller.show_base_currency_summary(message)
+
+        self.finance_manager.get_base_currency_report.assert_awaited_once_with(message.from_user.id, 'USD')
+        message.answer.assert_called_once_with("Итоги в USD", parse_mode='Markdown')
 
     async def test_set_goal_start(self):
         message = AsyncMock()
@@ -212,62 +413,1606 @@ class TestFinanceManager(unittest.IsolatedAsyncioTestCase):
 
     def setUp(self):
         self.user_manager = AsyncMock(spec=UserManager)
-        self.finance_manager = FinanceManager(db_name=':memory:')
-        self.finance_manager.user_manager = self.user_manager
+        self.pool = MagicMock(spec=ConnectionPool)
+        self.write_queue = AsyncMock(spec=WriteQueue)
+        self.finance_manager = FinanceManager(self.pool, self.user_manager, self.write_queue,
+                                              AsyncMock(spec=ChartRenderer), ChartCache(), RateStore(self.pool))
 
-    @patch('aiosqlite.connect')
-    async def test_add_income(self, mock_connect):
-        mock_db = mock_connect.return_value.__aenter__.return_value
+    async def test_add_income(self):
         self.user_manager.get_user_id.return_value = 1
 
         await self.finance_manager.add_income(telegram_id=12345, category='Зарплата', amount=1000, currency='USD')
 
-        mock_db.execute.assert_called_with('''
-                INSERT INTO income (user_id, category, amount, currency, date)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (1, 'Зарплата', 1000, 'USD', unittest.mock.ANY))
+        self.write_queue.submit.assert_awaited_once_with(('''
+    INSERT INTO income (user_id, category, amount, currency, date)
+    VALUES (?, ?, ?, ?, ?)
+''', (1, 'Зарплата', 1000, 'USD', unittest.mock.ANY)), (UPSERT_CATEGORY_TOTAL, unittest.mock.ANY),
+            (BUMP_DATA_VERSION, (1,)))
 
-        mock_db.commit.assert_called_once()
-
-    @patch('aiosqlite.connect')
-    async def test_add_expense(self, mock_connect):
-        mock_db = mock_connect.return_value.__aenter__.return_value
+    async def test_add_expense(self):
         self.user_manager.get_user_id.return_value = 1
 
         await self.finance_manager.add_expense(telegram_id=12345, category='Продукты', amount=250, currency='USD')
 
-        mock_db.execute.assert_called_with('''
-                INSERT INTO expenses (user_id, category, amount, currency, date)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (1, 'Продукты', 250, 'USD', unittest.mock.ANY))
+        self.write_queue.submit.assert_awaited_once_with(('''
+    INSERT INTO expenses (user_id, category, amount, currency, date)
+    VALUES (?, ?, ?, ?, ?)
+''', (1, 'Продукты', 250, 'USD', unittest.mock.ANY)), (UPSERT_CATEGORY_TOTAL, unittest.mock.ANY),
+            (BUMP_DATA_VERSION, (1,)), (RECORD_BUDGET_ALERTS, (unittest.mock.ANY, 1, 'Продукты', 'USD')))
 
-        mock_db.commit.assert_called_once()
 
+class TestConnectionPool(unittest.IsolatedAsyncioTestCase):
 
-class TestCurrencyManager(unittest.TestCase):
+    async def asyncSetUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.pool = ConnectionPool(os.path.join(self.tmp_dir.name, 'test.db'), readers=2)
+        await self.pool.open()
+        await DatabaseManager(self.pool).init_db()
+
+    async def asyncTearDown(self):
+        await self.pool.close()
+        self.tmp_dir.cleanup()
+
+    async def test_wal_mode_enabled(self):
+        async with self.pool.reader() as db:
+            async with db.execute('PRAGMA journal_mode') as cursor:
+                row = await cursor.fetchone()
+
+        self.assertEqual(row[0], 'wal')
+
+    async def test_readers_are_read_only(self):
+        async with self.pool.reader() as db:
+            with self.assertRaises(sqlite3.OperationalError) as context:
+                await db.execute('INSERT INTO users (telegram_id) VALUES (1)')
+
+        self.assertIn('readonly', str(context.exception))
+
+    async def test_managers_share_pool(self):
+        user_manager = UserManager(self.pool)
+        write_queue = WriteQueue(self.pool)
+        write_queue.start()
+        finance_manager = FinanceManager(self.pool, user_manager, write_queue, AsyncMock(spec=ChartRenderer),
+                                         ChartCache(), RateStore(self.pool))
+
+        await finance_manager.add_income(12345, 'Зарплата', 1000, 'USD')
+        await write_queue.close()
+        user_id = await user_manager.get_user_id(12345)
+
+        self.assertEqual(await user_manager.get_telegram_id(user_id), 12345)
+        page = await finance_manager.get_statistics_page(12345)
+        self.assertIn('Зарплата: 1000.0 USD', page.text)
+
+    async def test_lock_waits_are_counted(self):
+        async def hold_writer():
+            async with self.pool.writer():
+                await asyncio.sleep(0.05)
+
+        before = self.pool.lock_stats()['writer']
+        await asyncio.gather(hold_writer(), hold_writer())
+
+        stats = self.pool.lock_stats()['writer']
+        self.assertEqual((stats['acquired'] - before['acquired'], stats['contended'] - before['contended']), (2, 1))
+        self.assertGreaterEqual(stats['wait_seconds'], 0.04)
+
+    async def test_writer_rolls_back_on_error(self):
+        with self.assertRaises(RuntimeError):
+            async with self.pool.writer() as db:
+                await db.execute('INSERT INTO users (telegram_id) VALUES (1)')
+                raise RuntimeError()
+
+        async with self.pool.reader() as db:
+            async with db.execute('SELECT COUNT(*) FROM users') as cursor:
+                row = await cursor.fetchone()
+
+        self.assertEqual(row[0], 0)
+
+    async def test_writer_rolls_back_uncommitted_transaction(self):
+        async with self.pool.writer() as db:
+            await db.execute('INSERT INTO users (telegram_id) VALUES (1)')
+
+        async with self.pool.writer() as db:
+            self.assertFalse(db.in_transaction)
+            await db.execute('INSERT INTO users (telegram_id) VALUES (2)')
+            await db.commit()
+
+        async with self.pool.reader() as db:
+            async with db.execute('SELECT telegram_id FROM users') as cursor:
+                rows = await cursor.fetchall()
+
+        self.assertEqual(rows, [(2,)])
+
+    async def test_deliver_reminders_does_not_hold_writer(self):
+        user_manager = UserManager(self.pool)
+        bot = MagicMock()
+        notifier = NotificationDispatcher(bot, global_rate=1000, per_chat_rate=1000)
+        notifier.start()
+        goal_manager = GoalManager(notifier, self.pool, user_manager)
+        await goal_manager.add_reminder(12345, 'Оплатить счёт', '2000-01-01T10:00:00')
+
+        async def send_message(chat_id, text):
+            self.assertFalse(self.pool._write_lock.locked())
+
+        bot.send_message = AsyncMock(side_effect=send_message)
+
+        with patch.object(user_manager, 'get_telegram_id') as get_telegram_id:
+            self.assertEqual(await goal_manager.deliver_reminders([1]), [])
+        await notifier.close()
+        await goal_manager.flush_sent()
+
+        get_telegram_id.assert_not_called()
+
+        bot.send_message.assert_awaited_once_with(12345, 'Оплатить счёт')
+        async with self.pool.reader() as db:
+            async with db.execute('SELECT COUNT(*) FROM reminders') as cursor:
+                row = await cursor.fetchone()
+        self.assertEqual(row[0], 0)
+
+
+class TestReminderScheduler(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.pool = ConnectionPool(os.path.join(self.tmp_dir.name, 'test.db'), readers=1)
+        await self.pool.open()
+        await DatabaseManager(self.pool).init_db()
+        self.bot = MagicMock()
+        self.bot.send_message = AsyncMock()
+        self.notifier = NotificationDispatcher(self.bot, global_rate=1000, per_chat_rate=1000, retry_delay=0.01)
+        self.notifier.start()
+        self.goal_manager = GoalManager(self.notifier, self.pool, UserManager(self.pool))
+
+    async def asyncTearDown(self):
+        await self.goal_manager.stop()
+        await self.notifier.close()
+        await self.pool.close()
+        self.tmp_dir.cleanup()
+
+    async def count_reminders(self):
+        async with self.pool.reader() as db:
+            async with db.execute('SELECT COUNT(*) FROM reminders') as cursor:
+                return (await cursor.fetchone())[0]
+
+    async def test_reminder_delivered_at_due_time(self):
+        await self.goal_manager.start()
+        remind_at = (datetime.datetime.now() + datetime.timedelta(seconds=0.3)).isoformat()
+
+        await self.goal_manager.add_reminder(111, 'Скоро', remind_at)
+        await asyncio.sleep(0.1)
+        self.bot.send_message.assert_not_awaited()
+        await asyncio.sleep(0.5)
+
+        self.bot.send_message.assert_awaited_once_with(111, 'Скоро')
+        self.assertEqual(await self.count_reminders(), 0)
+        self.assertEqual(len(self.goal_manager.reminder_scheduler), 0)
+
+    async def test_pending_reminders_survive_restart(self):
+        await self.goal_manager.add_reminder(111, 'Прошлое', '2000-01-01T10:00:00')
+        await self.goal_manager.add_reminder(111, 'Будущее', '2999-01-01T10:00:00')
+
+        restarted = GoalManager(self.notifier, self.pool, UserManager(self.pool))
+        await restarted.start()
+        await asyncio.sleep(0.1)
+        await self.notifier.join()
+        await restarted.stop()
+
+        self.bot.send_message.assert_awaited_once_with(111, 'Прошлое')
+        self.assertEqual(await self.count_reminders(), 1)
+        self.assertEqual(len(restarted.reminder_scheduler), 1)
+
+    async def test_reminder_from_other_worker_delivered_by_scheduling_worker(self):
+        # Второй воркер — отдельный процесс со своим пулом к той же БД и без запущенного расписания
+        other_pool = ConnectionPool(self.pool.db_path, readers=1)
+        await other_pool.open()
+        other_bot = MagicMock()
+        other_bot.send_message = AsyncMock()
+        other_worker = GoalManager(NotificationDispatcher(other_bot), other_pool, UserManager(other_pool))
+        self.goal_manager.reminder_scheduler.poll_interval = 0.05
+        await self.goal_manager.start()
+
+        try:
+            await other_worker.add_reminder(222, 'С другого воркера', '2000-01-01T10:00:00')
+            self.assertEqual(len(other_worker.reminder_scheduler), 0)
+            await asyncio.sleep(0.3)
+            await self.notifier.join()
+            await self.goal_manager.flush_sent()
+        finally:
+            await other_pool.close()
+
+        self.bot.send_message.assert_awaited_once_with(222, 'С другого воркера')
+        other_bot.send_message.assert_not_awaited()
+        self.assertEqual(await self.count_reminders(), 0)
+
+    async def test_failed_delivery_is_retried_not_lost(self):
+        self.bot.send_message.side_effect = [RuntimeError('network'), None]
+        await self.goal_manager.start()
+
+        with self.assertLogs('notification_dispatcher', level='WARNING'):
+            await self.goal_manager.add_reminder(111, 'Повтор', '2000-01-01T10:00:00')
+            await asyncio.sleep(0.1)
+            await self.notifier.join()
+        await self.goal_manager.flush_sent()
+
+        self.assertEqual(self.bot.send_message.await_count, 2)
+        self.assertEqual(await self.count_reminders(), 0)
+
+    async def test_rejected_reminder_is_rescheduled(self):
+        self.bot.send_message.side_effect = BotBlocked('Forbidden: bot was blocked by the user')
+        self.goal_manager.reminder_scheduler.retry_delay = 60
+        await self.goal_manager.start()
+
+        with self.assertLogs('notification_dispatcher', level='ERROR'):
+            await self.goal_manager.add_reminder(111, 'Отклонено', '2000-01-01T10:00:00')
+            await asyncio.sleep(0.1)
+            await self.notifier.join()
+
+        self.assertEqual(self.bot.send_message.await_count, 1)
+        self.assertEqual(await self.count_reminders(), 1)
+        self.assertEqual(len(self.goal_manager.reminder_scheduler), 1)
+
+
+class TestGoalExpiry(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.pool = ConnectionPool(os.path.join(self.tmp_dir.name, 'test.db'), readers=1)
+        await self.pool.open()
+        await DatabaseManager(self.pool).init_db()
+        self.bot = MagicMock()
+        self.bot.send_message = AsyncMock()
+        self.notifier = NotificationDispatcher(self.bot, global_rate=1000, per_chat_rate=1000)
+        self.notifier.start()
+        self.goal_manager = GoalManager(self.notifier, self.pool, UserManager(self.pool), goal_batch_size=2)
+
+    async def asyncTearDown(self):
+        await self.notifier.close()
+        await self.pool.close()
+        self.tmp_dir.cleanup()
+
+    async def remaining_goals(self):
+        async with self.pool.reader() as db:
+            async with db.execute('SELECT goal_name FROM financial_goals ORDER BY id') as cursor:
+                return [row[0] for row in await cursor.fetchall()]
+
+    async def test_only_due_goals_processed_in_batches(self):
+        for day in range(1, 6):
+            await self.goal_manager.set_financial_goal(111, f'Цель{day}', 100, f'2024-01-0{day}')
+        await self.goal_manager.set_financial_goal(111, 'Будущая', 100, '2024-02-01')
+
+        with patch.object(self.pool, 'reader', wraps=self.pool.reader) as reader, \
+                patch.object(self.pool, 'writer', wraps=self.pool.writer) as writer:
+            await self.goal_manager.check_goals(today=datetime.date(2024, 1, 5))
+            await self.notifier.join()
+            await self.goal_manager.flush_sent()
+
+        self.assertEqual(self.bot.send_message.await_count, 5)
+        self.assertEqual(reader.call_count, 4)
+        # Доставленные цели удаляются одной транзакцией, а не по одной на цель
+        self.assertEqual(writer.call_count, 1)
+        self.assertEqual(await self.remaining_goals(), ['Будущая'])
+
+    async def test_delivered_goals_deleted_after_interval(self):
+        self.goal_manager.delete_interval = 0.01
+        await self.goal_manager.set_financial_goal(111, 'Первая', 100, '2024-01-01')
+
+        await self.goal_manager.check_goals(today=datetime.date(2024, 1, 1))
+        await self.notifier.join()
+        await asyncio.sleep(0.1)
+
+        self.assertEqual(await self.remaining_goals(), [])
+
+    async def test_failed_notification_keeps_goal(self):
+        await self.goal_manager.set_financial_goal(111, 'Первая', 100, '2024-01-01')
+        await self.goal_manager.set_financial_goal(111, 'Вторая', 100, '2024-01-01')
+        self.bot.send_message.side_effect = [BotBlocked('Forbidden: bot was blocked by the user'), None]
+
+        with self.assertLogs('notification_dispatcher', level='ERROR'):
+            await self.goal_manager.check_goals(today=datetime.date(2024, 1, 1))
+            await self.notifier.join()
+        await self.goal_manager.flush_sent()
+
+        self.assertEqual(await self.remaining_goals(), ['Первая'])
+
+    async def test_expiry_query_uses_deadline_index(self):
+        async with self.pool.reader() as db:
+            async with db.execute('EXPLAIN QUERY PLAN SELECT id FROM financial_goals WHERE deadline <= ?',
+                                  ('2024-01-01',)) as cursor:
+                plan = ' '.join(row[-1] for row in await cursor.fetchall())
+        self.assertIn('idx_financial_goals_deadline', plan)
+
+
+class TestNotificationDispatcher(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.api = FakeTelegramAPI()
+        url = await self.api.start()
+        self.bot = Bot('123456:TEST-TOKEN', server=TelegramAPIServer.from_base(url))
+
+    async def asyncTearDown(self):
+        await (await self.bot.get_session()).close()
+        await self.api.close()
+
+    async def dispatcher(self, **kwargs):
+        kwargs.setdefault('global_rate', 1000)
+        kwargs.setdefault('per_chat_rate', 1000)
+        notifier = NotificationDispatcher(self.bot, **kwargs)
+        notifier.start()
+        self.addAsyncCleanup(notifier.close)
+        return notifier
+
+    def test_token_bucket_reserves_future_slots(self):
+        bucket = TokenBucket(rate=2, capacity=1)
+        self.assertEqual([bucket.reserve(0.0), bucket.reserve(0.0), bucket.reserve(0.0)], [0.0, 0.5, 1.0])
+        self.assertEqual(bucket.reserve(10.0), 0.0)
+
+    async def test_delivered_callback_after_successful_send(self):
+        notifier = await self.dispatcher()
+        delivered = []
+
+        for chat_id in (1, 2, 3):
+            async def on_delivered(chat_id=chat_id):
+                delivered.append(chat_id)
+            await notifier.send(chat_id, f'Привет {chat_id}', on_delivered=on_delivered)
+        await notifier.join()
+
+        self.assertEqual(sorted(self.api.sent_messages), [(1, 'Привет 1'), (2, 'Привет 2'), (3, 'Привет 3')])
+        self.assertEqual(sorted(delivered), [1, 2, 3])
+        self.assertEqual(notifier.delivered, 3)
+
+    async def test_global_rate_limit(self):
+        notifier = await self.dispatcher(workers=8, global_rate=100)
+        started = time.monotonic()
+
+        for chat_id in range(150):
+            await notifier.send(chat_id, 'Тест')
+        await notifier.join()
+
+        # 100 сообщений уходят запасом бакета, остальные 50 — со скоростью 100 в секунду
+        self.assertGreaterEqual(time.monotonic() - started, 0.45)
+        self.assertEqual(len(self.api.sent_messages), 150)
+
+    async def test_per_chat_rate_limit(self):
+        notifier = await self.dispatcher(workers=4, per_chat_rate=20)
+
+        for number in range(4):
+            await notifier.send(42, f'Сообщение {number}')
+        await notifier.join()
+
+        times = [call['time'] for call in self.api.calls]
+        self.assertEqual(len(times), 4)
+        self.assertGreaterEqual(times[-1] - times[0], 0.14)
+
+    async def test_retry_after_pauses_and_retries(self):
+        notifier = await self.dispatcher()
+        self.api.flood(1, retry_after=1)
+        started = time.monotonic()
+
+        with self.assertLogs('notification_dispatcher', level='WARNING'):
+            await notifier.send(5, 'После паузы')
+            await notifier.join()
+
+        self.assertGreaterEqual(time.monotonic() - started, 0.95)
+        self.assertEqual(self.api.sent_messages, [(5, 'После паузы')])
+
+    async def test_blocked_chat_is_not_retried(self):
+        notifier = await self.dispatcher()
+        self.api.blocked_chats.add(7)
+        failed = []
+
+        async def on_failed():
+            failed.append(7)
+
+        with self.assertLogs('notification_dispatcher', level='ERROR'):
+            await notifier.send(7, 'Заблокирован', on_delivered=AsyncMock(), on_failed=on_failed)
+            await notifier.join()
+
+        self.assertEqual(failed, [7])
+        self.assertEqual(notifier.failed, 1)
+        self.assertEqual(self.api.sent_messages, [])
+
+    async def test_send_requires_started_dispatcher(self):
+        with self.assertRaises(RuntimeError):
+            await NotificationDispatcher(self.bot).send(1, 'Текст')
+
+
+class TestSQLiteStorage(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.pool = ConnectionPool(os.path.join(self.tmp_dir.name, 'test.db'), readers=1)
+        await self.pool.open()
+        await DatabaseManager(self.pool).init_db()
+        self.write_queue = WriteQueue(self.pool)
+        self.write_queue.start()
+        self.storage = SQLiteStorage(self.pool, self.write_queue, flush_interval=0.01)
+        self.storage.start()
+
+    async def asyncTearDown(self):
+        await self.storage.close()
+        await self.write_queue.close()
+        await self.pool.close()
+        self.tmp_dir.cleanup()
+
+    async def stored_rows(self):
+        async with self.pool.reader() as db:
+            async with db.execute('SELECT chat, user, state, data FROM fsm_storage') as cursor:
+                return await cursor.fetchall()
+
+    async def test_dialog_survives_restart(self):
+        await self.storage.set_state(chat=1, user=1, state='AddExpense:amount')
+        await self.storage.update_data(chat=1, user=1, category='Продукты')
+        await self.storage.close()
+
+        restarted = SQLiteStorage(self.pool, self.write_queue)
+        self.assertEqual(await restarted.get_state(chat=1, user=1), 'AddExpense:amount')
+        self.assertEqual(await restarted.get_data(chat=1, user=1), {'category': 'Продукты'})
+
+    async def test_updates_are_coalesced_into_one_write(self):
+        with patch.object(self.write_queue, 'submit', wraps=self.write_queue.submit) as submit:
+            await self.storage.set_state(chat=1, user=1, state='AddIncome:category')
+            for amount in range(10):
+                await self.storage.update_data(chat=1, user=1, amount=amount)
+            await asyncio.sleep(0.1)
+
+        self.assertEqual(submit.await_count, 1)
+        self.assertEqual(await self.stored_rows(), [('1', '1', 'AddIncome:category', '{"amount": 9}')])
+
+    async def test_reads_are_served_from_cache(self):
+        await self.storage.set_state(chat=1, user=1, state='AddIncome:amount')
+        await self.storage.flush()
+
+        with patch.object(self.pool, 'reader', wraps=self.pool.reader) as reader:
+            for _ in range(5):
+                self.assertEqual(await self.storage.get_state(chat=1, user=1), 'AddIncome:amount')
+        reader.assert_not_called()
+
+    async def test_finish_removes_record(self):
+        await self.storage.set_state(chat=1, user=1, state='AddIncome:amount')
+        await self.storage.update_data(chat=1, user=1, amount=5)
+        await self.storage.flush()
+
+        await self.storage.finish(chat=1, user=1)
+        await self.storage.flush()
+
+        self.assertEqual(await self.stored_rows(), [])
+        self.assertIsNone(await self.storage.get_state(chat=1, user=1))
+
+    async def test_returned_data_is_a_copy(self):
+        await self.storage.set_data(chat=1, user=1, data={'items': [1]})
+        data = await self.storage.get_data(chat=1, user=1)
+        data['items'].append(2)
+
+        self.assertEqual(await self.storage.get_data(chat=1, user=1), {'items': [1]})
+
+
+def fake_update(update_id, user_id, text):
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': 0,
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': 'Тест'},
+            'text': text,
+        },
+    }
+
+
+class TestWebhookServer(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.bot = Bot('123456:TEST-TOKEN')
+        self.dp = Dispatcher(self.bot, storage=MemoryStorage())
+        self.handled = []
+        self.release = asyncio.Event()
+        self.release.set()
+
+        async def handler(message):
+            # Первое сообщение обрабатывается дольше остальных
+            await asyncio.sleep(0.1 if message.text == '1' else 0)
+            await self.release.wait()
+            self.handled.append((message.from_user.id, message.text))
+
+        self.dp.register_message_handler(handler)
+        self.session = aiohttp.ClientSession()
+
+    async def asyncTearDown(self):
+        await self.session.close()
+        await (await self.bot.get_session()).close()
+
+    async def start_server(self, **kwargs):
+        server = WebhookServer(self.dp, host='127.0.0.1', port=0, **kwargs)
+        await server.start()
+        self.addAsyncCleanup(server.close)
+        self.url = f'http://127.0.0.1:{server.port}/webhook'
+        return server
+
+    async def post(self, payload, headers=None):
+        async with self.session.post(self.url, json=payload, headers=headers) as response:
+            return response.status
+
+    def test_update_user_id(self):
+        self.assertEqual(update_user_id(fake_update(1, 42, 'x')), 42)
+        self.assertIsNone(update_user_id({'update_id': 1, 'poll': {'id': '1'}}))
+
+    async def test_updates_are_acknowledged_and_processed(self):
+        server = await self.start_server()
+
+        statuses = await asyncio.gather(*(self.post(fake_update(i, 100 + i, 'привет')) for i in range(5)))
+        await server.close()
+
+        self.assertEqual(statuses, [200] * 5)
+        self.assertEqual(sorted(self.handled), [(100 + i, 'привет') for i in range(5)])
+
+    async def test_per_user_order_is_preserved(self):
+        server = await self.start_server()
+
+        for number in ('1', '2', '3'):
+            await self.post(fake_update(int(number), 7, number))
+        await self.post(fake_update(4, 8, 'другой'))
+        await server.close()
+
+        self.assertEqual([text for user, text in self.handled if user == 7], ['1', '2', '3'])
+        self.assertEqual(self.handled[0], (8, 'другой'))
+
+    async def test_in_flight_limit_applies_backpressure(self):
+        server = await self.start_server(max_in_flight=1, acquire_timeout=0.05)
+        self.release.clear()
+
+        self.assertEqual(await self.post(fake_update(1, 1, 'a')), 200)
+        self.assertEqual(await self.post(fake_update(2, 2, 'b')), 503)
+        self.assertEqual(server.in_flight, 1)
+
+        self.release.set()
+        await server.close()
+        self.assertEqual(self.handled, [(1, 'a')])
+
+    async def test_secret_token_is_checked(self):
+        await self.start_server(secret_token='s3cret')
+
+        self.assertEqual(await self.post(fake_update(1, 1, 'a')), 401)
+        self.assertEqual(await self.post(fake_update(1, 1, 'a'), {'X-Telegram-Bot-Api-Secret-Token': 's3cret'}), 200)
+
+
+class TestSharding(unittest.IsolatedAsyncioTestCase):
+
+    def test_shard_for_is_stable(self):
+        self.assertEqual(shard_for(10, 4), shard_for(10, 4))
+        self.assertEqual({shard_for(user_id, 4) for user_id in range(100)}, {0, 1, 2, 3})
+        self.assertEqual(shard_for(None, 4), 0)
+
+    async def test_router_keeps_user_updates_on_one_worker_in_order(self):
+        results = multiprocessing.get_context('fork').Queue()
+
+        def worker_main(index, queue):
+            while True:
+                payload = queue.get()
+                if payload is None:
+                    break
+                results.put((index, payload['message']['from']['id'], payload['update_id']))
+
+        router = ShardRouter(worker_main, workers=3, queue_size=2)
+        router.start()
+        for update_id in range(30):
+            await router.route(fake_update(update_id, update_id % 5, 'x'))
+        await router.close()
+
+        received = [results.get(timeout=5) for _ in range(30)]
+        for user_id in range(5):
+            routed = [(index, update_id) for index, user, update_id in received if user == user_id]
+            self.assertEqual({index for index, _ in routed}, {shard_for(user_id, 3)})
+            self.assertEqual([update_id for _, update_id in routed], list(range(user_id, 30, 5)))
+
+    async def test_dispatcher_routes_updates_sequentially(self):
+        router = MagicMock()
+        dispatcher = ShardingDispatcher(Bot('123456:TEST-TOKEN'), router)
+
+        await dispatcher.process_updates([types.Update(**fake_update(i, 1, str(i))) for i in range(3)])
+
+        self.assertEqual([call.args[0]['update_id'] for call in router.submit.call_args_list], [0, 1, 2])
+
+    async def test_concurrent_batches_keep_order_when_worker_queue_is_full(self):
+        results = multiprocessing.get_context('fork').Queue()
+
+        def worker_main(index, queue):
+            while True:
+                payload = queue.get()
+                if payload is None:
+                    break
+                time.sleep(0.005)
+                results.put(payload['update_id'])
+
+        router = ShardRouter(worker_main, workers=1, queue_size=1)
+        router.start()
+        dispatcher = ShardingDispatcher(Bot('123456:TEST-TOKEN'), router)
+        batches = [[types.Update(**fake_update(batch * 10 + i, 1, 'x')) for i in range(10)] for batch in range(3)]
+        # Как при polling: каждая пачка обрабатывается своей задачей, пока предыдущая ещё не передана воркеру
+        await asyncio.gather(*(dispatcher.process_updates(batch) for batch in batches))
+        await router.close()
+
+        self.assertEqual([results.get(timeout=5) for _ in range(30)], list(range(30)))
+
+    async def test_full_channel_stops_intake_until_workers_catch_up(self):
+        release = multiprocessing.get_context('fork').Event()
+
+        def worker_main(index, queue):
+            release.wait(5)
+            while queue.get() is not None:
+                pass
+
+        router = ShardRouter(worker_main, workers=1, queue_size=1, channel_size=3)
+        router.start()
+        for update_id in range(5):
+            router.submit(fake_update(update_id, 1, 'x'))
+
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(router.wait_for_room(), 0.2)
+        release.set()
+        await asyncio.wait_for(router.wait_for_room(), 5)
+        await router.close()
+
+    async def test_polling_waits_for_room_before_next_get_updates(self):
+        router = MagicMock()
+        router.wait_for_room = AsyncMock()
+        bot = Bot('123456:TEST-TOKEN')
+        bot.get_updates = AsyncMock(side_effect=[[types.Update(**fake_update(1, 1, 'x'))], asyncio.CancelledError])
+        dispatcher = ShardingDispatcher(bot, router)
+
+        with patch.object(dispatcher, 'reset_webhook', AsyncMock()):
+            await dispatcher.start_polling(relax=0)
+        await asyncio.sleep(0)
+
+        self.assertEqual(router.wait_for_room.await_count, 2)
+        self.assertEqual(bot.get_updates.await_count, 2)
+        router.submit.assert_called_once()
+
+
+class TestLoadTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_report_is_machine_readable(self):
+        report = await run_load_test(users=4, scenarios=3, mix='add_expense=1,convert=1,contribute=1')
+
+        self.assertEqual(report['errors'], 0)
+        self.assertEqual(report['updates'], sum(stats['count'] for label, stats in report['latency'].items()
+                                                if label != 'all'))
+        self.assertGreater(report['updates_per_s'], 0)
+        self.assertTrue({'p50_ms', 'p95_ms', 'p99_ms'} <= set(report['latency']['all']))
+        self.assertGreater(report['db_locks']['writer']['acquired'], 0)
+        self.assertGreater(report['telegram_calls'], 0)
+
+    def test_unknown_scenario_rejected(self):
+        with self.assertRaises(ValueError):
+            asyncio.run(run_load_test(users=1, mix='unknown=1'))
+
+
+class TestMetrics(unittest.IsolatedAsyncioTestCase):
 
     def setUp(self):
-        self.mock_xml_response = '''<?xml version="1.0" encoding="windows-1251"?>
-        <ValCurs Date="01.01.2023" name="Foreign Currency Market">
-            <Valute ID="R01010">
-                <CharCode>USD</CharCode>
-                <Nominal>1</Nominal>
-                <Value>76.32</Value>
-            </Valute>
-            <Valute ID="R01035">
-                <CharCode>EUR</CharCode>
-                <Nominal>1</Nominal>
-                <Value>90.57</Value>
-            </Valute>
-        </ValCurs>'''
-        self.patcher = patch('requests.get')
-        self.mock_requests_get = self.patcher.start()
-        self.mock_requests_get.return_value.content = self.mock_xml_response
+        self.registry = MetricsRegistry()
+
+    def test_histogram_renders_cumulative_buckets(self):
+        histogram = Histogram('test_seconds', 'Тест', ['handler'], buckets=(0.1, 1), registry=self.registry)
+        for value in (0.05, 0.5, 5):
+            histogram.labels('cmd_start').observe(value)
+        Counter('test_rejected', 'Отказы', registry=self.registry).inc()
+        Gauge('test_depth', 'Глубина', lambda: 7, registry=self.registry)
+
+        text = self.registry.render()
+
+        self.assertIn('# TYPE test_seconds histogram', text)
+        self.assertIn('test_seconds_bucket{handler="cmd_start",le="0.1"} 1', text)
+        self.assertIn('test_seconds_bucket{handler="cmd_start",le="1.0"} 2', text)
+        self.assertIn('test_seconds_bucket{handler="cmd_start",le="+Inf"} 3', text)
+        self.assertIn('test_seconds_count{handler="cmd_start"} 3', text)
+        self.assertIn('test_rejected_total 1', text)
+        self.assertIn('test_depth 7', text)
+
+    def test_duplicate_and_mislabelled_metrics_rejected(self):
+        histogram = Histogram('test_seconds', 'Тест', ['handler'], registry=self.registry)
+        with self.assertRaises(ValueError):
+            Histogram('test_seconds', 'Тест', registry=self.registry)
+        with self.assertRaises(ValueError):
+            histogram.labels('a', 'b')
+
+    def test_statement_label(self):
+        self.assertEqual(statement_label('SELECT id FROM users WHERE telegram_id = ?'), 'SELECT users')
+        self.assertEqual(statement_label('\n    INSERT INTO income (user_id) VALUES (?)'), 'INSERT income')
+        self.assertEqual(statement_label('UPDATE financial_goals SET current_amount = ?'), 'UPDATE financial_goals')
+        self.assertEqual(statement_label('DELETE FROM reminders WHERE id = ?'), 'DELETE reminders')
+        self.assertEqual(statement_label('PRAGMA busy_timeout=5000'), 'PRAGMA')
+
+    async def test_pool_queries_are_timed_by_statement(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            pool = ConnectionPool(os.path.join(tmp_dir, 'test.db'), readers=1, instrument=True)
+            await pool.open()
+            try:
+                async with pool.writer() as db:
+                    await db.execute('CREATE TABLE metric_probe (id INTEGER)')
+                    await db.executemany('INSERT INTO metric_probe VALUES (?)', [(1,), (2,)])
+                    await db.commit()
+                async with pool.reader() as db:
+                    async with db.execute('SELECT id FROM metric_probe') as cursor:
+                        self.assertEqual(await cursor.fetchall(), [(1,), (2,)])
+            finally:
+                await pool.close()
+
+        self.assertGreater(DB_QUERY_SECONDS.labels('INSERT metric_probe').count, 0)
+        self.assertGreater(DB_QUERY_SECONDS.labels('SELECT metric_probe').count, 0)
+
+    async def test_middleware_times_handlers_and_server_exposes_metrics(self):
+        histogram = Histogram('test_handler_seconds', 'Тест', ['handler'], registry=self.registry)
+        bot = Bot('123456:TEST-TOKEN')
+        dp = Dispatcher(bot, storage=MemoryStorage())
+        dp.middleware.setup(MetricsMiddleware(histogram))
+
+        async def cmd_ping(message):
+            pass
+
+        dp.register_message_handler(cmd_ping)
+        Dispatcher.set_current(dp)
+        Bot.set_current(bot)
+        await dp.process_update(types.Update(**fake_update(1, 42, 'ping')))
+        await (await bot.get_session()).close()
+        self.assertEqual(histogram.labels('cmd_ping').count, 1)
+
+        server = MetricsServer(self.registry, host='127.0.0.1', port=0)
+        await server.start()
+        self.addAsyncCleanup(server.close)
+        async with aiohttp.ClientSession() as session:
+            async with session.get(f'http://127.0.0.1:{server.port}/metrics') as response:
+                self.assertEqual(response.status, 200)
+                self.assertTrue(response.headers['Content-Type'].startswith('text/plain'))
+                self.assertIn('test_handler_seconds_count{handler="cmd_ping"} 1', await response.text())
+
+
+class TestWriteQueue(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.pool = ConnectionPool(os.path.join(self.tmp_dir.name, 'test.db'), readers=1)
+        await self.pool.open()
+        await DatabaseManager(self.pool).init_db()
+        self.write_queue = WriteQueue(self.pool, max_batch=50, flush_interval=0.01)
+        self.write_queue.start()
+
+    async def asyncTearDown(self):
+        await self.write_queue.close()
+        await self.pool.close()
+        self.tmp_dir.cleanup()
+
+    async def count(self, table):
+        async with self.pool.reader() as db:
+            async with db.execute(f'SELECT COUNT(*) FROM {table}') as cursor:
+                return (await cursor.fetchone())[0]
+
+    async def test_concurrent_inserts_are_group_committed(self):
+        sql = 'INSERT INTO users (telegram_id) VALUES (?)'
+        with patch.object(self.write_queue, '_execute', wraps=self.write_queue._execute) as execute:
+            await asyncio.gather(*(self.write_queue.submit((sql, (i,))) for i in range(120)))
+
+        self.assertEqual(await self.count('users'), 120)
+        self.assertLess(execute.await_count, 120)
+
+    async def test_submit_reports_changed_rows(self):
+        insert = 'INSERT INTO users (telegram_id) VALUES (?)'
+        update = 'UPDATE users SET data_version = data_version + 1 WHERE telegram_id = ?'
+        self.assertEqual(await self.write_queue.submit((insert, (1,)), (update, (2,))), [1, 0])
+
+        # В серии известны только нули, ненулевое число строк одной отправки неизвестно
+        results = await asyncio.gather(*(self.write_queue.submit((insert, (i,)), (update, (2,))) for i in (2, 3)))
+        self.assertEqual(results, [[None, None], [None, None]])
+
+    async def test_failed_row_does_not_fail_batch(self):
+        sql = 'INSERT INTO users (telegram_id) VALUES (?)'
+        results = await asyncio.gather(
+            self.write_queue.submit((sql, (1,))),
+            self.write_queue.submit((sql, (1,))),
+            self.write_queue.submit((sql, (2,))),
+            return_exceptions=True,
+        )
 
-        self.currency_manager = CurrencyManager()
+        self.assertEqual(sum(isinstance(result, sqlite3.IntegrityError) for result in results), 1)
+        self.assertEqual(await self.count('users'), 2)
+
+    async def test_batch_keeps_order_of_different_statements(self):
+        upsert = ('INSERT INTO budgets (user_id, category, amount, currency) VALUES (1, ?, ?, ?) '
+                  'ON CONFLICT (user_id, category) DO UPDATE SET amount = excluded.amount')
+        delete = 'DELETE FROM budgets WHERE user_id = 1 AND category = ?'
+        with patch.object(self.write_queue, '_execute', wraps=self.write_queue._execute) as execute:
+            await asyncio.gather(
+                self.write_queue.submit((upsert, ('Продукты', 100, 'RUB'))),
+                self.write_queue.submit((delete, ('Продукты',))),
+                self.write_queue.submit((upsert, ('Продукты', 200, 'RUB'))),
+                self.write_queue.submit((upsert, ('Транспорт', 50, 'RUB'))),
+            )
+
+        execute.assert_awaited_once()
+        async with self.pool.reader() as db:
+            async with db.execute('SELECT category, amount FROM budgets ORDER BY category') as cursor:
+                self.assertEqual(await cursor.fetchall(), [('Продукты', 200), ('Транспорт', 50)])
+            async with db.execute('PRAGMA synchronous') as cursor:
+                # 2 — FULL: подтверждённый COMMIT уже синхронизирован с диском
+                self.assertEqual((await cursor.fetchone())[0], 2)
+
+    async def test_close_drains_queue(self):
+        sql = 'INSERT INTO users (telegram_id) VALUES (?)'
+        tasks = [asyncio.create_task(self.write_queue.submit((sql, (i,)))) for i in range(10)]
+        await asyncio.sleep(0)
+
+        await self.write_queue.close()
+        await asyncio.gather(*tasks)
+
+        self.assertEqual(await self.count('users'), 10)
+        with self.assertRaises(RuntimeError):
+            await self.write_queue.submit((sql, (11,)))
+
+
+class TestUserManagerCache(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.pool = ConnectionPool(os.path.join(self.tmp_dir.name, 'test.db'), readers=1)
+        await self.pool.open()
+        await DatabaseManager(self.pool).init_db()
+        self.user_manager = UserManager(self.pool, cache_size=2)
+
+    async def asyncTearDown(self):
+        await self.pool.close()
+        self.tmp_dir.cleanup()
+
+    async def test_new_user_resolved_and_cached_both_ways(self):
+        user_id = await self.user_manager.get_user_id(111)
+
+        self.assertEqual(await self.user_manager.get_user_id(111), user_id)
+        self.assertEqual(await self.user_manager.get_telegram_id(user_id), 111)
+        stats = self.user_manager.cache_stats()
+        self.assertEqual(stats['user_id']['misses'], 1)
+        self.assertEqual(stats['user_id']['hits'], 1)
+        self.assertEqual(stats['telegram_id']['hits'], 1)
+
+    async def test_existing_user_is_not_duplicated(self):
+        await self.user_manager.add_user(111)
+        user_id = await UserManager(self.pool).get_user_id(111)
+
+        self.assertEqual(await self.user_manager.get_user_id(111), user_id)
+        async with self.pool.reader() as db:
+            async with db.execute('SELECT COUNT(*) FROM users') as cursor:
+                self.assertEqual((await cursor.fetchone())[0], 1)
+
+    async def test_cache_is_bounded(self):
+        for telegram_id in (1, 2, 3):
+            await self.user_manager.get_user_id(telegram_id)
+
+        self.assertEqual(self.user_manager.cache_stats()['user_id']['size'], 2)
+
+    async def test_unknown_user_id_raises(self):
+        with self.assertRaises(ValueError):
+            await self.user_manager.get_telegram_id(999)
+
+    async def test_bulk_telegram_ids_use_one_query_for_misses(self):
+        user_ids = [await UserManager(self.pool).get_user_id(telegram_id) for telegram_id in (10, 20, 30)]
+        await self.user_manager.get_telegram_id(user_ids[0])
+
+        with patch.object(self.pool, 'reader', wraps=self.pool.reader) as reader:
+            result = await self.user_manager.get_telegram_ids([*user_ids, user_ids[1], 999])
+
+        self.assertEqual(result, {user_ids[0]: 10, user_ids[1]: 20, user_ids[2]: 30})
+        self.assertEqual(reader.call_count, 1)
+
+
+class TestCategoryTotals(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.pool = ConnectionPool(os.path.join(self.tmp_dir.name, 'test.db'), readers=1)
+        await self.pool.open()
+        self.db_manager = DatabaseManager(self.pool)
+        await self.db_manager.init_db()
+        self.write_queue = WriteQueue(self.pool)
+        self.write_queue.start()
+        self.finance_manager = FinanceManager(self.pool, UserManager(self.pool), self.write_queue,
+                                              AsyncMock(spec=ChartRenderer), ChartCache(), RateStore(self.pool))
+
+    async def asyncTearDown(self):
+        await self.write_queue.close()
+        await self.pool.close()
+        self.tmp_dir.cleanup()
+
+    async def test_inserts_update_rollup(self):
+        await self.finance_manager.add_income(1, 'Зарплата', 1000, 'RUB')
+        await self.finance_manager.add_income(1, 'Зарплата', 500, 'RUB')
+        await self.finance_manager.add_expense(1, 'Продукты', 250, 'RUB')
+
+        totals = await self.finance_manager.get_category_totals(1)
+
+        self.assertEqual(totals, {'income': {'Зарплата': 1500}, 'expense': {'Продукты': 250}})
+        self.assertEqual(await self.finance_manager.get_summary(1),
+                         "Итого доходов: 1500.00 RUB\nИтого расходов: 250.00 RUB")
+
+    async def test_statistics_pages_are_keyset_paginated(self):
+        async with self.pool.writer() as db:
+            await db.execute('INSERT INTO users (telegram_id) VALUES (1)')
+            for day in range(1, 6):
+                await db.execute("INSERT INTO income (user_id, category, amount, currency, date) "
+                                 "VALUES (1, 'Зарплата', ?, 'RUB', ?)", (day, f'2024-01-0{day}T10:00:00'))
+                await db.execute("INSERT INTO expenses (user_id, category, amount, currency, date) "
+                                 "VALUES (1, 'Продукты', ?, 'RUB', ?)", (day, f'2024-01-0{day}T10:00:00'))
+            await db.commit()
+
+        first = await self.finance_manager.get_statistics_page(1, page_size=4)
+        second = await self.finance_manager.get_statistics_page(1, cursor=first.next_cursor, page_size=4)
+        back = await self.finance_manager.get_statistics_page(1, cursor=second.prev_cursor, backward=True,
+                                                              page_size=4)
+
+        self.assertIsNone(first.prev_cursor)
+        self.assertIn('2024-01-05', first.text)
+        self.assertNotIn('2024-01-03', first.text)
+        self.assertIn('2024-01-03', second.text)
+        self.assertIsNotNone(second.prev_cursor)
+        self.assertEqual(back.text, first.text)
+        self.assertIsNone(back.prev_cursor)
+
+        ranged = await self.finance_manager.get_statistics_page(1, date_from=datetime.date(2024, 1, 2),
+                                                                date_to=datetime.date(2024, 1, 2))
+        self.assertEqual(ranged.text.count('2024-01-02'), 2)
+        self.assertNotIn('2024-01-03', ranged.text)
+        self.assertIsNone(ranged.next_cursor)
+
+    async def test_rebuild_matches_incremental_rollup(self):
+        await self.finance_manager.add_income(1, 'Зарплата', 1000, 'RUB')
+        await self.finance_manager.add_expense(1, 'Продукты', 250, 'USD')
+        async with self.pool.writer() as db:
+            await db.execute("INSERT INTO expenses (user_id, category, amount, currency, date) "
+                             "VALUES (1, 'Продукты', 50, 'USD', '2020-01-01T00:00:00')")
+            await db.commit()
+
+        await self.db_manager.rebuild_category_totals()
+
+        totals = await self.finance_manager.get_category_totals(1)
+        self.assertEqual(totals, {'income': {'Зарплата': 1000}, 'expense': {'Продукты': 300}})
+
+
+class TestCsvImport(unittest.IsolatedAsyncioTestCase):
+
+    CSV = ('Дата операции;Сумма операции;Валюта операции;Категория\r\n'
+           '01.02.2024 10:00:00;-1 234,50;RUB;Супермаркеты\r\n'
+           '02.02.2024;50000;RUB;Зарплата\r\n'
+           ';;;\r\n'
+           'вчера;-10;RUB;Такси\r\n'
+           '03.02.2024;-100;usd;Такси\r\n'
+           '2024-03-01;-20;RUB;Аптеки\r\n')
+
+    async def asyncSetUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.pool = ConnectionPool(os.path.join(self.tmp_dir.name, 'test.db'), readers=1)
+        await self.pool.open()
+        self.db_manager = DatabaseManager(self.pool)
+        await self.db_manager.init_db()
+        self.finance_manager = FinanceManager(self.pool, UserManager(self.pool), AsyncMock(spec=WriteQueue),
+                                              AsyncMock(spec=ChartRenderer), ChartCache(), RateStore(self.pool))
+
+    async def asyncTearDown(self):
+        await self.pool.close()
+        self.tmp_dir.cleanup()
+
+    async def import_csv(self, content: bytes, **kwargs):
+        progress = []
+
+        async def on_progress(result):
+            progress.append(result.imported)
+
+        with tempfile.TemporaryFile() as file:
+            file.write(content)
+            file.seek(0)
+            result = await self.finance_manager.import_transactions(1, file, on_progress, **kwargs)
+        return result, progress
+
+    async def test_import_maps_categories_and_updates_rollup(self):
+        result, progress = await self.import_csv(self.CSV.encode('cp1251'), chunk_size=2)
+
+        self.assertEqual((result.imported, result.skipped), (4, 1))
+        self.assertEqual(len(result.errors), 1)
+        self.assertTrue(result.errors[0].startswith('строка 5:'))
+        self.assertEqual(progress, [2, 2, 4, 4])
+
+        totals = await self.finance_manager.get_category_totals(1)
+        self.assertEqual(totals, {'income': {'Зарплата': 50000},
+                                  'expense': {'Продукты': 1234.5, 'Транспорт': 100, 'Другое': 20}})
+        await self.db_manager.rebuild_category_totals()
+        self.assertEqual(await self.finance_manager.get_category_totals(1), totals)
+        self.assertGreater(await self.finance_manager.get_data_version(await UserManager(self.pool).get_user_id(1)),
+                           0)
+
+    async def test_import_detects_utf8_and_comma_delimiter(self):
+        content = '\ufeffdate,amount,currency,type\n2024-01-01,15.5,EUR,расход\n'.encode('utf-8')
+
+        result, _ = await self.import_csv(content)
+
+        self.assertEqual((result.imported, result.skipped), (1, 0))
+        async with self.pool.reader() as db:
+            async with db.execute('SELECT category, amount, currency, date FROM expenses') as cursor:
+                self.assertEqual(await cursor.fetchall(), [('Другое', 15.5, 'EUR', '2024-01-01T00:00:00')])
+
+    async def test_import_requires_date_and_amount_columns(self):
+        with self.assertRaises(ValueError):
+            await self.import_csv('Описание;Сумма\nКофе;-100\n'.encode('utf-8'))
+
+
+class TestBudgets(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.pool = ConnectionPool(os.path.join(self.tmp_dir.name, 'test.db'), readers=1)
+        await self.pool.open()
+        await DatabaseManager(self.pool).init_db()
+        self.write_queue = WriteQueue(self.pool)
+        self.write_queue.start()
+        self.notifier = AsyncMock(spec=NotificationDispatcher)
+        self.finance_manager = FinanceManager(self.pool, UserManager(self.pool), self.write_queue,
+                                              AsyncMock(spec=ChartRenderer), ChartCache(), RateStore(self.pool),
+                                              self.notifier)
+        await self.finance_manager.set_budget(1, 'Продукты', 100)
+
+    async def asyncTearDown(self):
+        await self.write_queue.close()
+        await self.pool.close()
+        self.tmp_dir.cleanup()
+
+    def sent_texts(self):
+        return [call.args[1] for call in self.notifier.send.await_args_list]
+
+    async def test_alert_sent_once_per_threshold(self):
+        for amount in (50, 35, 10, 20, 5):
+            await self.finance_manager.add_expense(1, 'Продукты', amount, 'RUB')
+        await self.finance_manager.add_expense(1, 'Транспорт', 500, 'RUB')
+        await self.finance_manager.add_expense(1, 'Продукты', 500, 'USD')
+        await self.finance_manager.join_alerts()
+
+        texts = self.sent_texts()
+        self.assertEqual(len(texts), 2)
+        self.assertIn('Потрачено 80% бюджета «Продукты»', texts[0])
+        self.assertIn('85\\.00 из 100\\.00 RUB', texts[0])
+        self.assertIn('превышен: потрачено 115\\.00', texts[1])
+        self.assertEqual(self.notifier.send.await_args_list[0].args[0], 1)
+
+        budgets = await self.finance_manager.get_budgets(1)
+        self.assertEqual(budgets, [('Продукты', 100, 'RUB', 120)])
+
+    async def test_concurrent_expenses_send_single_highest_alert(self):
+        await asyncio.gather(*(self.finance_manager.add_expense(1, 'Продукты', 40, 'RUB') for _ in range(3)))
+        await self.finance_manager.join_alerts()
+
+        texts = self.sent_texts()
+        self.assertEqual(len(texts), 1)
+        self.assertIn('превышен', texts[0])
+
+    async def test_expense_below_threshold_costs_only_the_write(self):
+        with patch.object(self.pool, 'reader', wraps=self.pool.reader) as reader, \
+                patch.object(self.pool, 'writer', wraps=self.pool.writer) as writer:
+            await self.finance_manager.add_expense(1, 'Продукты', 10, 'RUB')
+            await self.finance_manager.join_alerts()
+
+        reader.assert_not_called()
+        self.assertEqual(writer.call_count, 1)
+        self.notifier.send.assert_not_awaited()
+
+    async def test_slow_notifier_does_not_delay_expense(self):
+        release = asyncio.Event()
+
+        async def send(*args, **kwargs):
+            await release.wait()
+
+        self.notifier.send.side_effect = send
+        # Расход подтверждается, пока отправка уведомления ещё висит в очереди
+        await asyncio.wait_for(self.finance_manager.add_expense(1, 'Продукты', 150, 'RUB'), 1)
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(asyncio.shield(self.finance_manager.join_alerts()), 0.2)
+        self.notifier.send.assert_called_once()
+
+        release.set()
+        await self.finance_manager.join_alerts()
+        self.notifier.send.assert_awaited_once()
+
+    async def test_import_records_alerts_for_current_month_only(self):
+        content = (f'Дата операции;Сумма операции;Валюта операции;Категория\r\n'
+                   f'{datetime.date.today():%d.%m.%Y};-90;RUB;Супермаркеты\r\n'
+                   f'01.01.2020;-500;RUB;Супермаркеты\r\n')
+        with tempfile.TemporaryFile() as file:
+            file.write(content.encode('utf-8'))
+            file.seek(0)
+            await self.finance_manager.import_transactions(1, file)
+        await self.finance_manager.join_alerts()
+
+        texts = self.sent_texts()
+        self.assertEqual(len(texts), 1)
+        self.assertIn('Потрачено 80% бюджета «Продукты»', texts[0])
+
+    async def test_set_budget_validates_and_removes(self):
+        with self.assertRaises(ValueError):
+            await self.finance_manager.set_budget(1, 'Зарплата', 100)
+        with self.assertRaises(ValueError):
+            await self.finance_manager.set_budget(1, 'Продукты', -1)
+
+        await self.finance_manager.set_budget(1, 'Продукты', 0)
+        await self.finance_manager.add_expense(1, 'Продукты', 500, 'RUB')
+        await self.finance_manager.join_alerts()
+
+        self.assertEqual(await self.finance_manager.get_budgets(1), [])
+        self.notifier.send.assert_not_awaited()
+
+
+class TestHistoryExport(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.pool = ConnectionPool(os.path.join(self.tmp_dir.name, 'test.db'), readers=1)
+        await self.pool.open()
+        await DatabaseManager(self.pool).init_db()
+        self.finance_manager = FinanceManager(self.pool, UserManager(self.pool), AsyncMock(spec=WriteQueue),
+                                              AsyncMock(spec=ChartRenderer), ChartCache(), RateStore(self.pool))
+        self.export_queue = ExportQueue(self.finance_manager, batch_size=2)
+        self.export_queue.start()
+
+        content = ('date;amount;category\n' + ''.join(
+            f'2024-01-0{day}T10:00:00.5;{-day if day % 2 else day * 100};Такси\n' for day in range(1, 6))
+        ).encode('utf-8')
+        await self.finance_manager.import_transactions(1, io.BytesIO(content))
+
+    async def asyncTearDown(self):
+        await self.export_queue.close()
+        await self.pool.close()
+        self.tmp_dir.cleanup()
+
+    async def export(self, telegram_id, export_format):
+        done = asyncio.get_running_loop().create_future()
+
+        async def deliver(file, filename):
+            done.set_result((file.read(), filename))
+
+        self.export_queue.submit(telegram_id, export_format, deliver)
+        return await asyncio.wait_for(done, 5)
+
+    async def test_csv_export_is_ordered_and_reimportable(self):
+        content, filename = await self.export(1, 'csv')
+
+        self.assertTrue(filename.endswith('.csv'))
+        rows = list(csv.reader(io.StringIO(content.decode('utf-8-sig'))))
+        self.assertEqual(rows[0], ['date', 'type', 'category', 'amount', 'currency', 'note'])
+        self.assertEqual([row[0][:10] for row in rows[1:]], [f'2024-01-0{day}' for day in range(1, 6)])
+        self.assertEqual(rows[1][1:], ['expense', 'Транспорт', '1.0', 'RUB', 'Такси'])
+
+        result = await self.finance_manager.import_transactions(2, io.BytesIO(content))
+        self.assertEqual((result.imported, result.skipped), (5, 0))
+        self.assertEqual(await self.finance_manager.get_category_totals(2),
+                         await self.finance_manager.get_category_totals(1))
+
+    async def test_jsonl_export_is_gzipped(self):
+        content, filename = await self.export(1, 'jsonl')
+
+        self.assertTrue(filename.endswith('.jsonl.gz'))
+        records = [json.loads(line) for line in gzip.decompress(content).decode('utf-8').splitlines()]
+        self.assertEqual(len(records), 5)
+        self.assertEqual(records[1], {'date': '2024-01-02T10:00:00.500000', 'type': 'income', 'category': 'Другое',
+                                      'amount': 200.0, 'currency': 'RUB', 'note': 'Такси'})
+
+    async def test_duplicate_and_failed_exports(self):
+        release = asyncio.Event()
+        failed = asyncio.Event()
+
+        async def deliver(file, filename):
+            await release.wait()
+            raise RuntimeError("upload failed")
+
+        async def on_failed():
+            failed.set()
+
+        self.export_queue.submit(1, 'csv', deliver, on_failed)
+        with self.assertRaises(ValueError):
+            self.export_queue.submit(1, 'csv', deliver)
+        release.set()
+        await asyncio.wait_for(failed.wait(), 5)
+
+        content, _ = await self.export(1, 'csv')
+        self.assertTrue(content)
+
+
+class TestArchive(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.archive_dir = os.path.join(self.tmp_dir.name, 'archive')
+        self.pool = ConnectionPool(os.path.join(self.tmp_dir.name, 'test.db'), readers=1,
+                                   archive_dir=self.archive_dir)
+        await self.pool.open()
+        self.db_manager = DatabaseManager(self.pool)
+        await self.db_manager.init_db()
+        self.finance_manager = FinanceManager(self.pool, UserManager(self.pool), AsyncMock(spec=WriteQueue),
+                                              AsyncMock(spec=ChartRenderer), ChartCache(), RateStore(self.pool))
+        self.archive_manager = ArchiveManager(self.pool, max_age_days=730, batch_size=3, attach_grace=0)
+
+        content = 'date;amount;category\n' + ''.join(
+            f'{year}-0{month}-15;{-month * 10 if month % 2 else month * 100};Такси\n'
+            for year in (2021, 2022, 2025) for month in range(1, 5))
+        await self.finance_manager.import_transactions(1, io.BytesIO(content.encode('utf-8')))
+
+    async def asyncTearDown(self):
+        await self.pool.close()
+        self.tmp_dir.cleanup()
+
+    async def count_main(self):
+        async with self.pool.reader() as db:
+            async with db.execute('SELECT substr(date, 1, 4), COUNT(*) FROM main.income GROUP BY 1 UNION ALL '
+                                  'SELECT substr(date, 1, 4), COUNT(*) FROM main.expenses GROUP BY 1') as cursor:
+                counts = {}
+                for year, count in await cursor.fetchall():
+                    counts[year] = counts.get(year, 0) + count
+                return counts
+
+    async def snapshot(self):
+        page = await self.finance_manager.get_statistics_page(1, page_size=100)
+        batches = [batch async for batch in self.finance_manager.iter_transactions(1, batch_size=5)]
+        return (await self.finance_manager.get_category_totals(1), page.text, sum(batches, []),
+                await self.finance_manager.get_base_currency_report(1))
+
+    async def test_old_years_move_to_archives_transparently(self):
+        before = await self.snapshot()
+
+        moved = await self.archive_manager.run(today=datetime.date(2026, 10, 18))
+
+        self.assertEqual(moved, 8)
+        self.assertEqual(await self.count_main(), {'2025': 4})
+        self.assertEqual(sorted(os.listdir(self.archive_dir)), ['archive_2021.db', 'archive_2022.db'])
+        self.assertEqual(self.pool.archive_years(), (2021, 2022))
+        self.assertEqual(await self.snapshot(), before)
+
+        await self.db_manager.rebuild_category_totals()
+        self.assertEqual(await self.finance_manager.get_category_totals(1), before[0])
+
+        self.assertEqual(await self.archive_manager.run(today=datetime.date(2026, 10, 18)), 0)
+
+    async def test_paging_across_archive_boundary(self):
+        await self.archive_manager.run(today=datetime.date(2026, 10, 18))
+
+        page = await self.finance_manager.get_statistics_page(1, page_size=5)
+        older = await self.finance_manager.get_statistics_page(1, cursor=page.next_cursor, page_size=5)
+        self.assertIn('2025-01-15', page.text)
+        self.assertIn('2022-04-15', page.text)
+        self.assertIn('2022-03-15', older.text)
+        self.assertNotIn('2022-04-15', older.text)
+
+        recent = await self.finance_manager.get_statistics_page(1, date_from=datetime.date(2025, 1, 1))
+        self.assertIn('2025-01-15', recent.text)
+        self.assertNotIn('2022', recent.text)
+
+    async def test_hot_range_reads_main_database_only(self):
+        await self.archive_manager.run(today=datetime.date(2026, 10, 18))
+
+        async with self.pool.reader() as db:
+            self.assertEqual(await self.pool.history_tables(db, '2023-01-01'), ('income', 'expenses'))
+            income, _ = await self.pool.history_tables(db, '2022-06-01')
+        self.assertIn('archive_2022.income', income)
+
+    async def test_incremental_vacuum_returns_free_pages(self):
+        await self.archive_manager.run(today=datetime.date(2026, 10, 18))
+
+        async with self.pool.writer() as db:
+            async with db.execute('PRAGMA auto_vacuum') as cursor:
+                self.assertEqual((await cursor.fetchone())[0], 2)
+            async with db.execute('PRAGMA freelist_count') as cursor:
+                self.assertEqual((await cursor.fetchone())[0], 0)
+
+
+class TestTransactionSearch(unittest.IsolatedAsyncioTestCase):
+
+    CSV = ('Дата;Сумма;Категория;Описание\n'
+           '2024-03-05;-1500;Такси;Яндекс Go\n'
+           '2024-04-10;-300;Такси;Ситимобил\n'
+           '2024-04-12;-2500;Супермаркеты;Пятёрочка <акция>\n'
+           '2024-07-01;-1200;Такси;Яндекс Go\n'
+           '2021-05-01;-5000;Такси;Яндекс Go\n'
+           '2024-03-06;80000;Зарплата;Аванс\n')
+
+    async def asyncSetUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.pool = ConnectionPool(os.path.join(self.tmp_dir.name, 'test.db'), readers=1,
+                                   archive_dir=os.path.join(self.tmp_dir.name, 'archive'))
+        await self.pool.open()
+        await DatabaseManager(self.pool).init_db()
+        self.finance_manager = FinanceManager(self.pool, UserManager(self.pool), AsyncMock(spec=WriteQueue),
+                                              AsyncMock(spec=ChartRenderer), ChartCache(), RateStore(self.pool))
+        await self.finance_manager.import_transactions(1, io.BytesIO(self.CSV.encode('utf-8')))
+        await self.finance_manager.import_transactions(2, io.BytesIO(self.CSV.encode('utf-8')))
+
+    async def asyncTearDown(self):
+        await self.pool.close()
+        self.tmp_dir.cleanup()
+
+    async def search(self, text, **kwargs):
+        return await self.finance_manager.search_transactions(1, parse_search_query(text), **kwargs)
+
+    def test_parse_search_query(self):
+        query = parse_search_query('Такси расходы >1000 <2000,5 2024-03..2024-05')
+        self.assertEqual(query, SearchQuery(['такси'], 'e', 1000.0, 2000.5, '2024-03-01', '2024-06-01'))
+        self.assertEqual(parse_search_query('2024-12').date_to, '2025-01-01')
+        self.assertEqual(parse_search_query('2024').date_to, '2025-01-01')
+        self.assertEqual(parse_search_query('"кафе" 2024-02-29').date_to, '2024-03-01')
+        self.assertEqual(parse_search_query('"кафе" такс*').match_expression(5),
+                         'owner : "u5" AND {category note currency} : ("""кафе""" AND "такс"*)')
+        for text in ('', '---', '2024-13'):
+            with self.assertRaises(ValueError):
+                parse_search_query(text)
+
+    async def test_search_filters_by_text_amount_and_period(self):
+        page = await self.search('такс* >1000 2024-03..2024-05')
+
+        self.assertEqual(page.text, "Найденные операции:\n2024-03-05 -1500.00 RUB · Транспорт — Такси Яндекс Go")
+        self.assertIsNone(page.next_cursor)
+
+        page = await self.search('яндекс')
+        self.assertEqual(page.text.count('Яндекс'), 3)
+        self.assertIn('Ничего не найдено', (await self.search('аванс расходы')).text)
+        self.assertIn('Ничего не найдено', (await self.search('такс')).text)
+        self.assertIn('+80000.00 RUB · Зарплата — Аванс', (await self.search('аванс')).text)
+        self.assertIn('Пятёрочка &lt;акция&gt;', (await self.search('пятерочка')).text)
+        self.assertIn('Пятёрочка', (await self.search('ПЯТЁРОЧКА')).text)
+
+    async def test_search_pages_by_date(self):
+        first = await self.search('такси', page_size=2)
+        second = await self.search('такси', cursor=first.next_cursor, page_size=2)
+        back = await self.search('такси', cursor=second.prev_cursor, backward=True, page_size=2)
+
+        self.assertIn('2024-07-01', first.text)
+        self.assertIn('2024-04-10', first.text)
+        self.assertIn('2024-03-05', second.text)
+        self.assertIn('2021-05-01', second.text)
+        self.assertIsNone(second.next_cursor)
+        self.assertEqual(back.text, first.text)
+
+    async def test_index_follows_changes_and_archiving(self):
+        async with self.pool.writer() as db:
+            await db.execute("UPDATE expenses SET note = 'Убер' WHERE date LIKE '2024-07%'")
+            await db.execute("DELETE FROM expenses WHERE note LIKE '%Ситимобил'")
+            await db.commit()
+
+        self.assertIn('2024-07-01', (await self.search('убер')).text)
+        self.assertNotIn('2024-07-01', (await self.search('яндекс')).text)
+        self.assertIn('Ничего не найдено', (await self.search('ситимобил')).text)
+
+        await ArchiveManager(self.pool, attach_grace=0).run(today=datetime.date(2026, 10, 18))
+        self.assertEqual(self.pool.archive_years(), (2021,))
+        self.assertIn('2021-05-01', (await self.search('яндекс 2021')).text)
+        self.assertIn('2021-05-01', (await self.search('яндекс')).text)
+        async with self.pool.reader() as db:
+            async with db.execute("SELECT COUNT(*) FROM transactions_fts "
+                                  "WHERE transactions_fts MATCH 'яндекс'") as cursor:
+                self.assertEqual((await cursor.fetchone())[0], 4)
+
+
+class TestChartRenderer(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.renderer = ChartRenderer(max_workers=1, timeout=30, max_pending=1, queue_timeout=0.01)
+        await self.renderer.start()
+
+    async def asyncTearDown(self):
+        self.renderer.close()
+
+    async def test_render_returns_png(self):
+        image = await self.renderer.render({'Зарплата': 1000}, {'Продукты': 250, 'Транспорт': 50})
+
+        self.assertTrue(image.startswith(b'\x89PNG'))
+
+    async def test_saturated_pool_rejects_request(self):
+        first = asyncio.create_task(self.renderer.render({'Зарплата': 1000}, {'Продукты': 250}))
+        await asyncio.sleep(0)
+
+        with self.assertRaises(ChartRendererBusy):
+            await self.renderer.render({'Зарплата': 1000}, {'Продукты': 250})
+        await first
+
+    def test_render_without_income(self):
+        self.assertTrue(render_statistics_chart({}, {'Продукты': 1}).startswith(b'\x89PNG'))
+
+
+class TestRateHistory(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.pool = ConnectionPool(os.path.join(self.tmp_dir.name, 'test.db'), readers=1)
+        await self.pool.open()
+        await DatabaseManager(self.pool).init_db()
+        self.rate_store = RateStore(self.pool)
+        self.finance_manager = FinanceManager(self.pool, UserManager(self.pool), AsyncMock(spec=WriteQueue),
+                                              AsyncMock(spec=ChartRenderer), ChartCache(), self.rate_store)
+
+    async def asyncTearDown(self):
+        await self.pool.close()
+        self.tmp_dir.cleanup()
+
+    async def insert(self, table, category, amount, currency, date):
+        async with self.pool.writer() as db:
+            await db.execute('INSERT OR IGNORE INTO users (id, telegram_id) VALUES (1, 1)')
+            await db.execute(f'INSERT INTO {table} (user_id, category, amount, currency, date) VALUES (1, ?, ?, ?, ?)',
+                             (category, amount, currency, date))
+            await db.commit()
+
+    async def test_import_archived_xml(self):
+        path = os.path.join(self.tmp_dir.name, 'rates.xml')
+        with open(path, 'wb') as file:
+            file.write(CBR_XML)
+
+        self.assertEqual(await self.rate_store.import_xml_files([path]), 2)
+
+        history = await self.rate_store.load_history(['USD', 'RUB'])
+        self.assertEqual(list(history), ['USD'])
+        self.assertEqual(str(history['USD'][0][0]), '2023-01-01')
+
+    async def test_report_uses_rate_of_each_transaction_date(self):
+        await self.rate_store.save_rates('2024-01-01', {'USD': {'value': 90.0, 'nominal': 1}})
+        await self.rate_store.save_rates('2024-02-01', {'USD': {'value': 100.0, 'nominal': 1}})
+        await self.insert('income', 'Зарплата', 100, 'usd', '2024-01-15T10:00:00')
+        await self.insert('income', 'Зарплата', 100, 'USD', '2024-02-15T10:00:00')
+        await self.insert('expenses', 'Продукты', 1900, 'RUB', '2024-02-20T10:00:00')
+        await self.insert('expenses', 'Продукты', 5, 'XYZ', '2024-02-20T10:00:00')
+
+        report = await self.finance_manager.get_base_currency_report(1, 'RUB')
+
+        self.assertIn("Доходы: 19000.00", report)
+        self.assertIn("Расходы: 1900.00", report)
+        self.assertIn("Баланс: 17100.00", report)
+        self.assertIn("Не пересчитано операций: 1 (нет курсов: XYZ)", report)
+
+        report_usd = await self.finance_manager.get_base_currency_report(1, 'USD')
+        self.assertIn("Доходы: 200.00", report_usd)
+        self.assertIn("Расходы: 19.00", report_usd)
+
+    async def test_report_unknown_base_currency(self):
+        with self.assertRaises(ValueError):
+            await self.finance_manager.get_base_currency_report(1, 'ABC')
+
+
+class TestChartCache(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.pool = ConnectionPool(os.path.join(self.tmp_dir.name, 'test.db'), readers=1)
+        await self.pool.open()
+        await DatabaseManager(self.pool).init_db()
+        self.write_queue = WriteQueue(self.pool)
+        self.write_queue.start()
+        self.renderer = AsyncMock(spec=ChartRenderer)
+        self.renderer.render.return_value = b'png'
+        self.cache = ChartCache(disk_dir=os.path.join(self.tmp_dir.name, 'charts'))
+        self.finance_manager = FinanceManager(self.pool, UserManager(self.pool), self.write_queue, self.renderer,
+                                              self.cache, RateStore(self.pool))
 
-    def tearDown(self):
-        self.patcher.stop()
+    async def asyncTearDown(self):
+        await self.write_queue.close()
+        await self.pool.close()
+        self.tmp_dir.cleanup()
+
+    async def test_chart_reused_until_new_transaction(self):
+        await self.finance_manager.add_income(1, 'Зарплата', 1000, 'RUB')
+
+        first = await self.finance_manager.create_statistics_chart(1)
+        await self.finance_manager.remember_chart_file_id(first.key, 'file-id')
+        second = await self.finance_manager.create_statistics_chart(1)
+        await self.finance_manager.add_expense(1, 'Продукты', 100, 'RUB')
+        third = await self.finance_manager.create_statistics_chart(1)
+
+        self.assertEqual(second.key, first.key)
+        self.assertEqual(second.file_id, 'file-id')
+        self.assertNotEqual(third.key, first.key)
+        self.assertIsNone(third.file_id)
+        self.assertEqual(self.renderer.render.await_count, 2)
+
+    async def test_disk_tier_survives_memory_eviction(self):
+        await self.cache.put('a' * 64, b'png-a')
+        await self.cache.set_file_id('a' * 64, 'file-a')
+
+        fresh = ChartCache(disk_dir=self.cache.disk_dir)
+        chart = await fresh.get('a' * 64)
+
+        self.assertEqual((chart.png, chart.file_id), (b'png-a', 'file-a'))
+
+    async def test_memory_tier_is_bounded_by_bytes(self):
+        cache = ChartCache(max_bytes=10)
+        await cache.put('a', b'12345678')
+        await cache.put('b', b'12345678')
+
+        self.assertIsNone(await cache.get('a'))
+        self.assertEqual(cache.stats()['bytes'], 8)
+
+
+class TestMigrations(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.pool = ConnectionPool(os.path.join(self.tmp_dir.name, 'test.db'), readers=1)
+        await self.pool.open()
+        self.db_manager = DatabaseManager(self.pool)
+
+    async def asyncTearDown(self):
+        await self.pool.close()
+        self.tmp_dir.cleanup()
+
+    async def test_init_db_applies_all_migrations(self):
+        version = await self.db_manager.init_db()
+
+        self.assertEqual(version, MIGRATIONS[-1][0])
+        async with self.pool.reader() as db:
+            async with db.execute("SELECT name FROM sqlite_master WHERE type = 'index'") as cursor:
+                indexes = {row[0] for row in await cursor.fetchall()}
+        self.assertTrue({'idx_income_user_date', 'idx_expenses_user_date', 'idx_reminders_remind_at',
+                         'idx_financial_goals_deadline', 'idx_financial_goals_user'} <= indexes)
+
+    async def test_only_pending_migrations_run(self):
+        await self.db_manager.init_db()
+
+        extra = [(MIGRATIONS[-1][0] + 1, ['CREATE TABLE extra (id INTEGER PRIMARY KEY)'])]
+        async with self.pool.writer() as db:
+            # Повторный запуск уже применённых шагов упал бы на CREATE TABLE без IF NOT EXISTS
+            await apply_migrations(db, [(1, ['CREATE TABLE users (id INTEGER)'])] + extra)
+            version = await apply_migrations(db, extra)
+
+        self.assertEqual(version, MIGRATIONS[-1][0] + 1)
+
+    async def test_concurrent_processes_apply_migrations_once(self):
+        other = ConnectionPool(self.pool.db_path, readers=1)
+        await other.open()
+        self.addAsyncCleanup(other.close)
+
+        versions = await asyncio.gather(self.db_manager.init_db(), DatabaseManager(other).init_db())
+
+        self.assertEqual(versions, [MIGRATIONS[-1][0]] * 2)
+        async with self.pool.reader() as db:
+            async with db.execute('SELECT COUNT(*) FROM schema_version') as cursor:
+                self.assertEqual((await cursor.fetchone())[0], len(MIGRATIONS))
+
+    async def test_failed_migration_is_rolled_back(self):
+        await self.db_manager.init_db()
+
+        broken = [(MIGRATIONS[-1][0] + 1, ['CREATE TABLE broken (id INTEGER)', 'NOT VALID SQL'])]
+        async with self.pool.writer() as db:
+            with self.assertRaises(sqlite3.OperationalError):
+                await apply_migrations(db, broken)
+
+        self.assertEqual(await self.db_manager.init_db(), MIGRATIONS[-1][0])
+        async with self.pool.reader() as db:
+            async with db.execute("SELECT COUNT(*) FROM sqlite_master WHERE name = 'broken'") as cursor:
+                row = await cursor.fetchone()
+        self.assertEqual(row[0], 0)
+
+    async def test_index_used_for_user_queries(self):
+        await self.db_manager.init_db()
+
+        async with self.pool.reader() as db:
+            async with db.execute('EXPLAIN QUERY PLAN SELECT category, amount FROM income WHERE user_id = ?',
+                                  (1,)) as cursor:
+                plan = ' '.join(row[-1] for row in await cursor.fetchall())
+        self.assertIn('idx_income_user_date', plan)
+
+
+CBR_XML = '''<?xml version="1.0" encoding="windows-1251"?>
+<ValCurs Date="01.01.2023" name="Foreign Currency Market">
+    <Valute ID="R01010">
+        <CharCode>USD</CharCode>
+        <Nominal>1</Nominal>
+        <Value>76,32</Value>
+    </Valute>
+    <Valute ID="R01035">
+        <CharCode>EUR</CharCode>
+        <Nominal>1</Nominal>
+        <Value>90,57</Value>
+    </Valute>
+</ValCurs>'''.encode('cp1251')
+
+
+class TestCurrencyManager(unittest.TestCase):
+
+    def setUp(self):
+        rates_date, currencies = parse_cbr_xml(CBR_XML)
+        self.currency_manager = CurrencyManager()
+        self.currency_manager.set_rates(currencies, rates_date)
 
     def test_get_rate_existing_currency(self):
         self.assertAlmostEqual(self.currency_manager.get_rate('USD'), 76.32)
@@ -287,6 +2032,107 @@ class TestCurrencyManager(unittest.TestCase):
         result = self.currency_manager.convert(1, 'USD', 'RUB')
         self.assertAlmostEqual(result, 76.32)
 
+    def test_convert_cross_rate(self):
+        self.assertAlmostEqual(self.currency_manager.convert(100, 'USD', 'EUR'), 100 * 76.32 / 90.57)
+
+    def test_convert_many_matches_convert(self):
+        amounts = [100, 7632, 1, 50]
+        codes = ['USD', 'RUB', 'EUR', 'USD']
+
+        result = self.currency_manager.convert_many(amounts, codes, 'EUR')
+
+        expected = [self.currency_manager.convert(a, c, 'EUR') for a, c in zip(amounts, codes)]
+        for actual, value in zip(result, expected):
+            self.assertAlmostEqual(actual, value)
+
+    def test_convert_many_unknown_currency(self):
+        with self.assertRaises(ValueError) as context:
+            self.currency_manager.convert_many([1, 2], ['USD', 'ABC'], 'RUB')
+        self.assertEqual(str(context.exception), "Валюта ABC не найдена")
+
+    def test_convert_many_empty(self):
+        self.assertEqual(len(self.currency_manager.convert_many([], [], 'RUB')), 0)
+
+
+class TestCurrencyRefresh(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.snapshot_path = os.path.join(self.tmp_dir.name, 'rates.json')
+        self.requests = []
+        self.server_down = False
+
+        async def handle(request):
+            self.requests.append(dict(request.headers))
+            if self.server_down:
+                return web.Response(status=500)
+            if request.headers.get('If-None-Match') == '"v1"':
+                return web.Response(status=304)
+            return web.Response(body=CBR_XML, headers={'ETag': '"v1"'}, content_type='application/xml')
+
+        app = web.Application()
+        app.router.add_get('/XML_daily.asp', handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f'http://127.0.0.1:{port}/XML_daily.asp'
+
+    async def asyncTearDown(self):
+        await self.runner.cleanup()
+        self.tmp_dir.cleanup()
+
+    async def test_refresh_uses_conditional_request_and_snapshot(self):
+        currency_manager = CurrencyManager(snapshot_path=self.snapshot_path, cbr_url=self.url)
+
+        self.assertTrue(await currency_manager.refresh())
+        self.assertFalse(await currency_manager.refresh())
+        self.assertEqual(self.requests[1].get('If-None-Match'), '"v1"')
+        self.assertAlmostEqual(currency_manager.get_rate('USD'), 76.32)
+
+        restored = CurrencyManager(snapshot_path=self.snapshot_path, cbr_url=self.url)
+        self.assertEqual(restored.rates_date, '2023-01-01')
+        self.assertAlmostEqual(restored.get_rate('EUR'), 90.57)
+        self.assertEqual(restored.etag, '"v1"')
+
+    async def test_failed_refresh_keeps_previous_rates(self):
+        currency_manager = CurrencyManager(cbr_url=self.url)
+        await currency_manager.refresh()
+        self.server_down = True
+
+        with self.assertLogs('currency_manager', level='ERROR'):
+            self.assertFalse(await currency_manager.refresh())
+
+        self.assertAlmostEqual(currency_manager.get_rate('USD'), 76.32)
+
+    def test_starts_without_snapshot_or_network(self):
+        currency_manager = CurrencyManager(snapshot_path=self.snapshot_path, cbr_url='http://127.0.0.1:9/')
+
+        with self.assertRaises(ValueError):
+            currency_manager.get_rate('USD')
+        self.assertIsNone(currency_manager.rates_date)
+        self.assertEqual(currency_manager.get_rate('RUB'), 1.0)
+        self.assertEqual(currency_manager.convert(100, 'RUB', 'RUB'), 100)
+
+    async def test_failed_first_refresh_is_retried_soon(self):
+        self.server_down = True
+        currency_manager = CurrencyManager(cbr_url=self.url, refresh_interval=3600, retry_interval=0.2)
+        with self.assertLogs('currency_manager', level='ERROR'):
+            currency_manager.start()
+            await asyncio.sleep(0.1)
+        self.server_down = False
+        try:
+            for _ in range(50):
+                if 'USD' in currency_manager.currencies:
+                    break
+                await asyncio.sleep(0.05)
+        finally:
+            currency_manager.stop()
+
+        self.assertAlmostEqual(currency_manager.get_rate('USD'), 76.32)
+        self.assertEqual(len(self.requests), 2)
+
 
 if __name__ == '__main__':
     unittest.main()
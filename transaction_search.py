@@ -0,0 +1,76 @@
+import datetime
+import re
+from dataclasses import dataclass, field
+from typing import Optional
+
+SEARCH_PAGE_SIZE = 10
+MAX_SEARCH_TERMS = 8
+KIND_WORDS = {'доход': 'i', 'доходы': 'i', 'расход': 'e', 'расходы': 'e'}
+# Период: год, месяц или день, либо диапазон из двух таких значений через «..»
+_PERIOD_RE = re.compile(r'(\d{4}(?:-\d{2}){0,2})(?:\.\.(\d{4}(?:-\d{2}){0,2}))?')
+_AMOUNT_RE = re.compile(r'([<>])(\d+(?:[.,]\d+)?)')
+
+
+@dataclass
+class SearchQuery:
+    terms: list = field(default_factory=list)
+    kind: Optional[str] = None
+    min_amount: Optional[float] = None
+    max_amount: Optional[float] = None
+    date_from: str = ''
+    date_to: str = '9999'
+
+    def match_expression(self, user_id) -> str:
+        # Слово ищется целиком; «*» в конце включает поиск по префиксу. Длинный префикс объединяет списки
+        # всех подходящих слов всех пользователей и заметно медленнее, поэтому он только по явному запросу
+        expression = f'owner : "u{user_id}"'
+        if self.terms:
+            phrases = ' AND '.join('"' + term.rstrip('*').replace('"', '""') + '"' + ('*' if term.endswith('*') else '')
+                                   for term in self.terms)
+            expression += f' AND {{category note currency}} : ({phrases})'
+        return expression
+
+
+def period_start(text: str) -> str:
+    parts = [int(part) for part in text.split('-')]
+    return datetime.date(*parts, *[1] * (3 - len(parts))).isoformat()
+
+
+def period_end(text: str) -> str:
+    # Граница исключающая: первый день после указанного года, месяца или дня
+    parts = [int(part) for part in text.split('-')]
+    if len(parts) == 1:
+        return datetime.date(parts[0] + 1, 1, 1).isoformat()
+    if len(parts) == 2:
+        year, month = divmod(parts[0] * 12 + parts[1], 12)
+        return datetime.date(year, month + 1, 1).isoformat()
+    return (datetime.date(*parts) + datetime.timedelta(days=1)).isoformat()
+
+
+def parse_search_query(text: str) -> SearchQuery:
+    query = SearchQuery()
+    for word in (text or '').split():
+        lowered = word.lower()
+        period = _PERIOD_RE.fullmatch(word)
+        amount = _AMOUNT_RE.fullmatch(word)
+        if lowered in KIND_WORDS:
+            query.kind = KIND_WORDS[lowered]
+        elif period:
+            query.date_from = period_start(period.group(1))
+            query.date_to = period_end(period.group(2) or period.group(1))
+        elif amount:
+            value = float(amount.group(2).replace(',', '.'))
+            if amount.group(1) == '>':
+                query.min_amount = value
+            else:
+                query.max_amount = value
+        elif any(char.isalnum() for char in word):
+            # Индекс хранит текст с «е» вместо «ё», так же нормализуется и запрос
+            query.terms.append(lowered.replace('ё', 'е'))
+
+    if not (query.terms or query.kind or query.min_amount is not None or query.max_amount is not None
+            or query.date_from):
+        raise ValueError("Пустой поисковый запрос.")
+    if len(query.terms) > MAX_SEARCH_TERMS:
+        raise ValueError("Слишком много слов в запросе.")
+    return query
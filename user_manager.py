@@ -1,41 +1,93 @@
-import aiosqlite
+from lru_cache import LRUCache
+
+# Запас до SQLITE_MAX_VARIABLE_NUMBER старых сборок SQLite (999)
+LOOKUP_CHUNK_SIZE = 500
 
 
 class UserManager:
-    def __init__(self, db_name):
-        self.db_name = db_name
+    def __init__(self, pool, cache_size: int = 10000):
+        self.pool = pool
+        self._user_ids = LRUCache(cache_size)
+        self._telegram_ids = LRUCache(cache_size)
 
-    async def add_user(self, telegram_id: int):
+    def _remember(self, telegram_id: int, user_id: int):
+        self._user_ids.put(telegram_id, user_id)
+        self._telegram_ids.put(user_id, telegram_id)
+
+    def cache_stats(self) -> dict:
+        return {
+            'user_id': self._user_ids.stats(),
+            'telegram_id': self._telegram_ids.stats(),
+        }
 
-        async with aiosqlite.connect(self.db_name) as db:
-            await db.execute('INSERT OR IGNORE INTO users (telegram_id) VALUES (?)', (telegram_id,))
-            await db.commit()
+    async def add_user(self, telegram_id: int):
+        await self.get_user_id(telegram_id)
 
     async def get_user_id(self, telegram_id: int):
+        user_id = self._user_ids.get(telegram_id)
+        if user_id is not None:
+            return user_id
 
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self.pool.reader() as db:
             async with db.execute('SELECT id FROM users WHERE telegram_id = ?', (telegram_id,)) as cursor:
                 user = await cursor.fetchone()
-                if user:
-                    return user[0]
-                else:
-                    # User doesn't exist, add them
-                    await db.execute('INSERT INTO users (telegram_id) VALUES (?)', (telegram_id,))
-                    await db.commit()
-                    # Retrieve the new user ID
-                    async with db.execute('SELECT id FROM users WHERE telegram_id = ?', (telegram_id,)) as cursor:
-                        user = await cursor.fetchone()
-                        return user[0]
+
+        if user is None:
+            # Новый пользователь создаётся одним upsert, который сразу возвращает id
+            async with self.pool.writer() as db:
+                async with db.execute('''
+                    INSERT INTO users (telegram_id) VALUES (?)
+                    ON CONFLICT(telegram_id) DO UPDATE SET telegram_id = excluded.telegram_id
+                    RETURNING id
+                ''', (telegram_id,)) as cursor:
+                    user = await cursor.fetchone()
+                await db.commit()
+
+        self._remember(telegram_id, user[0])
+        return user[0]
 
     async def get_telegram_id(self, user_id: int) -> int:
-        async with aiosqlite.connect(self.db_name) as db:
+        telegram_id = self._telegram_ids.get(user_id)
+        if telegram_id is not None:
+            return telegram_id
+
+        async with self.pool.reader() as db:
             async with db.execute('SELECT telegram_id FROM users WHERE id = ?', (user_id,)) as cursor:
                 row = await cursor.fetchone()
                 if row:
                     try:
                         # Преобразование в int перед возвратом
-                        return int(row[0])
+                        telegram_id = int(row[0])
                     except ValueError:
                         raise ValueError(f"Telegram ID для пользователя с id {user_id} не является целым числом.")
                 else:
                     raise ValueError(f"Пользователь с id {user_id} не найден.")
+
+        self._remember(telegram_id, user_id)
+        return telegram_id
+
+    async def get_telegram_ids(self, user_ids) -> dict:
+        result = {}
+        missing = []
+        for user_id in dict.fromkeys(user_ids):
+            telegram_id = self._telegram_ids.get(user_id)
+            if telegram_id is not None:
+                result[user_id] = telegram_id
+            else:
+                missing.append(user_id)
+
+        if not missing:
+            return result
+
+        # Промахи кэша разрешаются одним запросом на пачку; неизвестные id в результат не попадают
+        async with self.pool.reader() as db:
+            for start in range(0, len(missing), LOOKUP_CHUNK_SIZE):
+                chunk = missing[start:start + LOOKUP_CHUNK_SIZE]
+                placeholders = ', '.join('?' * len(chunk))
+                async with db.execute(f'SELECT id, telegram_id FROM users WHERE id IN ({placeholders})',
+                                      chunk) as cursor:
+                    async for user_id, telegram_id in cursor:
+                        telegram_id = int(telegram_id)
+                        self._remember(telegram_id, user_id)
+                        result[user_id] = telegram_id
+        return result
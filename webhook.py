@@ -0,0 +1,150 @@
+import asyncio
+import logging
+import signal
+
+from aiogram import Bot, Dispatcher, types
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+def update_user_id(payload: dict):
+    # Все типы апдейтов с отправителем хранят его в поле from вложенного объекта
+    for value in payload.values():
+        if isinstance(value, dict):
+            user = value.get('from') or value.get('user')
+            if isinstance(user, dict) and 'id' in user:
+                return user['id']
+    return None
+
+
+class UpdateProcessor:
+    def __init__(self, dispatcher: Dispatcher, max_in_flight: int = 100):
+        self.dispatcher = dispatcher
+        self._slots = asyncio.Semaphore(max_in_flight)
+        self._tails = {}
+        self._tasks = set()
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._tasks)
+
+    async def acquire(self, timeout: float = None) -> bool:
+        try:
+            await asyncio.wait_for(self._slots.acquire(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    def dispatch(self, payload: dict):
+        # Слот должен быть занят через acquire(); он освобождается по завершении обработки
+        task = asyncio.get_running_loop().create_task(self._process(payload, update_user_id(payload)))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def join(self, timeout: float = None):
+        if self._tasks:
+            await asyncio.wait(self._tasks, timeout=timeout)
+
+    async def _process(self, payload, user_id):
+        # Апдейты одного пользователя выполняются по очереди, иначе диалоги FSM перепутают шаги
+        previous = self._tails.get(user_id) if user_id is not None else None
+        current = asyncio.current_task()
+        if user_id is not None:
+            self._tails[user_id] = current
+
+        try:
+            if previous is not None:
+                await asyncio.wait([previous])
+            Dispatcher.set_current(self.dispatcher)
+            Bot.set_current(self.dispatcher.bot)
+            await self.dispatcher.process_update(types.Update(**payload))
+        except Exception:
+            logger.exception("Ошибка обработки апдейта %s", payload.get('update_id'))
+        finally:
+            if user_id is not None and self._tails.get(user_id) is current:
+                del self._tails[user_id]
+            self._slots.release()
+
+
+class WebhookServer:
+    def __init__(self, dispatcher: Dispatcher, host: str = '0.0.0.0', port: int = 8080, path: str = '/webhook',
+                 max_in_flight: int = 100, acquire_timeout: float = 1.0, secret_token: str = None):
+        self.dispatcher = dispatcher
+        self.host = host
+        self.port = port
+        self.path = path
+        self.max_in_flight = max_in_flight
+        self.acquire_timeout = acquire_timeout
+        self.secret_token = secret_token
+
+        self._processor = None
+        self._runner = None
+
+    @property
+    def in_flight(self) -> int:
+        return self._processor.in_flight if self._processor is not None else 0
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post(self.path, self._handle)
+        return app
+
+    async def start(self):
+        self._processor = UpdateProcessor(self.dispatcher, self.max_in_flight)
+        self._runner = web.AppRunner(self.make_app())
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    async def close(self, timeout: float = 30):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+        # Уже принятые апдейты дорабатываются, чтобы не потерять подтверждённые Telegram сообщения
+        if self._processor is not None:
+            await self._processor.join(timeout)
+
+    async def _handle(self, request):
+        if self.secret_token and request.headers.get(SECRET_HEADER) != self.secret_token:
+            return web.Response(status=401)
+
+        try:
+            payload = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+
+        # При исчерпании лимита отвечаем 503: Telegram повторит доставку позже, а память не растёт
+        if not await self._processor.acquire(self.acquire_timeout):
+            return web.Response(status=503, headers={'Retry-After': '1'})
+
+        self._processor.dispatch(payload)
+        return web.Response(text='ok')
+
+
+async def run_webhook(server: WebhookServer, on_startup, on_shutdown, webhook_url: str = None):
+    dispatcher = server.dispatcher
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+
+    await on_startup(dispatcher)
+    if webhook_url:
+        await dispatcher.bot.set_webhook(webhook_url, secret_token=server.secret_token,
+                                         max_connections=min(server.max_in_flight, 100))
+    await server.start()
+    logger.info("Вебхук слушает %s:%s%s", server.host, server.port, server.path)
+
+    try:
+        await stop.wait()
+    finally:
+        await server.close()
+        await on_shutdown(dispatcher)
+        await dispatcher.storage.close()
+        await dispatcher.storage.wait_closed()
+        session = await dispatcher.bot.get_session()
+        await session.close()
@@ -0,0 +1,125 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class WriteQueue:
+    def __init__(self, pool, max_batch: int = 256, flush_interval: float = 0.005):
+        self.pool = pool
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+
+        self._queue = asyncio.Queue()
+        self._task = None
+        self._closing = False
+
+    def qsize(self) -> int:
+        return self._queue.qsize()
+
+    def start(self):
+        if self._task is None:
+            self._closing = False
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def submit(self, *statements):
+        if self._closing or self._task is None:
+            raise RuntimeError("Очередь записи не запущена.")
+
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((statements, future))
+        # Управление возвращается только после COMMIT пакета, в который попала запись; при synchronous=FULL
+        # пула COMMIT означает, что запись уже на диске. Результат — число изменённых строк по каждому запросу
+        return await future
+
+    async def close(self):
+        if self._task is None:
+            return
+
+        self._closing = True
+        self._queue.put_nowait(None)
+        await self._task
+        self._task = None
+
+    async def _run(self):
+        while True:
+            item = await self._queue.get()
+            if item is None:
+                break
+
+            batch = [item]
+            rows = len(item[0])
+            stop = False
+            deadline = asyncio.get_running_loop().time() + self.flush_interval
+            while rows < self.max_batch:
+                timeout = deadline - asyncio.get_running_loop().time()
+                try:
+                    item = self._queue.get_nowait() if timeout <= 0 else await asyncio.wait_for(self._queue.get(),
+                                                                                                 timeout)
+                except (asyncio.QueueEmpty, asyncio.TimeoutError):
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+                rows += len(item[0])
+
+            await self._flush(batch)
+            if stop:
+                break
+
+        # Дренируем всё, что успели поставить в очередь до закрытия
+        remaining = []
+        while not self._queue.empty():
+            item = self._queue.get_nowait()
+            if item is not None:
+                remaining.append(item)
+        if remaining:
+            await self._flush(remaining)
+
+    async def _flush(self, batch):
+        try:
+            changes = await self._execute(batch)
+        except Exception as error:
+            if len(batch) == 1:
+                future = batch[0][1]
+                if not future.done():
+                    future.set_exception(error)
+                return
+            # Одна некорректная запись не должна ронять чужие вставки из того же пакета
+            logger.exception("Групповая запись не удалась, повторяем по одной")
+            for item in batch:
+                await self._flush([item])
+            return
+
+        for (_, future), counts in zip(batch, changes):
+            if not future.done():
+                future.set_result(counts)
+
+    async def _execute(self, batch):
+        # Подряд идущие отправки с одинаковым набором запросов объединяются, и каждый запрос набора выполняется
+        # одним executemany. Внутри такой серии запросы разных отправок должны быть независимы (вставки,
+        # накопительные upsert); отправка другого вида разрывает серию, поэтому, например, «установить бюджет —
+        # удалить — установить» выполняется в порядке отправки
+        runs = []
+        for statements, _ in batch:
+            shape = tuple(sql for sql, _ in statements)
+            if runs and runs[-1][0] == shape:
+                runs[-1][1].append(statements)
+            else:
+                runs.append((shape, [statements]))
+
+        changes = []
+        async with self.pool.writer() as db:
+            for shape, submissions in runs:
+                counts = []
+                for index, sql in enumerate(shape):
+                    cursor = await db.executemany(sql, [statements[index][1] for statements in submissions])
+                    counts.append(cursor.rowcount)
+                # executemany сообщает только сумму по серии: точное число известно для отправки без соседей,
+                # а в серии — лишь когда запрос не изменил ни одной строки; иначе вместо числа None
+                if len(submissions) > 1:
+                    counts = [0 if count == 0 else None for count in counts]
+                changes += [counts] * len(submissions)
+            await db.commit()
+        return changes